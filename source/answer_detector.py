@@ -0,0 +1,74 @@
+import json
+
+# Detects the answer line ({"evidence": ..., "testimony": ...}) while a response is generated,
+# so that generation can stop as soon as it is complete instead of running to the end.
+
+ANSWER_KEYS = ("evidence", "testimony")
+
+def is_answer(obj):
+    return isinstance(obj, dict) and all(
+        key in obj and isinstance(obj[key], (int, str)) and not isinstance(obj[key], bool) for key in ANSWER_KEYS
+    )
+
+class AnswerDetector:
+    """
+    Fed the answer text chunk by chunk. `done` becomes True once a line of the text is a complete
+    json object with an evidence and a testimony, which is what get_json_answer parses.
+    Only lines that end with a "}" seen in the latest chunk are checked.
+    """
+    def __init__(self):
+        self.text = ""
+        self.done = False
+        self.answer = None
+
+    def feed(self, chunk):
+        if self.done or not chunk:
+            return self.done
+        start = len(self.text)
+        self.text += chunk
+        end = self.text.find("}", start)
+        while end != -1:
+            line_start = self.text.rfind("\n", 0, end) + 1
+            candidate = self.text[line_start:end + 1].strip()
+            if candidate.startswith("{"):
+                try:
+                    obj = json.loads(candidate)
+                except json.JSONDecodeError:
+                    obj = None
+                if is_answer(obj):
+                    self.done = True
+                    self.answer = obj
+                    self.text = self.text[:end + 1]  # Drop whatever followed the answer in the chunk
+                    return True
+            end = self.text.find("}", end + 1)
+        return False
+
+def make_stopping_criteria(tokenizer):
+    """Hugging Face stopping criteria that ends generation once the answer line is complete"""
+    import torch
+    from transformers import StoppingCriteria, StoppingCriteriaList
+
+    class AnswerStoppingCriteria(StoppingCriteria):
+        def __init__(self):
+            self.prompt_length = None
+            self.detectors = None
+            self.lengths = None
+
+        def __call__(self, input_ids, scores, **kwargs):
+            if self.prompt_length is None:  # First call: one token generated
+                self.prompt_length = input_ids.shape[-1] - 1
+                self.detectors = [AnswerDetector() for _ in range(input_ids.shape[0])]
+                self.lengths = [0] * input_ids.shape[0]
+            done = []
+            for row, detector in enumerate(self.detectors):
+                if not detector.done and "}" not in tokenizer.decode(input_ids[row, -1:]):
+                    done.append(False)
+                    continue
+                # Decode everything since the last check, since tokens do not always decode on their own
+                text = tokenizer.decode(input_ids[row, self.prompt_length:], skip_special_tokens=True)
+                detector.feed(text[self.lengths[row]:])
+                self.lengths[row] = len(text)
+                done.append(detector.done)
+            return torch.tensor(done, dtype=torch.bool, device=input_ids.device)
+
+    return StoppingCriteriaList([AnswerStoppingCriteria()])
@@ -0,0 +1,150 @@
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+from run_models import load_case, build_prompt_prefix_suffix, SYSTEM_MESSAGE
+from prompt_compiler import LAYOUTS
+
+# Benchmark local (Hugging Face) inference on the prompts of real cases. Without --model, a tiny
+# randomly initialised Llama with a byte-level tokenizer is built under ../cache/tiny_model, so the
+# benchmark runs on CPU; the timings then are not real speeds. With its default hidden size of 128,
+# attention outweighs the per-token work of the layers, unlike in real models, so prefilling fewer
+# tokens saves little time. A larger --hidden_size gives timings closer to a real model.
+
+TINY_MODEL_DIR = "../cache/tiny_model"
+CHAT_TEMPLATE = (
+    "{% for message in messages %}<|{{ message['role'] }}|>{{ message['content'] }}<|end|>{% endfor %}"
+    "{% if add_generation_prompt %}<|assistant|>{% endif %}"
+)
+
+def parse_bench_local_arguments():
+    parser = argparse.ArgumentParser(description='Time local model inference on the prompts of real cases')
+    parser.add_argument('-m', '--model', type=str, default=None, help='Hugging Face model id or dir, defaults to a tiny random model')
+    parser.add_argument('-p', '--prompt', type=str, default='base', help='prompt name')
+    parser.add_argument('--context', type=str, default=None, help='context setting of the prompts, as in run_models.py')
+    parser.add_argument('--layout', type=str, default='cache', choices=LAYOUTS, help='prompt layout, as in run_models.py')
+    parser.add_argument('--data', type=str, default='aceattorney', help='dataset name, aceattorney or danganronpa')
+    parser.add_argument('--cases', type=int, default=5, help='number of cases, taken in order')
+    parser.add_argument('--max_new_tokens', type=int, default=16)
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--hidden_size', type=int, default=128, help='hidden size of the tiny random model, e.g. 1024 for one where per-token work outweighs attention, as in real models')
+    parser.add_argument('--batch_sizes', type=str, default=None, help='instead report the throughput of batched generation for these comma-separated batch sizes, e.g. 1,4,8')
+    return parser
+
+def build_tiny_model(model_dir=TINY_MODEL_DIR, hidden_size=128):
+    """Random 2-layer Llama whose tokenizer maps every byte to a token, so that nothing needs to be downloaded"""
+    if hidden_size != 128:
+        model_dir = f"{model_dir}_{hidden_size}"
+    if os.path.exists(os.path.join(model_dir, "config.json")):
+        return model_dir
+    import torch
+    from tokenizers import Tokenizer, models, pre_tokenizers, decoders
+    from transformers import PreTrainedTokenizerFast, LlamaConfig, LlamaForCausalLM
+
+    specials = ["<s>", "</s>", "<|system|>", "<|user|>", "<|assistant|>", "<|end|>"]
+    alphabet = pre_tokenizers.ByteLevel.alphabet()
+    vocab = {token: i for i, token in enumerate(specials + sorted(alphabet))}
+    tokenizer = Tokenizer(models.BPE(vocab=vocab, merges=[]))
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=tokenizer, bos_token="<s>", eos_token="</s>", pad_token="</s>")
+    tokenizer.add_special_tokens({"additional_special_tokens": specials[2:]})
+    tokenizer.chat_template = CHAT_TEMPLATE
+    tokenizer.save_pretrained(model_dir)
+
+    torch.manual_seed(0)
+    config = LlamaConfig(
+        vocab_size=len(vocab), hidden_size=hidden_size, intermediate_size=2 * hidden_size, num_hidden_layers=2,
+        num_attention_heads=hidden_size // 32, num_key_value_heads=hidden_size // 64, max_position_embeddings=1 << 20, bos_token_id=0, eos_token_id=1, pad_token_id=1
+    )
+    LlamaForCausalLM(config).save_pretrained(model_dir)
+    print(f"<build_tiny_model> Built a random model in {model_dir}")
+    return model_dir
+
+def load_prompts(data_dir, n_cases, prompt, context, layout):
+    """Turn prompts of the first n_cases cases with turns, as lists of prompts per case"""
+    prompt_prefix, prompt_suffix = build_prompt_prefix_suffix(prompt)
+    cases = []
+    for fname in sorted(fname for fname in os.listdir(data_dir) if fname.endswith('.json')):
+        case = load_case(os.path.join(data_dir, fname))
+        if case.turns:
+            cases.append(case.build(prompt_prefix, prompt_suffix, context, False, "local", layout))
+        if len(cases) == n_cases:
+            break
+    return cases
+
+def bench_prefix_cache(model_dir, cases, max_new_tokens, device):
+    """
+    Time every turn with and without reusing the KV cache of the shared prefix, greedy so that answers
+    compare. Fewer prefilled tokens only save time when the model is large enough for its per-token
+    work to outweigh attention, see the README
+    """
+    from kani import Kani
+    from kani.engines.huggingface import HuggingEngine
+    from local_engine import PrefixCachingEngine
+
+    hyperparams = {"max_new_tokens": max_new_tokens, "do_sample": False}
+    print(f"{'engine':<14}{'seconds':>9}{'prompt tokens':>15}{'prefilled':>11}")
+    answers, seconds = {}, {}
+    for name, engine_class in [("plain", HuggingEngine), ("prefix_cache", PrefixCachingEngine)]:
+        engine = engine_class(model_dir, device=device)
+
+        async def run():
+            texts, n_tokens = [], 0
+            for prompts in cases:
+                for prompt in prompts:
+                    client = Kani(engine, system_prompt=SYSTEM_MESSAGE)  # One fresh session per prompt
+                    texts.append((await client.chat_round(prompt, **hyperparams)).text)
+                    n_tokens += await engine.prompt_len(client.always_included_messages + client.chat_history[:-1])
+            return texts, n_tokens
+
+        asyncio.run(Kani(engine).chat_round("Hello", max_new_tokens=1))  # Warm up outside the timed region
+        prefilled = engine.prefix_cache.prefill_tokens if hasattr(engine, "prefix_cache") else 0
+        start = time.perf_counter()
+        answers[name], n_tokens = asyncio.run(run())
+        seconds[name] = time.perf_counter() - start
+        prefilled = engine.prefix_cache.prefill_tokens - prefilled if hasattr(engine, "prefix_cache") else n_tokens
+        print(f"{name:<14}{seconds[name]:>9.2f}{n_tokens:>15}{prefilled:>11}")
+        del engine
+    same = sum(a == b for a, b in zip(answers["plain"], answers["prefix_cache"]))
+    print(f"Same answers: {same} of {len(answers['plain'])}")
+    print(f"prefix_cache took {seconds['prefix_cache'] / seconds['plain']:.2f}x the time of plain")
+
+def bench_throughput(model_dir, cases, batch_sizes, max_new_tokens, device):
+    """Throughput of generating all turn prompts in length buckets of each batch size, as run_local_batch_job does"""
+    from kani.engines.huggingface import HuggingEngine
+    from local_engine import length_buckets, tokenize_messages, generate_batch
+
+    engine = HuggingEngine(model_dir, device=device)
+    token_ids = [tokenize_messages(engine, [{"role": "user", "content": prompt}]) for prompts in cases for prompt in prompts]
+    generate_batch(engine, token_ids[:1], max_new_tokens=1)  # Warm up outside the timed region
+    print(f"{'batch':>6}{'batches':>9}{'seconds':>9}{'prompts/s':>11}{'tokens/s':>10}{'prompt tokens/s':>17}{'padding':>9}")
+    for batch_size in batch_sizes:
+        buckets = length_buckets([len(ids) for ids in token_ids], batch_size)
+        n_generated, n_padded = 0, 0
+        start = time.perf_counter()
+        for bucket in buckets:
+            _, lengths = generate_batch(engine, [token_ids[i] for i in bucket], max_new_tokens=max_new_tokens, do_sample=False)
+            n_generated += sum(lengths)
+            n_padded += len(bucket) * max(len(token_ids[i]) for i in bucket)
+        seconds = time.perf_counter() - start
+        n_prompt_tokens = sum(len(ids) for ids in token_ids)
+        print(f"{batch_size:>6}{len(buckets):>9}{seconds:>9.2f}{len(token_ids) / seconds:>11.2f}{n_generated / seconds:>10.1f}"
+              f"{n_prompt_tokens / seconds:>17.0f}{1 - n_prompt_tokens / n_padded:>9.1%}")
+
+if __name__ == "__main__":
+    args = parse_bench_local_arguments().parse_args()
+    if args.data == 'aceattorney':
+        data_dir = '../data/aceattorney_data/final'
+    elif args.data == 'danganronpa':
+        data_dir = '../data/danganronpa_data/final'
+
+    model_dir = args.model or build_tiny_model(hidden_size=args.hidden_size)
+    cases = load_prompts(data_dir, args.cases, args.prompt, args.context, args.layout)
+    print(f"{sum(len(prompts) for prompts in cases)} prompts of {len(cases)} cases")
+    if args.batch_sizes is not None:
+        bench_throughput(model_dir, cases, [int(size) for size in args.batch_sizes.split(",")], args.max_new_tokens, args.device)
+        sys.exit()
+    bench_prefix_cache(model_dir, cases, args.max_new_tokens, args.device)
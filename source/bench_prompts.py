@@ -0,0 +1,192 @@
+import argparse
+import os
+import re
+import sys
+import time
+import tracemalloc
+
+from run_models import parse_json, load_case, build_prompt_prefix_suffix
+
+# Benchmark prompt construction for the whole dataset under every prompt/context/description setting,
+# comparing the per-case cached fragments of prompt_compiler.py (load_case(...).build(...), as runs
+# build their prompts) with the string concatenation builder they replaced
+
+def parse_bench_arguments():
+    parser = argparse.ArgumentParser(description='Time prompt construction over a whole dataset')
+    parser.add_argument('-m', '--model', type=str, default='deepseek-reasoner', help='model name, only used for context truncation')
+    parser.add_argument('--data', type=str, default='aceattorney', help='dataset name, aceattorney or danganronpa')
+    parser.add_argument('--repeat', type=int, default=3, help='number of timed repetitions, the best one is reported')
+    parser.add_argument('--longest', type=int, default=None, help='If set, only time and trace memory of --context full on the N cases with the longest story')
+    parser.add_argument('-p', '--prompt', type=str, default='base', help='prompt name used with --longest')
+    return parser
+
+# Baseline: the builder from before prompt_compiler.py, which formats every fragment again for every turn
+
+def baseline_truncate_context(context, MODEL):
+    context_size = len(context)  # Count characters, not tokens
+
+    # Truncate context for specific models
+    max_context_size = -1
+    if "deepseek" in MODEL or "deepseek-chat" in MODEL:  # Roughly 66000 tokens for deepseek
+        max_context_size = 230000
+    if max_context_size != -1:
+        start_idx = context_size - max_context_size
+        context = "..." + context[start_idx:]
+
+    return context
+
+def baseline_build_prompt(turns, prev_context, PROMPT_PREFIX, PROMPT_SUFFIX, CONTEXT, NO_DESCRIPTION, MODEL):
+    prompts = []
+    context_sofar = ""
+    for turn in turns:
+        context_is_added = False
+        new_context = turn['newContext']
+        new_context = re.sub(r'\n+', ' ', new_context)  # Remove newlines
+        context_sofar += new_context
+        if CONTEXT is None:
+            prompt = ""
+        else:
+            prompt = "Story:\n"
+            full_context = ""
+            if CONTEXT == "full":
+                full_context += prev_context + "\n" + context_sofar + "\n"
+            elif CONTEXT == "sum":
+                full_context += turn['summarizedContext'] + "\n"
+
+            full_context = baseline_truncate_context(full_context, MODEL)
+
+            prompt += full_context
+
+        character_counter = 0
+        prompt += "Characters:\n"
+        for character in turn['characters']:
+            prompt += f"Character {character_counter}\n"
+            prompt += f"Name: {character['name']}\n"
+            if not NO_DESCRIPTION:
+                prompt += f"Description: {character['description1']}\n"
+            character_counter += 1
+
+        # Format evidences
+        evidence_counter = 0
+        evidences = []
+        for evidence in turn['evidences']:
+            evidence_string = f"Evidence {evidence_counter}\n"
+            evidence_string += f"Name: {evidence['name']}\n"
+            if not NO_DESCRIPTION:
+                evidence_string += f"Description: "
+                descriptions = []
+                for key in evidence.keys():
+                    if 'description' in key:
+                        descriptions.append(evidence[key])
+                evidence_string += " ".join(descriptions) + "\n"
+            evidences.append(evidence_string)
+            evidence_counter += 1
+
+        # Format testimonies
+        testimony_counter = 0
+        testimonies = []
+        for testimony in turn['testimonies']:
+            testimony_string = f"Testimony {testimony_counter}\n"
+            testimony_string += f"Testimony: {testimony['testimony']}\n"
+            testimony_string += f"Person: {testimony['person']}\n"
+            # Provide context if needed
+            if "source" in testimony and \
+                testimony["source"].get("is_self_contained", "yes") == "no" and \
+                CONTEXT is None:
+                context_span = testimony["source"]["context_span"]
+                if not context_is_added and not NO_DESCRIPTION:
+                    for i, evidence_string in enumerate(evidences):
+                        evidence_spans = testimony["source"]["evidence_span"]
+                        if isinstance(evidence_spans, str):
+                            evidence_spans = [evidence_spans]
+                        for evidence_span in evidence_spans:
+                            if evidence_span in evidence_string: # Find evidence
+                                evidences[i] += f"{context_span}\n"  # Add context span
+                    context_is_added = True
+            testimony_counter += 1
+            testimonies.append(testimony_string)
+
+        # Build rest of the prompt
+        prompt += f"Evidences:\n{''.join(evidences)}\nTestimonies:\n{''.join(testimonies)}\n"
+        prompts.append(PROMPT_PREFIX + prompt + PROMPT_SUFFIX)
+    return prompts
+
+# Timing
+
+def best_time(fn, repeat):
+    """Best wall time of repeat calls of fn(), and its last result"""
+    best, result = float("inf"), None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+def bench_setting(cases, prompt, context, no_description, model, repeat):
+    """Time both builders on every case. Return their times, the prompts, their size, and whether the prompts match"""
+    prompt_prefix, prompt_suffix = build_prompt_prefix_suffix(prompt)
+    baseline_seconds, baseline_prompts = best_time(lambda: [
+        baseline_build_prompt(turns, prev_context, prompt_prefix, prompt_suffix, context, no_description, model)
+        for _, (turns, prev_context) in cases
+    ], repeat)
+    cached_seconds, cached_prompts = best_time(lambda: [
+        load_case(path).build(prompt_prefix, prompt_suffix, context, no_description, model) for path, _ in cases
+    ], repeat)
+    n_prompts = sum(len(prompts) for prompts in cached_prompts)
+    n_chars = sum(len(p) for prompts in cached_prompts for p in prompts)
+    return baseline_seconds, cached_seconds, n_prompts, n_chars, baseline_prompts == cached_prompts
+
+def bench_longest(cases, n, prompt, model, repeat):
+    """Time and peak traced memory of full-context prompt construction by both builders on the n longest cases"""
+    def story_length(case):
+        turns, prev_context = case[1]
+        return len(prev_context) + sum(len(turn['newContext']) for turn in turns)
+
+    prompt_prefix, prompt_suffix = build_prompt_prefix_suffix(prompt)
+    builders = [
+        ("baseline", lambda path, turns, prev_context: baseline_build_prompt(turns, prev_context, prompt_prefix, prompt_suffix, "full", False, model)),
+        ("cached", lambda path, turns, prev_context: load_case(path).build(prompt_prefix, prompt_suffix, "full", False, model))
+    ]
+    print(f"{'story KB':>9}{'turns':>7}{'builder':>10}{'seconds':>9}{'output MB':>11}{'peak MB':>9}")
+    for case in sorted(cases, key=story_length)[-n:]:
+        path, (turns, prev_context) = case
+        for name, build in builders:
+            best, _ = best_time(lambda: build(path, turns, prev_context), repeat)
+            tracemalloc.start()
+            prompts = build(path, turns, prev_context)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            output_size = sum(sys.getsizeof(p) for p in prompts)
+            print(f"{story_length(case) / 1e3:>9.0f}{len(turns):>7}{name:>10}{best:>9.4f}{output_size / 1e6:>11.2f}{peak / 1e6:>9.2f}")
+
+if __name__ == "__main__":
+    args = parse_bench_arguments().parse_args()
+    if args.data == 'aceattorney':
+        data_dir = '../data/aceattorney_data/final'
+    elif args.data == 'danganronpa':
+        data_dir = '../data/danganronpa_data/final'
+
+    start = time.perf_counter()
+    fnames = sorted(fname for fname in os.listdir(data_dir) if fname.endswith('.json'))
+    cases = [(os.path.join(data_dir, fname), parse_json(os.path.join(data_dir, fname))) for fname in fnames]
+    cases = [(path, case) for path, case in cases if case[0]]
+    for path, _ in cases:
+        load_case(path)  # Parsed once for both builders, outside the timed region
+    print(f"Parsed {len(cases)} cases in {time.perf_counter() - start:.3f}s")
+
+    if args.longest is not None:
+        bench_longest(cases, args.longest, args.prompt, args.model, args.repeat)
+        sys.exit()
+
+    prompts = sorted(fname[:-len('.json')] for fname in os.listdir('prompts') if fname.endswith('.json'))
+    print(f"{'prompt':<16}{'context':<9}{'no_desc':<9}{'baseline':>9}{'cached':>9}{'speedup':>9}{'prompts':>9}{'MB':>9}{'same':>6}")
+    total_baseline, total_cached = 0, 0
+    for prompt in prompts:
+        for context in [None, "full", "sum"]:
+            for no_description in [False, True]:
+                baseline, cached, n_prompts, n_chars, same = bench_setting(cases, prompt, context, no_description, args.model, args.repeat)
+                total_baseline += baseline
+                total_cached += cached
+                print(f"{prompt:<16}{str(context):<9}{str(no_description):<9}{baseline:>9.3f}{cached:>9.3f}{baseline / cached:>8.1f}x"
+                      f"{n_prompts:>9}{n_chars / 1e6:>9.1f}{str(same):>6}")
+    print(f"Total: {total_baseline:.3f}s baseline, {total_cached:.3f}s cached ({total_baseline / total_cached:.1f}x)")
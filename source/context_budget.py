@@ -0,0 +1,102 @@
+import functools
+import json
+import math
+import os
+
+SOURCE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Tokens kept free for the chat template, the system message and tokenizer boundary effects
+SAFETY_MARGIN = 256
+
+class ApproxTokenizer:
+    """Fallback when no tokenizer can be loaded: ~4 ascii characters per token, 1 token per other character"""
+    def count(self, text):
+        n_ascii = len(text.encode("ascii", "ignore"))
+        return math.ceil(n_ascii / 4) + (len(text) - n_ascii)
+
+class TiktokenTokenizer:
+    def __init__(self, encoding):
+        self.encoding = encoding
+
+    def count(self, text):
+        return len(self.encoding.encode(text, disallowed_special=()))
+
+class HuggingFaceTokenizer:
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+
+    def count(self, text):
+        return len(self.tokenizer.encode(text, add_special_tokens=False))
+
+@functools.lru_cache(maxsize=None)
+def get_tokenizer(name):
+    """Load a tokenizer once per process: a tiktoken encoding name or a Hugging Face model id"""
+    try:
+        if "/" not in name:
+            import tiktoken
+            return TiktokenTokenizer(tiktoken.get_encoding(name))
+        from transformers import AutoTokenizer
+        return HuggingFaceTokenizer(AutoTokenizer.from_pretrained(name))
+    except Exception as e:
+        print(f"<get_tokenizer> Could not load tokenizer {name} ({type(e).__name__}), approximating token counts")
+        return ApproxTokenizer()
+
+class ContextBudget:
+    """
+    Token budget of a model: the prompt may use the context window minus the tokens
+    reserved for the completion
+    """
+    def __init__(self, model, context_window, max_completion_tokens, tokenizer):
+        self.model = model
+        self.context_window = context_window
+        self.max_completion_tokens = max_completion_tokens
+        self.tokenizer_name = tokenizer
+
+    @property
+    def max_prompt_tokens(self):
+        return self.context_window - self.max_completion_tokens - SAFETY_MARGIN
+
+    def count(self, text):
+        return get_tokenizer(self.tokenizer_name).count(text)
+
+    def fit_tail(self, segments, max_tokens, counts=None, marker="..."):
+        """
+        Return the longest suffix of the concatenated segments that fits in max_tokens, as a list
+        of pieces. If anything is cut, `marker` is prepended. `counts` are the token counts of
+        the segments, if already known.
+        """
+        if counts is None:
+            counts = [self.count(segment) for segment in segments]
+        if sum(counts) <= max_tokens:
+            return list(segments)
+        max_tokens -= self.count(marker)
+        kept = 0
+        k = len(segments)
+        while k > 0 and kept + counts[k - 1] <= max_tokens:
+            kept += counts[k - 1]
+            k -= 1
+        if k == 0 or max_tokens <= kept:
+            return [marker] + list(segments[k:])
+        # Binary search the start of the partial segment
+        segment = segments[k - 1]
+        lo, hi = 0, len(segment)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.count(segment[mid:]) + kept <= max_tokens:
+                hi = mid
+            else:
+                lo = mid + 1
+        return [marker, segment[lo:]] + list(segments[k:])
+
+@functools.lru_cache(maxsize=None)
+def get_context_budget(model, config_path=os.path.join(SOURCE_DIR, "context_windows.json")):
+    """Return the ContextBudget of a model from context_windows.json, or None if its window is unknown"""
+    with open(config_path, "r") as file:
+        config = json.load(file)
+    if model not in config:  # Also accept the full names from models.json
+        with open(os.path.join(os.path.dirname(config_path), "models.json"), "r") as file:
+            aliases = {full_name: alias for alias, full_name in json.load(file).items()}
+        model = aliases.get(model, model)
+    if model not in config:
+        return None
+    return ContextBudget(model, **config[model])
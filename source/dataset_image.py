@@ -0,0 +1,198 @@
+import argparse
+import functools
+import hashlib
+import json
+import mmap
+import os
+
+# Packed image of a dataset dir: every case's json without its story contexts, followed by the
+# contexts themselves, in one memory-mapped blob. index.json holds the offsets of each case.
+# Cases are decoded one at a time when read, and their contexts only when asked for.
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+IMAGE_ROOT = os.path.join(REPO_DIR, "cache", "datasets")
+IMAGE_VERSION = 1
+
+# Large story fields moved out of the case metadata into the text section of the blob
+TEXT_FIELDS = ("previousContext", "newContext")
+
+def list_case_files(data_dir):
+    return sorted(fname for fname in os.listdir(data_dir) if fname.endswith('.json'))
+
+def get_fingerprint(data_dir):
+    """Cheap change check: name, size and modification time of every case file"""
+    fingerprint = []
+    for fname in list_case_files(data_dir):
+        stat = os.stat(os.path.join(data_dir, fname))
+        fingerprint.append([fname, stat.st_size, stat.st_mtime_ns])
+    return fingerprint
+
+def get_content_hash(data_dir):
+    sha = hashlib.sha256()
+    for fname in list_case_files(data_dir):
+        sha.update(fname.encode("utf-8") + b"\0")
+        with open(os.path.join(data_dir, fname), "rb") as file:
+            sha.update(file.read())
+        sha.update(b"\0")
+    return sha.hexdigest()
+
+def get_image_dir(data_dir):
+    """e.g. ../data/aceattorney_data/final -> <repo>/cache/datasets/aceattorney_data_final"""
+    data_dir = os.path.abspath(data_dir)
+    name = os.path.relpath(data_dir, os.path.join(REPO_DIR, "data")) \
+        if data_dir.startswith(os.path.join(REPO_DIR, "data") + os.sep) else data_dir.strip(os.sep)
+    return os.path.join(IMAGE_ROOT, name.replace(os.sep, "_"))
+
+def extract_texts(obj, texts):
+    """Replace the TEXT_FIELDS strings of a case by {"$text": i} and append them to texts"""
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            if key in TEXT_FIELDS and isinstance(value, str):
+                obj[key] = {"$text": len(texts)}
+                texts.append(value)
+            else:
+                extract_texts(value, texts)
+    elif isinstance(obj, list):
+        for value in obj:
+            extract_texts(value, texts)
+
+def resolve_texts(obj, get_text):
+    """Inverse of extract_texts. With get_text=None, the text fields are dropped"""
+    if isinstance(obj, dict):
+        for key in [key for key in obj if key in TEXT_FIELDS]:
+            if isinstance(obj[key], dict) and "$text" in obj[key]:
+                if get_text is None:
+                    del obj[key]
+                else:
+                    obj[key] = get_text(obj[key]["$text"])
+        for value in obj.values():
+            resolve_texts(value, get_text)
+    elif isinstance(obj, list):
+        for value in obj:
+            resolve_texts(value, get_text)
+
+def build_image(data_dir, image_dir, content_hash):
+    """Write <image_dir>/dataset_<hash>.bin, then the index.json pointing at it"""
+    os.makedirs(image_dir, exist_ok=True)
+    blob_name = f"dataset_{content_hash[:16]}.bin"
+    blob_path = os.path.join(image_dir, blob_name)
+    tmp_path = f"{blob_path}.{os.getpid()}.tmp"
+    cases = {}
+    offset = 0
+    with open(tmp_path, "wb") as blob:
+        def write(data):
+            nonlocal offset
+            blob.write(data)
+            start, offset = offset, offset + len(data)
+            return [start, len(data)]
+
+        for fname in list_case_files(data_dir):
+            with open(os.path.join(data_dir, fname), "r") as file:
+                data = json.load(file)
+            texts = []
+            extract_texts(data, texts)
+            cases[fname] = {
+                "meta": write(json.dumps(data, ensure_ascii=False).encode("utf-8")),
+                "texts": [write(text.encode("utf-8")) + [len(text)] for text in texts]
+            }
+    os.replace(tmp_path, blob_path)
+
+    index = {
+        "version": IMAGE_VERSION,
+        "data_dir": os.path.abspath(data_dir),
+        "content_hash": content_hash,
+        "fingerprint": get_fingerprint(data_dir),
+        "blob": blob_name,
+        "cases": cases
+    }
+    write_index(image_dir, index)
+    for fname in os.listdir(image_dir):  # Older blobs, still readable by processes that mapped them
+        if fname.startswith("dataset_") and fname.endswith(".bin") and fname != blob_name:
+            os.remove(os.path.join(image_dir, fname))
+    print(f"<build_image> Packed {len(cases)} cases of {data_dir} into {offset / 1024 ** 2:.1f} MB")
+    return index
+
+def write_index(image_dir, index):
+    index_path = os.path.join(image_dir, "index.json")
+    tmp_path = f"{index_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as file:
+        json.dump(index, file)
+    os.replace(tmp_path, index_path)
+
+def load_index(data_dir, image_dir, force=False):
+    """Return the index of an up-to-date image of data_dir, rebuilding it if the dataset changed"""
+    index_path = os.path.join(image_dir, "index.json")
+    index = None
+    if os.path.exists(index_path) and not force:
+        with open(index_path, "r") as file:
+            index = json.load(file)
+        if index.get("version") != IMAGE_VERSION or \
+            not os.path.exists(os.path.join(image_dir, index["blob"])):
+            index = None
+    fingerprint = get_fingerprint(data_dir)
+    if index is not None and index["fingerprint"] == fingerprint:
+        return index
+    content_hash = get_content_hash(data_dir)
+    if index is not None and index["content_hash"] == content_hash:  # Only touched, not changed
+        index["fingerprint"] = fingerprint
+        write_index(image_dir, index)
+        return index
+    return build_image(data_dir, image_dir, content_hash)
+
+class DatasetImage:
+    def __init__(self, data_dir, force=False):
+        self.data_dir = data_dir
+        self.image_dir = get_image_dir(data_dir)
+        self.index = load_index(data_dir, self.image_dir, force)
+        self.cases = self.index["cases"]
+        with open(os.path.join(self.image_dir, self.index["blob"]), "rb") as file:
+            size = os.fstat(file.fileno()).st_size
+            self.blob = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+
+    def fnames(self):
+        return list(self.cases)
+
+    def text(self, fname, i):
+        start, length, _ = self.cases[fname]["texts"][i]
+        return self.blob[start:start + length].decode("utf-8")
+
+    def text_length(self, fname, i):
+        """Length in characters of a text, without decoding it"""
+        return self.cases[fname]["texts"][i][2]
+
+    def read(self, fname, text=True):
+        """
+        Return the case as json.load would. With text=False, its story contexts are left out
+        and that part of the blob is never read.
+        """
+        if fname not in self.cases:
+            raise FileNotFoundError(f"<DatasetImage> No case {fname} in {self.data_dir}")
+        start, length = self.cases[fname]["meta"]
+        data = json.loads(self.blob[start:start + length].decode("utf-8"))
+        resolve_texts(data, (lambda i: self.text(fname, i)) if text else None)
+        return data
+
+@functools.lru_cache(maxsize=None)
+def get_dataset_image(data_dir):
+    """One image per dataset dir and process, checked against the dataset when first opened"""
+    return DatasetImage(data_dir)
+
+def read_case(file_path, text=True):
+    """Drop-in for json.load(open(file_path)) on a case file of a dataset dir"""
+    data_dir, fname = os.path.split(os.path.abspath(file_path))
+    return get_dataset_image(data_dir).read(fname, text)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Pack dataset dirs into images')
+    parser.add_argument('--data', type=str, default='all', help='aceattorney, danganronpa or all')
+    parser.add_argument('--force', action='store_true', help='rebuild even if the dataset did not change')
+    args = parser.parse_args()
+
+    data_dirs = {
+        'aceattorney': os.path.join(REPO_DIR, 'data/aceattorney_data/final'),
+        'danganronpa': os.path.join(REPO_DIR, 'data/danganronpa_data/final')
+    }
+    for name, data_dir in data_dirs.items():
+        if args.data in (name, 'all'):
+            image = DatasetImage(data_dir, force=args.force)
+            print(f"<main> {name}: {len(image.cases)} cases in {image.image_dir}")
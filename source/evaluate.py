@@ -11,7 +11,11 @@ import math
 from tqdm import tqdm
 from collections import defaultdict
 
-from run_models import get_output_dir, get_fnames, parse_arguments
+from run_models import get_output_dir, get_fnames, parse_arguments, resolve_model, \
+    load_batch_manifest, save_batch_manifest, load_completion_index, body_has_answer, BATCH_FAILED_STATUSES
+from response_cache import ResponseCache
+from dataset_image import read_case
+from output_store import read_outputs, write_outputs
 
 # Parsing functions
 
@@ -33,10 +37,9 @@ def parse_pred(caseid, output_dir):
                 print(f"{caseid} response {i}: {e}")
                 pred.append({"evidence": -1, "testimony": -1})
     # Parse reasoning
-    if os.path.exists(os.path.join(output_dir, caseid.replace(".json", "_outputs.json"))):
-        with open(os.path.join(output_dir, caseid.replace(".json", "_outputs.json")), 'r') as f:
-            output = json.load(f)
-            reasoning = [o['cot'] for o in output]  # list of strings
+    output = read_outputs(output_dir, caseid.replace(".json", ""), prompts=False)
+    if output is not None:
+        reasoning = [o['cot'] for o in output]  # list of strings
 
     if all(ans == {} for ans in pred):
         return [], []
@@ -90,20 +93,19 @@ def parse_pred_openai(caseid, input_data, output_data, output_dir):
     with open(os.path.join(output_dir, caseid.split('.')[0] + '.jsonl'), 'w') as file:
         for answer_json in pred:
             file.write(json.dumps(answer_json) + "\n")
-    with open(os.path.join(output_dir, caseid.split('.')[0] + '_outputs.json'), 'w') as file:
-        json_response = []
-        for idx, cot in enumerate(reasoning):
-            json_response.append({
-                "idx": int(ids[idx].split("_")[-1]),  # May not be idx
-                "prompt": prompts[idx],
-                "cot": cot,
-                "response_json": pred[idx]
-            })
-        json_response = sorted(
-            json_response,
-            key=lambda x: int(x["idx"])
-        )  # Sort by idx, to match the order of gold_indices
-        file.write(json.dumps(json_response, indent=2, ensure_ascii=False))
+    json_response = []
+    for idx, cot in enumerate(reasoning):
+        json_response.append({
+            "idx": int(ids[idx].split("_")[-1]),  # May not be idx
+            "prompt": prompts[idx],
+            "cot": cot,
+            "response_json": pred[idx]
+        })
+    json_response = sorted(
+        json_response,
+        key=lambda x: int(x["idx"])
+    )  # Sort by idx, to match the order of gold_indices
+    write_outputs(output_dir, caseid.split('.')[0], json_response)
     
     return pred, reasoning
 
@@ -117,9 +119,8 @@ def parse_gold(caseid, data_dir):
         "turns": []
     }
     try:
-        with open(os.path.join(data_dir, caseid), 'r') as f:
-            data = json.load(f)
-            evidences = [evidence['name'] for evidence in data.get('evidences', [])]
+        data = read_case(os.path.join(data_dir, caseid), text=False)
+        evidences = [evidence['name'] for evidence in data.get('evidences', [])]
         characters = [character['name'] for character in data.get('characters', [])]
         # Parse evidence metadata
         n_evidences = len(evidences)
@@ -166,26 +167,25 @@ def init_correct(data_dir, output_dir):
     caseids = get_fnames(data_dir, output_dir, "ALL", eval=True, verbose=False)
 
     for caseid in caseids:
-        with open(os.path.join(data_dir, caseid), 'r') as f:
-            data = json.load(f)
-            if "turns" not in data or data['turns'] == []:  # Skip if no turns
+        data = read_case(os.path.join(data_dir, caseid), text=False)
+        if "turns" not in data or data['turns'] == []:  # Skip if no turns
+            continue
+        n_evidences = len(data['evidences'])
+        for turn in data['turns']:
+            if turn["noPresent"]:
                 continue
-            n_evidences = len(data['evidences'])
-            for turn in data['turns']:
-                if turn["noPresent"]:
-                    continue
-                n_testimonies = len(turn['testimonies'])
-                if "labels" in turn:
-                    for label in turn['labels']:
-                        if label:
-                            categories.append(label)
-                if "reasoning" in turn:
-                    len_of_reasoning = len(turn['reasoning'])
-                    if len_of_reasoning > 0:
-                        reasoning_steps.append(len_of_reasoning)
-                n_action_space = n_evidences * n_testimonies
-                # Contain duplicates to count occurrences
-                action_space_sizes.append(n_action_space)  
+            n_testimonies = len(turn['testimonies'])
+            if "labels" in turn:
+                for label in turn['labels']:
+                    if label:
+                        categories.append(label)
+            if "reasoning" in turn:
+                len_of_reasoning = len(turn['reasoning'])
+                if len_of_reasoning > 0:
+                    reasoning_steps.append(len_of_reasoning)
+            n_action_space = n_evidences * n_testimonies
+            # Contain duplicates to count occurrences
+            action_space_sizes.append(n_action_space)  
 
     categories = list(set(categories))
     reasoning_steps = list(set(reasoning_steps))
@@ -563,37 +563,42 @@ def run_eval_job(caseids, output_dir, data_dir, client):
         golds_metadata
     )
 
-def check_status(output_dir):
-    # Check if the result has been saved
-    has_output = True
-    duplicate_count = 1
-    result_file_name = os.path.join(output_dir, "batchoutput.jsonl")
-    input_file_name = os.path.join(output_dir, "batchinput.jsonl")
-    while os.path.exists(result_file_name) and os.path.exists(input_file_name):
-        result_file_name = os.path.join(output_dir, f"batchoutput_{duplicate_count}.jsonl")
-        input_file_name = os.path.join(output_dir, f"batchinput_{duplicate_count}.jsonl")
-        duplicate_count += 1
-    if os.path.exists(input_file_name):  # There is a standalone input file
-        has_output = False
-
-    if has_output: return True
-        
+def get_openai_client(base_url=None):
     from dotenv import load_dotenv
     load_dotenv("../.env")
     OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 
     from openai import OpenAI
-    client = OpenAI(
-        api_key=OPENAI_API_KEY
+    return OpenAI(
+        api_key=OPENAI_API_KEY,
+        base_url=base_url
     )
 
-    with open(os.path.join(output_dir, "batch_api_metadata.json"), "r") as file:
-        data = json.load(file)
-    batch_job_id = data["batch_job_id"]
-
-    batch_job = client.batches.retrieve(batch_job_id)
+def download_file(client, file_id, path, chunk_size=1024 ** 2):
+    """
+    Stream a file of the files API to disk chunk by chunk. The file only appears under its name
+    once complete, so a partial download never looks like a finished shard.
+    """
+    tmp_path = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.part")
+    with client.files.with_streaming_response.content(file_id) as response:
+        with open(tmp_path, 'wb') as file:
+            for chunk in response.iter_bytes(chunk_size):
+                file.write(chunk)
+    os.replace(tmp_path, path)
+
+def get_pending_shards(output_dir, shards):
+    return [
+        shard for shard in shards 
+        if shard.get("status") not in BATCH_FAILED_STATUSES 
+        and not os.path.exists(os.path.join(output_dir, shard["output_file"]))
+    ]
+
+def poll_shard(client, output_dir, shard, model):
+    """Refresh the status of a batch shard and download its results once completed. Return the status"""
+    batch_job = client.batches.retrieve(shard["batch_job_id"])
     status = batch_job.status
-    print(f"Status: {status}")
+    shard["status"] = status
+    print(f"{shard['input_file']} status: {status}")
         
     if status == "completed":
         result_file_id = batch_job.output_file_id
@@ -603,14 +608,41 @@ def check_status(output_dir):
             print("Error file created")
             result_file_id = batch_job.error_file_id
         
-        result = client.files.content(result_file_id).content
+        result_file_name = os.path.join(output_dir, shard["output_file"])
+        download_file(client, result_file_id, result_file_name)
+
+        # Make the downloaded responses available to later runs
+        n_cached = ResponseCache().store_batch_results(
+            [os.path.join(output_dir, shard["input_file"])], result_file_name, model, is_valid=body_has_answer
+        )
+        print(f"<poll_shard> Cached {n_cached} responses")
+
+    elif status in BATCH_FAILED_STATUSES:
+        print(f"<poll_shard> {shard['batch_job_id']} {status}, its requests will be resubmitted by the next run")
+
+    return status
 
-        with open(result_file_name, 'wb') as file:
-            file.write(result)
+def check_status(output_dir, client=None):
+    """Download the results of finished batch shards. Return True once no shard is still running"""
+    shards = load_batch_manifest(output_dir)
+    pending = get_pending_shards(output_dir, shards)
+    if not pending: return True
 
-        return True
+    if client is None:
+        client = get_openai_client()
 
-    return False
+    with open(os.path.join(output_dir, "metadata.json"), "r") as file:
+        model = resolve_model(json.load(file)["model"])
+
+    all_done = True
+    for shard in pending:
+        status = poll_shard(client, output_dir, shard, model)
+        if status != "completed" and status not in BATCH_FAILED_STATUSES:
+            all_done = False
+
+    save_batch_manifest(output_dir, shards)
+    load_completion_index(output_dir)  # Index the new output files
+    return all_done
 
 def evaluate_single_run(output_dir, data_dir, MODEL, CASE="ALL"):
     print(f"Evaluating {MODEL} with prompt {output_dir.split('_')[2]}...")
@@ -621,14 +653,7 @@ def evaluate_single_run(output_dir, data_dir, MODEL, CASE="ALL"):
         if not check_status(output_dir):
             return
         else:
-            from dotenv import load_dotenv
-            load_dotenv("../.env")
-            OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-
-            from openai import OpenAI
-            client = OpenAI(
-                api_key=OPENAI_API_KEY
-            )
+            client = get_openai_client()
 
     run_eval_job(
         caseids, 
@@ -666,6 +691,7 @@ def find_output_dir(args):
     CONTEXT = args.context if args.context else None
     NO_DESCRIPTION = args.no_description
     DATA = args.data
+    LAYOUT = args.layout
 
     output_dir = get_output_dir(
         MODEL, 
@@ -673,7 +699,8 @@ def find_output_dir(args):
         CONTEXT, 
         CASE, 
         NO_DESCRIPTION,
-        DATA
+        DATA,
+        LAYOUT
     ) 
     if not os.path.exists(output_dir):
         raise ValueError(f"Output directory {output_dir} does not exist")
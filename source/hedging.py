@@ -0,0 +1,226 @@
+import asyncio
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, FIRST_COMPLETED, TimeoutError as FutureTimeoutError, wait
+
+from run_metrics import percentile
+
+# Per-request deadlines and hedged requests, against the slow tail of reasoning models. A request
+# that misses its deadline raises TimeoutError, which the RateController retries like any timeout.
+# With hedging, a turn still unanswered after the p95 latency observed for its model is sent a
+# second time, and the first valid answer is kept. Run with --timeout and --hedge.
+
+LATENCY_WINDOW = 500  # Latest request latencies the hedge delay is computed over
+MIN_HEDGE_SAMPLES = 20  # No hedging before this many latencies, the p95 of fewer is noise
+MIN_HEDGE_DELAY = 1.0
+
+def run_in_thread(fn):
+    """
+    Start fn() in a daemon thread and return a Future of its result. Sync requests cannot be
+    stopped, so one that is given up on runs on in its thread without holding up the exit.
+    """
+    future = Future()
+    def target():
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(fn())
+        except BaseException as e:
+            future.set_exception(e)
+    threading.Thread(target=target, daemon=True).start()
+    return future
+
+class Hedger:
+    """
+    Per-model deadlines and hedging. Keeps the latencies of the latest requests; a turn is hedged
+    once its request has run for their `quantile`, and first requests cancelled by a winning hedge
+    count with the time they ran, so that hedging does not pull the delay down.
+    """
+    def __init__(self, name, timeout=None, hedge=False, quantile=0.95, min_samples=MIN_HEDGE_SAMPLES, min_delay=MIN_HEDGE_DELAY):
+        self.name = name
+        self.timeout = timeout  # Seconds per request, None for no deadline
+        self.hedge = hedge
+        self.quantile = quantile
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.stats = {"turns": 0, "hedged": 0, "hedge_wins": 0, "timeouts": 0}
+        self._lock = threading.Lock()
+
+    def observe(self, latency):
+        with self._lock:
+            self.latencies.append(latency)
+
+    def seed(self, records):
+        """Observe the latencies of earlier requests of the model, as in metrics.jsonl"""
+        for record in records:
+            # The first request of a hedged turn ran for at least the turn, and the kept one may be the hedge
+            latency = record.get("turn_latency") if record.get("hedged") else record.get("latency")
+            if record.get("model") == self.name and latency is not None:
+                self.observe(latency)
+
+    def delay(self):
+        """Seconds before a turn is hedged, or None while there are too few latencies to tell"""
+        with self._lock:
+            if len(self.latencies) < self.min_samples:
+                return None
+            return max(self.min_delay, percentile(self.latencies, self.quantile))
+
+    def summary(self):
+        delay = self.delay()
+        return {
+            "model": self.name,
+            "timeout": self.timeout,
+            "hedge_delay": None if delay is None else round(delay, 2),
+            **self.stats,
+            "hedge_rate": round(self.stats["hedged"] / self.stats["turns"], 3) if self.stats["turns"] else None,
+            "hedge_win_rate": round(self.stats["hedge_wins"] / self.stats["hedged"], 3) if self.stats["hedged"] else None
+        }
+
+    def _expired(self):
+        with self._lock:
+            self.stats["timeouts"] += 1
+        return TimeoutError(f"<Hedger> {self.name}: no response within the {self.timeout}s deadline")
+
+    @staticmethod
+    def _elapsed(timer, start):
+        """Seconds since the request of an attempt was sent, or since the turn started if it was not yet"""
+        return time.perf_counter() - timer.get("start", start)
+
+    @staticmethod
+    def _remaining(timer, delay):
+        """Seconds until an attempt is due a hedge, counted from when its request is sent"""
+        if "start" not in timer:  # Still waiting on the rate controller
+            return delay
+        return timer["start"] + delay - time.perf_counter()
+
+    def _hedged(self):
+        with self._lock:
+            self.stats["hedged"] += 1
+        return True
+
+    def _finish(self, info, start, winner_is_hedge, primary_done, primary_timer):
+        """Record a finished turn and return its hedge metrics"""
+        with self._lock:
+            self.stats["turns"] += 1
+            self.stats["hedge_wins"] += winner_is_hedge
+        if not primary_done:  # Cancelled, so it would have taken at least this long
+            self.observe(self._elapsed(primary_timer, start))
+        return {**info, "hedge_won": winner_is_hedge, "turn_latency": time.perf_counter() - start}
+
+    # Sync calls
+
+    def call(self, request_fn, controller=None):
+        """
+        Run `request_fn()`, raising TimeoutError if it has not returned by the deadline. A request
+        given up on keeps a slot of the rate controller until it finishes.
+        """
+        if self.timeout is None:
+            return request_fn()
+        future = run_in_thread(request_fn)
+        try:
+            return future.result(self.timeout)
+        except FutureTimeoutError:
+            if future.done():  # The request itself timed out
+                raise
+            if controller is not None:
+                controller.hold(future)
+            raise self._expired() from None
+
+    def run(self, attempt_fn, is_valid):
+        """
+        Return the result of `attempt_fn(timer)` and its hedge metrics. The attempt sets timer["start"]
+        when its request is sent, rate limit waits aside. With hedging, a second attempt is started
+        once the first request has run for the hedge delay, and the first valid result is kept. The
+        other attempt cannot be stopped and is left to finish in its thread.
+        """
+        if not self.hedge:
+            return attempt_fn({}), {}
+        start = time.perf_counter()
+        delay = self.delay()
+        timers = [{}, {}]
+        attempts = [run_in_thread(lambda: attempt_fn(timers[0]))]
+        info = {"hedged": False}
+        while delay is not None:
+            remaining = self._remaining(timers[0], delay)
+            if remaining <= 0:
+                attempts.append(run_in_thread(lambda: attempt_fn(timers[1])))
+                info["hedged"] = self._hedged()
+                break
+            if wait(attempts, timeout=remaining).done:
+                break
+        pending, fallback, error = set(attempts), None, None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in sorted(done, key=attempts.index):
+                if future is attempts[0]:
+                    self.observe(self._elapsed(timers[0], start))
+                if future.exception() is not None:
+                    error = error or future.exception()
+                    continue
+                if is_valid(future.result()):
+                    for other in pending:
+                        other.cancel()
+                    return future.result(), self._finish(info, start, future is not attempts[0], attempts[0].done(), timers[0])
+                fallback = fallback or (future.result(),)
+        if fallback is None:
+            raise error
+        return fallback[0], self._finish(info, start, False, True, timers[0])
+
+    # Async calls
+
+    async def acall(self, request_fn):
+        """Await `request_fn()`, raising TimeoutError if it has not returned by the deadline"""
+        if self.timeout is None:
+            return await request_fn()
+        try:
+            return await asyncio.wait_for(request_fn(), self.timeout)
+        except asyncio.TimeoutError:
+            raise self._expired() from None
+
+    async def arun(self, attempt_fn, is_valid):
+        """Same as run, but the attempt that loses is cancelled"""
+        if not self.hedge:
+            return await attempt_fn({}), {}
+        start = time.perf_counter()
+        delay = self.delay()
+        timers = [{}, {}]
+        attempts = [asyncio.ensure_future(attempt_fn(timers[0]))]
+        info = {"hedged": False}
+        pending, fallback, error = set(attempts), None, None
+        try:
+            while delay is not None:
+                remaining = self._remaining(timers[0], delay)
+                if remaining <= 0:
+                    attempts.append(asyncio.ensure_future(attempt_fn(timers[1])))
+                    pending.add(attempts[-1])
+                    info["hedged"] = self._hedged()
+                    break
+                if (await asyncio.wait(attempts, timeout=remaining))[0]:
+                    break
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in sorted(done, key=attempts.index):
+                    if task is attempts[0]:
+                        self.observe(self._elapsed(timers[0], start))
+                    if task.exception() is not None:
+                        error = error or task.exception()
+                        continue
+                    if is_valid(task.result()):
+                        return task.result(), self._finish(info, start, task is not attempts[0], attempts[0].done(), timers[0])
+                    fallback = fallback or (task.result(),)
+        finally:
+            for task in pending:
+                task.cancel()
+        if fallback is None:
+            raise error
+        return fallback[0], self._finish(info, start, False, True, timers[0])
+
+HEDGERS = {}
+
+def get_hedger(model, **kwargs):
+    """Return the shared hedger of a model, creating it with `kwargs` the first time"""
+    if model not in HEDGERS:
+        HEDGERS[model] = Hedger(model, **kwargs)
+    return HEDGERS[model]
@@ -0,0 +1,174 @@
+import torch
+from kani.engines.huggingface import HuggingEngine
+
+# Hugging Face engine for kani that keeps the KV cache of the prompts it has seen. The turns of a
+# case share the prompt prefix, characters and evidences, and with --context full the story so far,
+# so each prompt only prefills the tokens after its longest common prefix with a cached prompt.
+# Prompts of different cases still share the chat template and the prompt prefix.
+
+PREFILL_CHUNK = 2048  # Tokens per forward pass when prefilling, to bound activation memory on long stories
+
+def crop(cache, length):
+    """Keep the first `length` tokens of a cache"""
+    extra = cache.get_seq_length() - length
+    if extra > 0:
+        cache.crop(-extra)
+
+def common_prefix_length(a, b):
+    n = min(len(a), len(b))
+    for i in range(n):
+        if a[i] != b[i]:
+            return i
+    return n
+
+class CacheEntry:
+    def __init__(self):
+        self.tokens = []  # Token ids the cache holds the keys and values of
+        self.cache = None
+
+class PrefixCache:
+    """
+    KV caches of the last `max_entries` prompts. A new prompt takes over the entry it shares the
+    longest prefix with: the entry is cropped to that prefix and extended with the rest of the prompt.
+    With one entry, consecutive prompts still reuse whatever prefix they share.
+    """
+    def __init__(self, max_entries=1):
+        self.max_entries = max_entries
+        self.entries = []  # Least recently used first
+        self.active = None
+        self.last = {"cached_tokens": 0, "prefill_tokens": 0}
+        self.cached_tokens = 0
+        self.prefill_tokens = 0
+
+    def prefill(self, model, input_ids):
+        """Return a cache holding every prompt token but the last one, which generate() processes itself"""
+        ids = input_ids[0].tolist()[:-1]
+        entry, common = None, 0
+        for candidate in self.entries:
+            n = common_prefix_length(candidate.tokens, ids)
+            if n > common:
+                entry, common = candidate, n
+        if entry is not None and getattr(entry.cache, "is_croppable", True):
+            self.entries.remove(entry)
+            crop(entry.cache, common)
+        else:
+            if len(self.entries) >= self.max_entries:
+                self.entries.pop(0)  # Free the least recently used cache before allocating a new one
+            entry, common = CacheEntry(), 0
+        self.entries.append(entry)
+
+        with torch.no_grad():
+            for start in range(common, len(ids), PREFILL_CHUNK):
+                output = model(input_ids[:, start:min(start + PREFILL_CHUNK, len(ids))], past_key_values=entry.cache, use_cache=True)
+                entry.cache = output.past_key_values
+        entry.tokens = ids
+        self.active = entry
+        self.last = {"cached_tokens": common, "prefill_tokens": len(ids) - common}
+        self.cached_tokens += common
+        self.prefill_tokens += len(ids) - common
+        return entry.cache
+
+    def release(self):
+        """Drop the generated tokens that generate() appended to the cache of the last prompt"""
+        if self.active is not None and self.active.cache is not None:
+            crop(self.active.cache, len(self.active.tokens))
+        self.active = None
+
+    def clear(self):
+        self.entries = []
+        self.active = None
+
+    def summary(self):
+        total = self.cached_tokens + self.prefill_tokens
+        return {
+            "cached_tokens": self.cached_tokens,
+            "prefill_tokens": self.prefill_tokens,
+            "hit_rate": round(self.cached_tokens / total, 3) if total else None
+        }
+
+class PrefixCachingEngine(HuggingEngine):
+    def __init__(self, *args, max_cache_entries=1, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prefix_cache = PrefixCache(max_cache_entries)
+
+    async def prompt_len(self, messages, functions=None, **kwargs):
+        # Measuring a prompt must not prefill it
+        prompt = self.build_prompt(messages, functions)
+        _, input_len, _ = super()._get_generate_args(prompt, **kwargs)
+        return input_len
+
+    def _get_generate_args(self, prompt, **hyperparams):
+        input_kwargs, input_len, hyperparams = super()._get_generate_args(prompt, **hyperparams)
+        if input_len > 1 and "past_key_values" not in hyperparams:
+            hyperparams["past_key_values"] = self.prefix_cache.prefill(self.model, input_kwargs["input_ids"])
+        return input_kwargs, input_len, hyperparams
+
+    async def predict(self, messages, functions=None, **hyperparams):
+        try:
+            return await super().predict(messages, functions, **hyperparams)
+        finally:
+            self.prefix_cache.release()
+
+    async def stream(self, messages, functions=None, **hyperparams):
+        try:
+            async for item in super().stream(messages, functions, **hyperparams):
+                yield item
+        finally:
+            self.prefix_cache.release()
+
+# Batched generation: turn prompts of many cases are sorted by length and cut into buckets, so that
+# the prompts generated together need little padding.
+
+def length_buckets(lengths, batch_size, max_batch_tokens=None):
+    """
+    Group item indices into batches of at most batch_size items of similar length. With
+    max_batch_tokens, a batch also stops growing once its padded size would exceed it.
+    """
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+    buckets, bucket = [], []
+    for i in order:
+        if bucket and (len(bucket) == batch_size or (
+            max_batch_tokens is not None and lengths[i] * (len(bucket) + 1) > max_batch_tokens
+        )):
+            buckets.append(bucket)
+            bucket = []
+        bucket.append(i)
+    if bucket:
+        buckets.append(bucket)
+    return buckets
+
+def tokenize_messages(engine, messages):
+    """Token ids of a list of chat messages, exactly as the engine would prompt the model with them"""
+    from kani import ChatMessage
+    kani_messages = [
+        ChatMessage.system(message["content"]) if message["role"] == "system" else
+        ChatMessage.user(message["content"]) if message["role"] == "user" else ChatMessage.assistant(message["content"])
+        for message in messages
+    ]
+    input_kwargs, _, _ = HuggingEngine._get_generate_args(engine, engine.build_prompt(kani_messages))
+    return input_kwargs["input_ids"][0].tolist()
+
+def generate_batch(engine, token_ids, stopping_criteria=None, **hyperparams):
+    """
+    Generate the answers of several tokenized prompts at once, left-padded to the longest one.
+    Return the answer texts and their number of generated tokens.
+    """
+    tokenizer = engine.tokenizer
+    pad_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else engine._get_eos_tokens(return_ids=True)[0]
+    width = max(len(ids) for ids in token_ids)
+    input_ids = torch.tensor([[pad_id] * (width - len(ids)) + ids for ids in token_ids], device=engine.device)
+    attention_mask = torch.tensor([[0] * (width - len(ids)) + [1] * len(ids) for ids in token_ids], device=engine.device)
+    hyperparams = {**engine.hyperparams, **hyperparams}
+    if "max_new_tokens" not in hyperparams:
+        hyperparams.setdefault("max_length", engine.max_context_size)
+    if stopping_criteria is not None:
+        hyperparams["stopping_criteria"] = stopping_criteria
+    with torch.no_grad():
+        output = engine.model.generate(input_ids=input_ids, attention_mask=attention_mask, pad_token_id=pad_id, **hyperparams)
+    eos_ids = set(engine._get_eos_tokens(return_ids=True))
+    texts, lengths = [], []
+    for row in output[:, width:].tolist():
+        end = next((k for k, token in enumerate(row) if token in eos_ids), len(row))
+        texts.append(tokenizer.decode(row[:end], skip_special_tokens=True).strip())
+        lengths.append(end)
+    return texts, lengths
@@ -0,0 +1,280 @@
+import argparse
+import itertools
+import json
+import random
+import threading
+import time
+from email import policy
+from email.parser import BytesParser
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Local stand-in for the OpenAI-compatible endpoints used by run_models.py and evaluate.py:
+# chat completions, files and batches. Every answer is the same canned response.
+
+CACHE_BLOCK = 256  # Characters (64 tokens at 4 characters a token) per block of the simulated prefix cache
+
+ANSWER = "The evidence contradicts the testimony.\n{\"evidence\": 0, \"testimony\": 0}"
+REASONING = "The testimony says one thing, but the evidence shows another."
+
+def parse_mock_arguments():
+    parser = argparse.ArgumentParser(description='Local stand-in for the OpenAI files, batches and chat completions endpoints')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds before each chat completion returns')
+    parser.add_argument('--latency_per_1k_tokens', type=float, default=0.0, help='extra seconds per 1000 prompt tokens, so that longer prompts take longer')
+    parser.add_argument('--slow_rate', type=float, default=0.0, help='fraction of chat completions that take --slow_latency seconds more, a slow tail to test --timeout and --hedge against')
+    parser.add_argument('--slow_latency', type=float, default=30.0, help='extra seconds of the slow chat completions')
+    parser.add_argument('--error_rate', type=float, default=0.0, help='fraction of chat completions answered with a 429')
+    parser.add_argument('--batch_delay', type=float, default=5.0, help='seconds before a batch completes')
+    parser.add_argument('--trailing', type=int, default=0, help='number of sentences the answer goes on with after its json line')
+    return parser
+
+class MockState:
+    def __init__(self, latency=0.0, error_rate=0.0, batch_delay=5.0, trailing=0, latency_per_1k_tokens=0.0, slow_rate=0.0, slow_latency=30.0):
+        self.latency = latency
+        self.latency_per_1k_tokens = latency_per_1k_tokens
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self.error_rate = error_rate
+        self.batch_delay = batch_delay
+        self.answer = ANSWER + "\n" + "This is why the testimony is wrong. " * trailing if trailing else ANSWER
+        self.files = {}
+        self.batches = {}
+        self.ids = itertools.count()
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.stats = {"requests": 0, "rate_limited": 0, "slow": 0, "max_in_flight": 0}
+        self.prefix_blocks = set()
+
+    def cached_tokens(self, text):
+        """Tokens of the longest prefix of text already sent, in whole blocks, like the DeepSeek context cache"""
+        blocks = [hash(text[:end]) for end in range(CACHE_BLOCK, len(text) + 1, CACHE_BLOCK)]
+        with self.lock:
+            hits = next((k for k, block in enumerate(blocks) if block not in self.prefix_blocks), len(blocks))
+            self.prefix_blocks.update(blocks)
+        return hits * CACHE_BLOCK // 4
+
+    def request_latency(self, body):
+        latency = self.latency
+        if self.latency_per_1k_tokens:
+            latency += self.latency_per_1k_tokens * len(json.dumps(body["messages"])) / 4 / 1000
+        if random.random() < self.slow_rate:
+            with self.lock:
+                self.stats["slow"] += 1
+            latency += self.slow_latency
+        return latency
+
+    def rate_limited(self):
+        """Whether to answer a chat completion with a 429"""
+        if random.random() < self.error_rate:
+            with self.lock:
+                self.stats["rate_limited"] += 1
+            return True
+        return False
+
+    def new_id(self, prefix):
+        with self.lock:
+            return f"{prefix}-{next(self.ids)}"
+
+    def usage(self, body):
+        text = json.dumps([body.get("model"), body["messages"]])
+        prompt_tokens = len(text) // 4
+        completion_tokens = len(self.answer) // 4
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "prompt_tokens_details": {"cached_tokens": self.cached_tokens(text)}
+        }
+        if "reasoner" in body.get("model", ""):  # Answers with a separate reasoning field, like deepseek-reasoner
+            usage["completion_tokens"] += len(REASONING) // 4
+            usage["completion_tokens_details"] = {"reasoning_tokens": len(REASONING) // 4}
+        return usage
+
+    def completion(self, body):
+        message = {"role": "assistant", "content": self.answer}
+        if "reasoner" in body.get("model", ""):
+            message["reasoning_content"] = REASONING
+        return {
+            "id": self.new_id("chatcmpl"),
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "mock"),
+            "choices": [{
+                "index": 0,
+                "finish_reason": "stop",
+                "message": message
+            }],
+            "usage": self.usage(body)
+        }
+
+    def run_batch(self, batch):
+        """Answer every request of a batch input file once the batch is old enough"""
+        if batch["status"] != "in_progress" or time.time() - batch["created_at"] < self.batch_delay:
+            return
+        lines = []
+        for line in self.files[batch["input_file_id"]]["data"].decode("utf-8").splitlines():
+            request = json.loads(line)
+            lines.append(json.dumps({
+                "id": self.new_id("batch_req"),
+                "custom_id": request["custom_id"],
+                "response": {"status_code": 200, "request_id": "", "body": self.completion(request["body"])},
+                "error": None
+            }))
+        output_file = self.add_file(("\n".join(lines) + "\n").encode("utf-8"), "batch_output")
+        batch.update(
+            status="completed",
+            output_file_id=output_file["id"],
+            completed_at=int(time.time()),
+            request_counts={"total": len(lines), "completed": len(lines), "failed": 0}
+        )
+
+    def add_file(self, data, purpose):
+        file = {
+            "id": self.new_id("file"),
+            "object": "file",
+            "bytes": len(data),
+            "created_at": int(time.time()),
+            "filename": f"{purpose}.jsonl",
+            "purpose": purpose,
+            "status": "processed"
+        }
+        self.files[file["id"]] = {"meta": file, "data": data}
+        return file
+
+def make_handler(state):
+    class MockHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def send_json(self, obj, status=200, headers=None):
+            data = json.dumps(obj).encode("utf-8")
+            self.send_response(status)
+            self.send_header("content-type", "application/json")
+            self.send_header("content-length", str(len(data)))
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def read_body(self):
+            return self.rfile.read(int(self.headers.get("content-length", 0)))
+
+        def route(self):
+            return self.path.split("?")[0].removeprefix("/v1").strip("/").split("/")
+
+        def do_POST(self):
+            route = self.route()
+            raw = self.read_body()
+            if route == ["chat", "completions"]:
+                return self.chat_completion(json.loads(raw))
+            if route == ["files"]:
+                message = BytesParser(policy=policy.default).parsebytes(
+                    b"Content-Type: " + self.headers["content-type"].encode() + b"\r\n\r\n" + raw
+                )
+                fields = {
+                    part.get_param("name", header="content-disposition"): part.get_payload(decode=True)
+                    for part in message.iter_parts()
+                }
+                return self.send_json(state.add_file(fields["file"], fields.get("purpose", b"batch").decode()))
+            if route == ["batches"]:
+                body = json.loads(raw)
+                batch = {
+                    "id": state.new_id("batch"),
+                    "object": "batch",
+                    "endpoint": body["endpoint"],
+                    "input_file_id": body["input_file_id"],
+                    "completion_window": body["completion_window"],
+                    "status": "in_progress",
+                    "created_at": int(time.time()),
+                    "metadata": body.get("metadata")
+                }
+                state.batches[batch["id"]] = batch
+                return self.send_json(batch)
+            self.send_json({"error": {"message": f"Unknown route {self.path}"}}, 404)
+
+        def do_GET(self):
+            route = self.route()
+            if len(route) == 2 and route[0] == "batches" and route[1] in state.batches:
+                batch = state.batches[route[1]]
+                state.run_batch(batch)
+                return self.send_json(batch)
+            if len(route) == 3 and route[0] == "files" and route[2] == "content" and route[1] in state.files:
+                data = state.files[route[1]]["data"]
+                self.send_response(200)
+                self.send_header("content-type", "application/octet-stream")
+                self.send_header("content-length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+                return
+            if route == ["stats"]:
+                return self.send_json(state.stats)
+            self.send_json({"error": {"message": f"Unknown route {self.path}"}}, 404)
+
+        def chat_completion(self, body):
+            with state.lock:
+                state.stats["requests"] += 1
+                state.in_flight += 1
+                state.stats["max_in_flight"] = max(state.stats["max_in_flight"], state.in_flight)
+            try:
+                if state.rate_limited():
+                    return self.send_json(
+                        {"error": {"message": "Rate limit reached", "type": "requests"}}, 429, {"retry-after": "0.5"}
+                    )
+                if body.get("stream"):
+                    return self.stream_completion(body)
+                time.sleep(state.request_latency(body))
+                self.send_json(state.completion(body))
+            finally:
+                with state.lock:
+                    state.in_flight -= 1
+
+        def stream_completion(self, body):
+            """Server-sent events: the reasoning and the answer a few characters at a time, then the usage"""
+            self.send_response(200)
+            self.send_header("content-type", "text/event-stream")
+            self.send_header("connection", "close")
+            self.end_headers()
+            self.close_connection = True
+            chunk = {"id": state.new_id("chatcmpl"), "object": "chat.completion.chunk", "created": int(time.time()), "model": body.get("model", "mock")}
+
+            def send(choices, usage=None):
+                event = {**chunk, "choices": choices}
+                if usage is not None:
+                    event["usage"] = usage
+                self.wfile.write(f"data: {json.dumps(event)}\n\n".encode("utf-8"))
+                self.wfile.flush()
+
+            latency = state.request_latency(body)
+            time.sleep(latency / 2)  # Time to first token
+            pieces = []
+            if "reasoner" in body.get("model", ""):
+                pieces += [{"reasoning_content": REASONING[i:i + 8]} for i in range(0, len(REASONING), 8)]
+            pieces += [{"content": state.answer[i:i + 8]} for i in range(0, len(state.answer), 8)]
+            for piece in pieces:
+                send([{"index": 0, "delta": piece, "finish_reason": None}])
+                time.sleep(latency / 2 / len(pieces))
+            send([{"index": 0, "delta": {}, "finish_reason": "stop"}])
+            if (body.get("stream_options") or {}).get("include_usage"):
+                send([], state.usage(body))
+            self.wfile.write(b"data: [DONE]\n\n")
+
+    return MockHandler
+
+def serve(port=8000, **kwargs):
+    """Start the stand-in in a background thread. Return the server, stop it with server.shutdown()"""
+    state = MockState(**kwargs)
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(state))
+    server.state = state
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+if __name__ == "__main__":
+    args = parse_mock_arguments().parse_args()
+    state = MockState(
+        args.latency, args.error_rate, args.batch_delay, args.trailing, args.latency_per_1k_tokens, args.slow_rate, args.slow_latency
+    )
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), make_handler(state))
+    print(f"<mock_openai_server> Listening on http://127.0.0.1:{args.port}/v1")
+    server.serve_forever()
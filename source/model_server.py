@@ -0,0 +1,308 @@
+import argparse
+import json
+import threading
+import time
+from collections import deque
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from run_metrics import percentile
+
+# Long-lived OpenAI-compatible chat completions endpoint for Hugging Face models. Models are loaded
+# once, on their first request or at startup, and stay resident, so back-to-back runs do not reload
+# them. Requests from any number of clients are queued; one worker thread owns the models and
+# generates the queued requests of the same model and settings together, in length buckets.
+# Run models against it with run_models.py --server http://127.0.0.1:<port>/v1
+
+LATENCY_WINDOW = 1000  # Requests the latency percentiles of /stats are computed over
+
+def parse_server_arguments():
+    parser = argparse.ArgumentParser(description='OpenAI-compatible server keeping Hugging Face models loaded')
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('-m', '--model', type=str, action='append', default=[], help='model to load at startup, full Hugging Face id or models.json acronym; can be repeated')
+    parser.add_argument('--batch_size', type=int, default=8, help='maximum number of queued requests generated together')
+    parser.add_argument('--max_new_tokens', type=int, default=None, help='generation limit of requests that do not set max_tokens')
+    parser.add_argument('--device', type=str, default=None, help='device of the models, e.g. cpu; defaults to device_map auto')
+    return parser
+
+class Job:
+    def __init__(self, model, messages, hyperparams):
+        self.model = model
+        self.messages = messages
+        self.hyperparams = hyperparams
+        self.key = (model, json.dumps(hyperparams, sort_keys=True))  # Only jobs with the same key share a batch
+        self.enqueued = time.perf_counter()
+        self.started = None
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.status = 500  # Of the error response
+
+class ModelServer:
+    def __init__(self, batch_size=8, device=None, max_new_tokens=None):
+        self.batch_size = batch_size
+        self.device = device
+        self.max_new_tokens = max_new_tokens
+        self.engines = {}
+        self.unavailable = {}  # Model: why it could not be loaded, so that its requests are rejected up front
+        self.queue = deque()
+        self.condition = threading.Condition()
+        self.in_flight = 0
+        self.stats = {"requests": 0, "completed": 0, "failed": 0, "batches": 0, "max_queue_depth": 0}
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.queue_waits = deque(maxlen=LATENCY_WINDOW)
+        self.batch_sizes = deque(maxlen=LATENCY_WINDOW)
+        threading.Thread(target=self.work, daemon=True).start()
+
+    def engine(self, model):
+        """The resident engine of a model, loading it on first use. Only called from the worker thread"""
+        if model not in self.engines:
+            from kani.engines.huggingface import HuggingEngine
+
+            start = time.perf_counter()
+            if self.device is None:
+                self.engines[model] = HuggingEngine(model_id=model, model_load_kwargs={"device_map": "auto"})
+            else:
+                self.engines[model] = HuggingEngine(model_id=model, device=self.device)
+            print(f"<ModelServer> Loaded {model} in {time.perf_counter() - start:.1f}s")
+        return self.engines[model]
+
+    def preload(self, model):
+        job = Job(model, None, {})
+        self.submit(job)
+        if job.error is not None:
+            raise job.error
+
+    def submit(self, job):
+        """Queue a job and wait until the worker is done with it"""
+        with self.condition:
+            self.queue.append(job)
+            self.stats["requests"] += job.messages is not None
+            self.stats["max_queue_depth"] = max(self.stats["max_queue_depth"], len(self.queue))
+            self.condition.notify()
+        job.done.wait()
+        return job
+
+    def next_batch(self):
+        """The oldest queued job and up to batch_size - 1 later jobs with the same model and settings"""
+        with self.condition:
+            while not self.queue:
+                self.condition.wait()
+            first = self.queue.popleft()
+            jobs = [first]
+            for job in list(self.queue):
+                if len(jobs) == self.batch_size:
+                    break
+                if job.key == first.key and job.messages is not None:
+                    self.queue.remove(job)
+                    jobs.append(job)
+            self.in_flight = len(jobs)
+            return jobs
+
+    def load(self, jobs):
+        """The engine of the model of the jobs, or None, with the jobs failed as not found, if there is no such model"""
+        try:
+            return self.engine(jobs[0].model)
+        except OSError as e:  # Raised by from_pretrained for what is not a model id or path, or not accessible
+            print(f"<ModelServer> Could not load {jobs[0].model}: {type(e).__name__}: {e}")
+            self.unavailable[jobs[0].model] = f"{type(e).__name__}: {e}"
+            for job in jobs:
+                job.error, job.status = e, 404
+            return None
+
+    def generate(self, engine, jobs):
+        """Answer a batch of jobs of the same model and settings, in length buckets"""
+        from local_engine import length_buckets, tokenize_messages, generate_batch
+
+        if jobs[0].messages is None:  # Preload
+            jobs[0].result = {}
+            return
+        token_ids = [tokenize_messages(engine, job.messages) for job in jobs]
+        hyperparams = dict(jobs[0].hyperparams)
+        if self.max_new_tokens is not None:
+            hyperparams.setdefault("max_new_tokens", self.max_new_tokens)
+        for bucket in length_buckets([len(ids) for ids in token_ids], self.batch_size):
+            texts, lengths = generate_batch(engine, [token_ids[i] for i in bucket], **hyperparams)
+            for i, text, n_tokens in zip(bucket, texts, lengths):
+                jobs[i].result = {"content": text, "prompt_tokens": len(token_ids[i]), "completion_tokens": n_tokens}
+            self.stats["batches"] += 1
+            self.batch_sizes.append(len(bucket))
+
+    def work(self):
+        while True:
+            jobs = self.next_batch()
+            started = time.perf_counter()
+            for job in jobs:
+                job.started = started
+            try:
+                engine = self.load(jobs)
+                if engine is not None:
+                    self.generate(engine, jobs)
+            except Exception as e:  # Such as out of memory, reported to the clients of the batch
+                print(f"<ModelServer> {type(e).__name__}: {e}")
+                for job in jobs:
+                    job.error = e
+            now = time.perf_counter()
+            with self.condition:
+                self.in_flight = 0
+                for job in jobs:
+                    if job.messages is None:
+                        continue
+                    self.stats["failed" if job.error is not None else "completed"] += 1
+                    self.latencies.append(now - job.enqueued)
+                    self.queue_waits.append(job.started - job.enqueued)
+            for job in jobs:
+                job.done.set()
+
+    def summary(self):
+        with self.condition:
+            return {
+                **self.stats,
+                "queue_depth": len(self.queue),
+                "in_flight": self.in_flight,
+                "models": list(self.engines),
+                "latency_p50": percentile(self.latencies, 0.5),
+                "latency_p95": percentile(self.latencies, 0.95),
+                "queue_wait_p50": percentile(self.queue_waits, 0.5),
+                "queue_wait_p95": percentile(self.queue_waits, 0.95),
+                "mean_batch_size": sum(self.batch_sizes) / len(self.batch_sizes) if self.batch_sizes else None
+            }
+
+def check_body(body):
+    """Why a chat completions request body cannot be answered, or None"""
+    if not isinstance(body, dict):
+        return "The body must be a JSON object"
+    if not isinstance(body.get("model"), str) or not body["model"]:
+        return "Missing model"
+    messages = body.get("messages")
+    if not isinstance(messages, list) or not messages:
+        return "Missing messages"
+    if not all(isinstance(message, dict) and "role" in message and "content" in message for message in messages):
+        return "Every message needs a role and a content"
+    for field in ("temperature", "top_p", "max_tokens", "max_completion_tokens"):
+        if body.get(field) is not None and (isinstance(body[field], bool) or not isinstance(body[field], (int, float))):
+            return f"{field} must be a number"
+    return None
+
+def get_hyperparams(body):
+    """Generation settings of a chat completions request body"""
+    hyperparams = {}
+    if body.get("temperature") is not None:
+        hyperparams["temperature"] = body["temperature"]
+        hyperparams["do_sample"] = body["temperature"] > 0
+    if body.get("top_p") is not None:
+        hyperparams["top_p"] = body["top_p"]
+    max_tokens = body.get("max_completion_tokens", body.get("max_tokens"))
+    if max_tokens is not None:
+        hyperparams["max_new_tokens"] = max_tokens
+    return hyperparams
+
+def make_handler(server, ids):
+    class ModelHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def send_json(self, obj, status=200):
+            data = json.dumps(obj).encode("utf-8")
+            self.send_response(status)
+            self.send_header("content-type", "application/json")
+            self.send_header("content-length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def route(self):
+            return self.path.split("?")[0].removeprefix("/v1").strip("/").split("/")
+
+        def do_GET(self):
+            route = self.route()
+            if route == ["stats"]:
+                return self.send_json(server.summary())
+            if route == ["models"]:
+                return self.send_json({"object": "list", "data": [{"id": model, "object": "model"} for model in server.engines]})
+            self.send_error_json(f"Unknown route {self.path}", 404)
+
+        def send_error_json(self, message, status, error_type="invalid_request_error"):
+            self.send_json({"error": {"message": message, "type": error_type}}, status)
+
+        def do_POST(self):
+            raw = self.rfile.read(int(self.headers.get("content-length", 0)))
+            if self.route() != ["chat", "completions"]:
+                return self.send_error_json(f"Unknown route {self.path}", 404)
+            try:
+                body = json.loads(raw)
+            except json.JSONDecodeError as e:
+                return self.send_error_json(f"Invalid JSON body: {e}", 400)
+            problem = check_body(body)
+            if problem is not None:
+                return self.send_error_json(problem, 400)
+            if body["model"] in server.unavailable:
+                return self.send_error_json(f"Model {body['model']} could not be loaded: {server.unavailable[body['model']]}", 404)
+            job = server.submit(Job(body["model"], body["messages"], get_hyperparams(body)))
+            if job.error is not None:
+                error_type = "invalid_request_error" if job.status == 404 else "server_error"
+                return self.send_error_json(f"{type(job.error).__name__}: {job.error}", job.status, error_type)
+            usage = {
+                "prompt_tokens": job.result["prompt_tokens"],
+                "completion_tokens": job.result["completion_tokens"],
+                "total_tokens": job.result["prompt_tokens"] + job.result["completion_tokens"]
+            }
+            completion = {
+                "id": f"chatcmpl-{next(ids)}",
+                "created": int(time.time()),
+                "model": body["model"]
+            }
+            if body.get("stream"):
+                return self.send_stream(body, completion, job.result["content"], usage)
+            self.send_json({
+                **completion,
+                "object": "chat.completion",
+                "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": job.result["content"]}}],
+                "usage": usage
+            })
+
+        def send_stream(self, body, completion, content, usage):
+            """The answer is generated in a batch, so it is streamed as a single chunk once complete"""
+            self.send_response(200)
+            self.send_header("content-type", "text/event-stream")
+            self.send_header("connection", "close")
+            self.end_headers()
+            self.close_connection = True
+            events = [
+                {"choices": [{"index": 0, "delta": {"role": "assistant", "content": content}, "finish_reason": None}]},
+                {"choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}
+            ]
+            if (body.get("stream_options") or {}).get("include_usage"):
+                events.append({"choices": [], "usage": usage})
+            for event in events:
+                self.wfile.write(f"data: {json.dumps({**completion, 'object': 'chat.completion.chunk', **event})}\n\n".encode("utf-8"))
+            self.wfile.write(b"data: [DONE]\n\n")
+
+    return ModelHandler
+
+def serve(port=8001, models=(), batch_size=8, device=None, max_new_tokens=None):
+    """Start the server in a background thread, with the given models loaded. Stop it with server.shutdown()"""
+    import itertools
+
+    model_server = ModelServer(batch_size, device, max_new_tokens)
+    for model in models:
+        model_server.preload(model)
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(model_server, itertools.count()))
+    server.model_server = model_server
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+if __name__ == "__main__":
+    from run_models import resolve_model
+
+    args = parse_server_arguments().parse_args()
+    server = serve(args.port, [resolve_model(model) for model in args.model], args.batch_size, args.device, args.max_new_tokens)
+    print(f"<model_server> Listening on http://127.0.0.1:{args.port}/v1")
+    try:
+        while True:
+            time.sleep(60)
+            summary = server.model_server.summary()
+            if summary["requests"]:
+                print(f"<model_server> {summary}")
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,130 @@
+import argparse
+import gzip
+import hashlib
+import json
+import os
+
+# Run outputs are written as <case>_outputs.jsonl.gz, one turn per line. The prompt of each turn is
+# replaced by its sha256, and the prompt itself is stored once, compressed, in a content-addressed
+# store shared by all run dirs of the same output root (<output_root>/.store). Prompts that are the
+# same across models, reruns and settings are therefore stored once.
+
+def hash_text(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+class PromptStore:
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+
+    def _path(self, key):
+        return os.path.join(self.store_dir, "prompts", key[:2], key + ".txt.gz")
+
+    def put(self, prompt):
+        """Store a prompt if it is not stored yet. Return its key"""
+        key = hash_text(prompt)
+        path = self._path(key)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with gzip.open(tmp_path, "wt", encoding="utf-8") as file:
+                file.write(prompt)
+            os.replace(tmp_path, path)
+        return key
+
+    def get(self, key):
+        with gzip.open(self._path(key), "rt", encoding="utf-8") as file:
+            return file.read()
+
+def get_prompt_store(output_dir):
+    """The store of the output root that holds output_dir"""
+    return PromptStore(os.path.join(os.path.dirname(os.path.normpath(output_dir)), ".store"))
+
+def get_outputs_path(output_dir, case_name):
+    return os.path.join(output_dir, case_name + "_outputs.jsonl.gz")
+
+def get_legacy_outputs_path(output_dir, case_name):
+    """Pretty-printed json list with the full prompts, written before the prompt store"""
+    return os.path.join(output_dir, case_name + "_outputs.json")
+
+def write_outputs(output_dir, case_name, entries):
+    """Write the per-turn entries (idx, prompt, response_json, cot) of a case"""
+    store = get_prompt_store(output_dir)
+    path = get_outputs_path(output_dir, case_name)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with gzip.open(tmp_path, "wt", encoding="utf-8") as file:
+        for entry in entries:
+            entry = dict(entry)
+            if "prompt" in entry:
+                entry["prompt_hash"] = store.put(entry.pop("prompt"))
+            file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+    os.replace(tmp_path, path)
+    legacy_path = get_legacy_outputs_path(output_dir, case_name)
+    if os.path.exists(legacy_path):  # Superseded, never read both
+        os.remove(legacy_path)
+
+def read_outputs(output_dir, case_name, prompts=True):
+    """
+    Return the per-turn entries of a case in either format, or None if the case has no outputs.
+    With prompts=False, the prompts are not loaded from the store.
+    """
+    path = get_outputs_path(output_dir, case_name)
+    if os.path.exists(path):
+        store = get_prompt_store(output_dir)
+        entries = []
+        with gzip.open(path, "rt", encoding="utf-8") as file:
+            for line in file:
+                entry = json.loads(line)
+                if "prompt_hash" in entry and prompts:
+                    entry["prompt"] = store.get(entry.pop("prompt_hash"))
+                entries.append(entry)
+        return entries
+    legacy_path = get_legacy_outputs_path(output_dir, case_name)
+    if os.path.exists(legacy_path):
+        with open(legacy_path, "r") as file:
+            return json.load(file)
+    return None
+
+def get_size(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(
+        os.path.getsize(os.path.join(root, fname))
+        for root, _, fnames in os.walk(path) for fname in fnames
+    )
+
+def migrate_run(output_dir, dry_run=False):
+    """Convert the legacy _outputs.json files of a run dir. Return the number of files converted"""
+    n_converted = 0
+    for fname in sorted(os.listdir(output_dir)):
+        if not fname.endswith("_outputs.json"):
+            continue
+        case_name = fname[:-len("_outputs.json")]
+        with open(os.path.join(output_dir, fname), "r") as file:
+            entries = json.load(file)
+        if dry_run:
+            n_converted += 1
+            continue
+        write_outputs(output_dir, case_name, entries)
+        if read_outputs(output_dir, case_name) != entries:
+            raise ValueError(f"<migrate_run> {output_dir}/{case_name} does not read back the same")
+        n_converted += 1
+    return n_converted
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Convert the _outputs.json files of existing runs to the prompt store format')
+    parser.add_argument('--output_root', type=str, default='../output', help='directory holding the output dirs')
+    parser.add_argument('--dry_run', action='store_true', help='only count the files to convert')
+    args = parser.parse_args()
+
+    size_before = get_size(args.output_root)
+    total = 0
+    for output in sorted(os.listdir(args.output_root)):
+        output_dir = os.path.join(args.output_root, output)
+        if not os.path.isdir(output_dir) or output.startswith("."):
+            continue
+        n_converted = migrate_run(output_dir, args.dry_run)
+        if n_converted:
+            print(f"<main> {output}: {n_converted} cases")
+        total += n_converted
+    size_after = get_size(args.output_root)
+    print(f"<main> Converted {total} cases, {args.output_root} went from {size_before / 1024 ** 2:.1f} MB to {size_after / 1024 ** 2:.1f} MB")
@@ -0,0 +1,290 @@
+import json
+import os
+import re
+
+from context_budget import get_context_budget, ApproxTokenizer
+from story_index import StoryIndex, tokenize, RETRIEVE_TOKENS
+
+# Order of the prompt sections. "cache" puts them from the most to the least shared, so that the
+# turns of a case share a long prefix that providers with prompt caching bill and prefill once:
+# prompt prefix, characters and evidences (the same for every turn), story (which only grows from
+# turn to turn), then the testimonies of the turn.
+LAYOUTS = ["default", "cache"]
+
+class StoryContext:
+    """
+    The full story of a case as a list of segments: the previous context, then the new context
+    of every turn. The story up to turn i is never materialised on its own; it is returned
+    as a list of pieces that are joined directly into the prompt.
+    """
+    def __init__(self, prev_context, new_contexts):
+        self.segments = [prev_context + "\n"] + list(new_contexts)
+
+    def pieces(self, i):
+        """Pieces of `prev_context + "\n" + context_sofar + "\n"` at turn i"""
+        return self.segments[:i + 2] + ["\n"]
+
+class CompiledCase:
+    """
+    Prompt fragments of one case, formatted once and joined for every turn.
+    All turns returned by parse_json share the same characters and evidences lists,
+    so their blocks only depend on the description setting.
+    """
+    def __init__(self, turns, prev_context):
+        self.turns = turns
+        self.prev_context = prev_context
+        self.characters = turns[0]['characters'] if turns else []
+        self.evidences = turns[0]['evidences'] if turns else []
+        self._new_contexts = None
+        self._story = None
+        self._story_index = None
+        self._token_counts = {}
+        self._characters_blocks = {}
+        self._evidence_strings = {}
+        self._evidences_blocks = {}
+        self._testimonies_blocks = {}
+
+    @property
+    def new_contexts(self):
+        if self._new_contexts is None:  # Only needed with full context
+            self._new_contexts = [re.sub(r'\n+', ' ', turn['newContext']) for turn in self.turns]  # Remove newlines
+        return self._new_contexts
+
+    @property
+    def story(self):
+        if self._story is None:
+            self._story = StoryContext(self.prev_context, self.new_contexts)
+        return self._story
+
+    @property
+    def story_index(self):
+        if self._story_index is None:  # Only needed with retrieved context
+            self._story_index = StoryIndex(self.story.segments)
+        return self._story_index
+
+    def characters_block(self, no_description):
+        if no_description not in self._characters_blocks:
+            block = "Characters:\n"
+            for character_counter, character in enumerate(self.characters):
+                block += f"Character {character_counter}\n"
+                block += f"Name: {character['name']}\n"
+                if not no_description:
+                    block += f"Description: {character['description1']}\n"
+            self._characters_blocks[no_description] = block
+        return self._characters_blocks[no_description]
+
+    def evidence_strings(self, no_description):
+        if no_description not in self._evidence_strings:
+            evidences = []
+            for evidence_counter, evidence in enumerate(self.evidences):
+                evidence_string = f"Evidence {evidence_counter}\n"
+                evidence_string += f"Name: {evidence['name']}\n"
+                if not no_description:
+                    descriptions = [evidence[key] for key in evidence.keys() if 'description' in key]
+                    evidence_string += "Description: " + " ".join(descriptions) + "\n"
+                evidences.append(evidence_string)
+            self._evidence_strings[no_description] = evidences
+        return self._evidence_strings[no_description]
+
+    def context_source(self, i):
+        """Source of the first testimony of turn i that is not self-contained, if any"""
+        for testimony in self.turns[i]['testimonies']:
+            if "source" in testimony and \
+                testimony["source"].get("is_self_contained", "yes") == "no":
+                return testimony["source"]
+        return None
+
+    def evidences_block(self, i, context, no_description):
+        """
+        Without story context, the context span of the first testimony that is not self-contained
+        is added to every evidence that contains one of its evidence spans
+        """
+        source = self.context_source(i) if context is None and not no_description else None
+        key = no_description if source is None else (no_description, i)
+        if key not in self._evidences_blocks:
+            evidences = self.evidence_strings(no_description)
+            if source is not None:
+                evidence_spans = source["evidence_span"]
+                if isinstance(evidence_spans, str):
+                    evidence_spans = [evidence_spans]
+                evidences = [
+                    evidence_string + f"{source['context_span']}\n" * sum(
+                        evidence_span in evidence_string for evidence_span in evidence_spans
+                    )
+                    for evidence_string in evidences
+                ]
+            self._evidences_blocks[key] = f"Evidences:\n{''.join(evidences)}\n"
+        return self._evidences_blocks[key]
+
+    def testimonies_block(self, i):
+        if i not in self._testimonies_blocks:
+            block = "Testimonies:\n"
+            for testimony_counter, testimony in enumerate(self.turns[i]['testimonies']):
+                block += f"Testimony {testimony_counter}\n"
+                block += f"Testimony: {testimony['testimony']}\n"
+                block += f"Person: {testimony['person']}\n"
+            self._testimonies_blocks[i] = block + "\n"
+        return self._testimonies_blocks[i]
+
+    def count_tokens(self, budget, text):
+        """Token count of a prompt fragment, memoised for the lifetime of the case"""
+        key = (budget.tokenizer_name, text)
+        if key not in self._token_counts:
+            self._token_counts[key] = budget.count(text)
+        return self._token_counts[key]
+
+    def context_spans(self, i):
+        """Context spans of the testimonies of turn i that are not self-contained"""
+        spans = []
+        for testimony in self.turns[i]['testimonies']:
+            source = testimony.get("source") or {}
+            if source.get("is_self_contained", "yes") == "no":
+                span = source.get("context_span", [])
+                spans.extend([span] if isinstance(span, str) else span)
+        return spans
+
+    def retrieval_query(self, i):
+        """BM25 query of turn i: its testimonies, then the evidences with half the weight"""
+        query = {}
+        for evidence in self.evidence_strings(False):
+            for term in tokenize(evidence):
+                query[term] = 0.5
+        for testimony in self.turns[i]['testimonies']:
+            for term in tokenize(testimony['testimony'] + " " + testimony['person']):
+                query[term] = 1.0
+        return query
+
+    def retrieved_pieces(self, i, budget, available):
+        """Story excerpts of turn i, taken from the story up to turn i only"""
+        if budget is None:
+            count = ApproxTokenizer().count
+        else:
+            count = lambda text: self.count_tokens(budget, text)
+        excerpts = self.story_index.select(
+            self.retrieval_query(i), self.context_spans(i), i + 2, min(RETRIEVE_TOKENS, available), count
+        )
+        return ["Story excerpts:\n"] + [excerpt + "\n...\n" for excerpt in excerpts[:-1]] + [excerpt + "\n\n" for excerpt in excerpts[-1:]]
+
+    def story_pieces(self, i, context, model, fixed_pieces):
+        """
+        Story pieces of turn i. If the context window of the model is known, the story is cut
+        from the front so that the prompt, including `fixed_pieces`, leaves room for the completion.
+        """
+        if context is None:
+            return []
+        if context == "retrieve":
+            budget = get_context_budget(model)
+            available = RETRIEVE_TOKENS if budget is None else budget.max_prompt_tokens - sum(
+                self.count_tokens(budget, piece) for piece in ["Story excerpts:\n"] + fixed_pieces
+            )
+            return self.retrieved_pieces(i, budget, max(available, 0))
+        if context == "full":
+            segments = self.story.pieces(i)
+        elif context == "sum":
+            segments = [self.turns[i]['summarizedContext'] + "\n"]
+        else:
+            segments = ["\n"]
+        budget = get_context_budget(model)
+        if budget is None:
+            return ["Story:\n"] + segments
+        available = budget.max_prompt_tokens - sum(
+            self.count_tokens(budget, piece) for piece in ["Story:\n"] + fixed_pieces
+        )
+        if available <= 0:
+            print(f"<CompiledCase> Turn {i} does not fit in the context window of {model} even without story")
+            available = 0
+        counts = [self.count_tokens(budget, segment) for segment in segments]
+        return ["Story:\n"] + budget.fit_tail(segments, available, counts)
+
+    def turn_pieces(self, i, prompt_prefix, prompt_suffix, context, no_description, model, layout="default"):
+        """Pieces of the prompt of turn i"""
+        fixed_pieces = [
+            self.characters_block(no_description),
+            self.evidences_block(i, context, no_description),
+            self.testimonies_block(i),
+            prompt_suffix
+        ]
+        story_pieces = self.story_pieces(i, context, model, [prompt_prefix] + fixed_pieces)
+        if layout == "cache":
+            return [prompt_prefix, *fixed_pieces[:2], *story_pieces, *fixed_pieces[2:]]
+        return [prompt_prefix, *story_pieces, *fixed_pieces]
+
+    def build(self, prompt_prefix, prompt_suffix, context, no_description, model, layout="default"):
+        """Return the prompt of every turn, same as run_models.build_prompt"""
+        return [
+            "".join(self.turn_pieces(i, prompt_prefix, prompt_suffix, context, no_description, model, layout))
+            for i in range(len(self.turns))
+        ]
+
+class Conversation:
+    """
+    A case as one growing chat. The first turn is the full-context prompt; every later turn only
+    adds its new context and testimonies, and the model's earlier answers stay in the history as
+    their answer json. If the history would not fit in the context window of the model, the
+    conversation restarts from the full-context prompt of the current turn.
+    """
+    def __init__(self, case, prompt_prefix, prompt_suffix, no_description, model, system_message, layout="default"):
+        self.case = case
+        self.prompt_prefix = prompt_prefix
+        self.prompt_suffix = prompt_suffix
+        self.no_description = no_description
+        self.model = model
+        self.layout = layout
+        self.budget = get_context_budget(model)
+        self.system = {"role": "system", "content": system_message}
+        self.messages = [self.system]
+        self.message_tokens = [self.count(system_message)]
+        self.restarts = 0
+        self.sent_tokens = 0  # Input tokens of every request of the conversation
+        self.stateless_tokens = 0  # Input tokens of the same turns with --context full
+        # Input tokens that are not a prefix of the previous request, i.e. that a provider with prompt
+        # caching has to process anew. With --context full, every turn repeats everything after the story.
+        self.new_tokens = 0
+        self.stateless_new_tokens = 0
+        self.previous_full_prompt = ""
+
+    def count(self, text):
+        if self.budget is None:
+            return ApproxTokenizer().count(text)
+        return self.case.count_tokens(self.budget, text)
+
+    def full_prompt(self, i):
+        pieces = self.case.turn_pieces(i, self.prompt_prefix, self.prompt_suffix, "full", self.no_description, self.model, self.layout)
+        return "".join(pieces), self.message_tokens[0] + sum(self.count(piece) for piece in pieces)
+
+    def continuation(self, i):
+        return "".join([
+            "Story continued:\n",
+            self.case.new_contexts[i],
+            "\n\n",
+            self.case.testimonies_block(i),
+            self.prompt_suffix
+        ])
+
+    def next_turn(self, i):
+        """Add the user message of turn i. Return it and the messages to send"""
+        full_prompt, full_tokens = self.full_prompt(i)
+        self.stateless_tokens += full_tokens
+        shared = os.path.commonprefix([self.previous_full_prompt, full_prompt])
+        self.stateless_new_tokens += full_tokens - (self.message_tokens[0] + self.count(shared) if shared else 0)
+        self.previous_full_prompt = full_prompt
+        if i > 0:
+            prompt = self.continuation(i)
+            tokens = self.count(prompt)
+            if self.budget is None or sum(self.message_tokens) + tokens <= self.budget.max_prompt_tokens:
+                self.messages.append({"role": "user", "content": prompt})
+                self.message_tokens.append(tokens)
+                self.sent_tokens += sum(self.message_tokens)
+                self.new_tokens += self.message_tokens[-2] + tokens  # The previous answer and this turn
+                return prompt, list(self.messages)
+            self.restarts += 1
+        self.messages = [self.system, {"role": "user", "content": full_prompt}]
+        self.message_tokens = [self.message_tokens[0], full_tokens - self.message_tokens[0]]
+        self.sent_tokens += full_tokens
+        self.new_tokens += full_tokens
+        return full_prompt, list(self.messages)
+
+    def add_answer(self, answer_json):
+        answer = json.dumps(answer_json)
+        self.messages.append({"role": "assistant", "content": answer})
+        self.message_tokens.append(self.count(answer))
@@ -0,0 +1,250 @@
+import asyncio
+import random
+import re
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+# Errors that are worth retrying: rate limits, timeouts, dropped connections and 5xx
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+
+def parse_duration(value):
+    """Parse header durations such as '1.5', '20ms', '6m0s' or an HTTP date into seconds"""
+    if value is None:
+        return None
+    value = str(value).strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    parts = re.findall(r'([\d.]+)(ms|h|m|s)', value)
+    if parts and "".join(n + u for n, u in parts) == value:
+        scale = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+        return sum(float(n) * scale[u] for n, u in parts)
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def get_headers(obj):
+    """Return the response headers of a raw response or an api error, if any"""
+    headers = getattr(obj, "headers", None)
+    if headers is None and getattr(obj, "response", None) is not None:
+        headers = getattr(obj.response, "headers", None)
+    return headers or {}
+
+def is_retryable(error):
+    name = type(error).__name__
+    if name in ("APITimeoutError", "APIConnectionError", "RateLimitError", "InternalServerError", "TimeoutError"):
+        return True
+    return getattr(error, "status_code", None) in RETRYABLE_STATUS
+
+def is_throttle(error):
+    """
+    Whether an error means the provider limits the rate. Other retryable errors, such as a slow
+    request that missed its deadline, are retried with backoff but leave the concurrency as is.
+    """
+    if type(error).__name__ == "RateLimitError" or getattr(error, "status_code", None) == 429:
+        return True
+    headers = get_headers(error)
+    return headers.get("retry-after") is not None or headers.get("retry-after-ms") is not None
+
+class RateController:
+    """
+    Per-provider request controller: a token bucket caps the request rate and AIMD adjusts
+    the number of requests in flight. Rate limit errors halve the concurrency, successes grow
+    it by roughly one slot per window, and retry-after / x-ratelimit-* headers pause new requests.
+    Timeouts and server errors are retried with backoff without lowering the concurrency.
+    """
+    def __init__(
+        self,
+        name,
+        requests_per_second=None,
+        initial_concurrency=4,
+        min_concurrency=1,
+        max_concurrency=64,
+        decrease_factor=0.5,
+        max_retries=8,
+        base_delay=1.0,
+        max_delay=60.0,
+    ):
+        self.name = name
+        self.rate = requests_per_second  # None means no rate cap
+        self.capacity = max(1.0, requests_per_second or 1.0)
+        self.tokens = self.capacity
+        self.last_refill = time.monotonic()
+        self.limit = float(initial_concurrency)
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.decrease_factor = decrease_factor
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.blocked_until = 0.0
+        self.last_decrease = 0.0
+        self.in_flight = 0
+        self.stats = {"requests": 0, "successes": 0, "throttled": 0, "retries": 0, "failures": 0}
+        self._lock = threading.Lock()
+        self._slots = threading.Condition()  # Guards in_flight, for sync and async calls alike
+        self._condition = None  # Created lazily inside the running event loop
+
+    # Bookkeeping
+
+    def _wait_time(self):
+        """Seconds until a request may be sent, consuming a token when it is 0"""
+        with self._lock:
+            now = time.monotonic()
+            if now < self.blocked_until:
+                return self.blocked_until - now
+            if self.rate is None:
+                return 0.0
+            self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+            self.last_refill = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+            return (1 - self.tokens) / self.rate
+
+    def _read_headers(self, headers):
+        delay = parse_duration(headers.get("retry-after-ms"))
+        if delay is not None:
+            delay /= 1000
+        else:
+            delay = parse_duration(headers.get("retry-after"))
+        remaining = headers.get("x-ratelimit-remaining-requests")
+        if delay is None and remaining is not None and remaining.strip() == "0":
+            delay = parse_duration(headers.get("x-ratelimit-reset-requests"))
+        if delay:
+            with self._lock:
+                self.blocked_until = max(self.blocked_until, time.monotonic() + delay)
+        return delay
+
+    def _count(self, key):
+        with self._lock:
+            self.stats[key] += 1
+
+    def _try_acquire(self):
+        """Take an in-flight slot if the AIMD limit allows it"""
+        with self._slots:
+            if self.in_flight < int(self.limit):
+                self.in_flight += 1
+                return True
+            return False
+
+    def _release_slot(self):
+        with self._slots:
+            self.in_flight -= 1
+            self._slots.notify_all()
+
+    def hold(self, future):
+        """Keep a slot taken until `future` is done, for a sync request that was given up on but still runs"""
+        with self._slots:
+            self.in_flight += 1
+        future.add_done_callback(lambda _: self._release_slot())
+
+    def on_success(self, headers):
+        with self._lock:
+            self.stats["successes"] += 1
+            self.limit = min(self.max_concurrency, self.limit + 1 / max(self.limit, 1))
+        self._read_headers(headers)
+
+    def on_throttle(self, headers, throttle=True):
+        """Decrease the limit on a rate limit, or only read the headers of another retried error"""
+        if throttle:
+            with self._lock:
+                self.stats["throttled"] += 1
+                now = time.monotonic()
+                if now - self.last_decrease > 1.0:  # One decrease per burst of errors
+                    self.limit = max(self.min_concurrency, self.limit * self.decrease_factor)
+                    self.last_decrease = now
+        return self._read_headers(headers)
+
+    def backoff(self, attempt, server_delay=None):
+        delay = min(self.max_delay, self.base_delay * 2 ** attempt)
+        delay = random.uniform(0, delay)  # Full jitter
+        if server_delay:
+            delay = max(delay, server_delay)
+        return delay
+
+    def summary(self):
+        return {"provider": self.name, "concurrency": round(self.limit, 2), **self.stats}
+
+    # Sync calls
+
+    def call(self, request_fn):
+        """Run `request_fn()` under the controller, retrying rate limits and timeouts"""
+        for attempt in range(self.max_retries + 1):
+            with self._slots:
+                self._slots.wait_for(self._try_acquire)
+            try:
+                wait = self._wait_time()
+                while wait > 0:
+                    time.sleep(wait)
+                    wait = self._wait_time()
+                self._count("requests")
+                response = request_fn()
+            except Exception as e:
+                self._release_slot()
+                if not is_retryable(e) or attempt == self.max_retries:
+                    self._count("failures")
+                    raise
+                delay = self.backoff(attempt, self.on_throttle(get_headers(e), is_throttle(e)))
+                self._count("retries")
+                print(f"<RateController> {self.name}: {type(e).__name__}, retrying in {delay:.1f}s (concurrency {self.limit:.1f})")
+                time.sleep(delay)
+                continue
+            except BaseException:  # Interrupted
+                self._release_slot()
+                raise
+            self._release_slot()
+            self.on_success(get_headers(response))
+            return response
+
+    # Async calls
+
+    async def _acquire(self):
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        async with self._condition:
+            await self._condition.wait_for(self._try_acquire)
+
+    async def _release(self):
+        self._release_slot()
+        async with self._condition:
+            self._condition.notify_all()
+
+    async def acall(self, request_fn):
+        """Await `request_fn()` under the controller, retrying rate limits and timeouts"""
+        for attempt in range(self.max_retries + 1):
+            await self._acquire()
+            try:
+                wait = self._wait_time()
+                while wait > 0:
+                    await asyncio.sleep(wait)
+                    wait = self._wait_time()
+                self._count("requests")
+                response = await request_fn()
+            except Exception as e:
+                await self._release()
+                if not is_retryable(e) or attempt == self.max_retries:
+                    self._count("failures")
+                    raise
+                delay = self.backoff(attempt, self.on_throttle(get_headers(e), is_throttle(e)))
+                self._count("retries")
+                print(f"<RateController> {self.name}: {type(e).__name__}, retrying in {delay:.1f}s (concurrency {self.limit:.1f})")
+                await asyncio.sleep(delay)
+                continue
+            except BaseException:  # Cancelled
+                await self._release()
+                raise
+            await self._release()
+            self.on_success(get_headers(response))
+            return response
+
+CONTROLLERS = {}
+
+def get_controller(provider, **kwargs):
+    """Return the shared controller of a provider, creating it with `kwargs` the first time"""
+    if provider not in CONTROLLERS:
+        CONTROLLERS[provider] = RateController(provider, **kwargs)
+    return CONTROLLERS[provider]
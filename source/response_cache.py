@@ -0,0 +1,141 @@
+import hashlib
+import json
+import os
+
+class CacheMiss(Exception):
+    """Raised in replay mode when a request has no cached response"""
+
+def request_key(model, messages, params=None):
+    """Content address of a request: sha256 of (resolved model name, messages, sampling params)"""
+    payload = json.dumps(
+        {"model": model, "messages": messages, "params": params or {}},
+        sort_keys=True,
+        ensure_ascii=False
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+class ResponseCache:
+    """
+    On-disk cache of chat completion bodies, one json file per request key.
+    mode is "on" (read and write), "replay" (read only, misses raise CacheMiss) or "off".
+    Files are evicted least-recently-used first once the cache grows past max_bytes.
+    """
+    def __init__(self, cache_dir="../cache/responses", mode="on", max_bytes=2 * 1024 ** 3):
+        assert mode in ("on", "replay", "off"), f"Unknown cache mode: {mode}"
+        self.cache_dir = cache_dir
+        self.mode = mode
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._size = None  # Computed on first write
+
+    @property
+    def enabled(self):
+        return self.mode != "off"
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + ".json")
+
+    def get(self, key):
+        """Return the cached response body, or None on a miss"""
+        if not self.enabled:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, "r") as f:
+                body = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            body = None
+        if body is None:
+            self.misses += 1
+            if self.mode == "replay":
+                raise CacheMiss(f"<ResponseCache> No cached response for {key}")
+            return None
+        os.utime(path)  # Mark as recently used for eviction
+        self.hits += 1
+        return body
+
+    def put(self, key, body):
+        if self.mode != "on":
+            return
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)  # Atomic, so readers never see partial files
+        if self._size is None:
+            self._size = self.disk_usage()
+        else:
+            self._size += len(data)
+        if self._size > self.max_bytes:
+            self.evict()
+
+    def _entries(self):
+        entries = []
+        if not os.path.exists(self.cache_dir):
+            return entries
+        for shard in os.scandir(self.cache_dir):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if entry.name.endswith(".json"):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def disk_usage(self):
+        return sum(size for _, size, _ in self._entries())
+
+    def evict(self, target_ratio=0.9):
+        """Delete least recently used entries until the cache is below target_ratio * max_bytes"""
+        entries = sorted(self._entries())
+        size = sum(size for _, size, _ in entries)
+        removed = 0
+        for _, entry_size, path in entries:
+            if size <= self.max_bytes * target_ratio:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            size -= entry_size
+            removed += 1
+        self._size = size
+        print(f"<ResponseCache> Evicted {removed} entries, {size / 1024 ** 2:.1f} MB left")
+
+    def summary(self):
+        return {"mode": self.mode, "hits": self.hits, "misses": self.misses}
+
+    def store_batch_results(self, input_paths, output_path, model, is_valid=None):
+        """
+        Cache the bodies of a downloaded batch output file, keyed by their batch input requests.
+        Bodies for which is_valid(body) is False are left out, so that their requests are sent again.
+        """
+        if self.mode != "on":
+            return 0
+        requests = {}
+        for input_path in input_paths:
+            with open(input_path, "r") as f:
+                for line in f:
+                    request = json.loads(line)
+                    requests[request["custom_id"]] = request["body"]
+        stored = 0
+        with open(output_path, "r") as f:
+            for line in f:
+                result = json.loads(line)
+                response = result.get("response") or {}
+                if response.get("status_code", 200) != 200 or result["custom_id"] not in requests:
+                    continue
+                if is_valid is not None and not is_valid(response["body"]):
+                    continue
+                body = requests[result["custom_id"]]
+                self.put(batch_request_key(body, model), response["body"])
+                stored += 1
+        return stored
+
+def batch_request_key(body, model):
+    """Key of a batch request body under the resolved model name"""
+    params = {k: v for k, v in body.items() if k not in ("model", "messages")}
+    return request_key(model, body["messages"], params)
@@ -0,0 +1,245 @@
+import argparse
+import json
+import os
+import time
+from collections import defaultdict
+
+from context_budget import get_context_budget
+
+# Per-turn request metrics: time to first token, latency, token counts. Each output dir gets a
+# metrics.jsonl sidecar with one line per request actually sent (cached responses are not logged).
+
+USAGE_FIELDS = ["prompt_tokens", "completion_tokens", "reasoning_tokens", "cached_tokens"]
+
+def stream_kwargs(stream):
+    if stream:
+        return {"stream": True, "stream_options": {"include_usage": True}}
+    return {"stream": False}
+
+def usage_metrics(usage):
+    """Token counts of a usage dict. Cached tokens are reported by OpenAI and DeepSeek under different names"""
+    usage = usage or {}
+    completion_details = usage.get("completion_tokens_details") or {}
+    prompt_details = usage.get("prompt_tokens_details") or {}
+    return {
+        "prompt_tokens": usage.get("prompt_tokens"),
+        "completion_tokens": usage.get("completion_tokens"),
+        "reasoning_tokens": completion_details.get("reasoning_tokens"),
+        "cached_tokens": prompt_details.get("cached_tokens", usage.get("prompt_cache_hit_tokens"))
+    }
+
+def response_metrics(response, start):
+    """Metrics of a non-streamed chat completion"""
+    metrics = {"stream": False, "ttft": None, "reasoning_time": None, "latency": time.perf_counter() - start}
+    metrics.update(usage_metrics(response.model_dump().get("usage")))
+    return metrics
+
+class StreamAccumulator:
+    """Rebuilds a chat completion body from its chunks, timing the first reasoning and answer tokens"""
+    def __init__(self, start):
+        self.start = start
+        self.content = []
+        self.reasoning = []
+        self.first_token = None
+        self.first_answer_token = None
+        self.first_reasoning_token = None
+        self.finish_reason = None
+        self.usage = None
+        self.meta = {}
+        self.early_stop = False
+
+    def add(self, chunk):
+        """Add a chunk. Return the answer text it carries"""
+        answer = ""
+        chunk = chunk.model_dump()
+        if not self.meta:
+            self.meta = {"id": chunk.get("id"), "created": chunk.get("created"), "model": chunk.get("model")}
+        if chunk.get("usage"):
+            self.usage = chunk["usage"]
+        for choice in chunk.get("choices") or []:
+            delta = choice.get("delta") or {}
+            now = time.perf_counter() - self.start
+            if delta.get("reasoning_content"):
+                if self.first_reasoning_token is None:
+                    self.first_reasoning_token = now
+                self.reasoning.append(delta["reasoning_content"])
+            if delta.get("content"):
+                if self.first_answer_token is None:
+                    self.first_answer_token = now
+                self.content.append(delta["content"])
+                answer = delta["content"]
+            if self.first_token is None and (delta.get("content") or delta.get("reasoning_content")):
+                self.first_token = now
+            if choice.get("finish_reason"):
+                self.finish_reason = choice["finish_reason"]
+        return answer
+
+    def stop(self, detector):
+        """Keep the answer up to the end of the answer line found by the detector"""
+        self.content = [detector.text]
+        self.early_stop = True
+
+    def result(self):
+        """Return the chat completion body and the metrics of the stream"""
+        message = {"role": "assistant", "content": "".join(self.content)}
+        if self.reasoning:
+            message["reasoning_content"] = "".join(self.reasoning)
+        body = {
+            **self.meta,
+            "object": "chat.completion",
+            "choices": [{"index": 0, "finish_reason": self.finish_reason or "stop", "message": message}]
+        }
+        if self.usage is not None:
+            body["usage"] = self.usage
+        reasoning_time = None
+        if self.first_reasoning_token is not None and self.first_answer_token is not None:
+            reasoning_time = self.first_answer_token - self.first_reasoning_token
+        metrics = {
+            "stream": True,
+            "early_stop": self.early_stop,
+            "ttft": self.first_token,
+            "reasoning_time": reasoning_time,
+            "latency": time.perf_counter() - self.start
+        }
+        metrics.update(usage_metrics(self.usage))
+        if self.usage is None:  # Usage only comes with the last chunk, so not after an early stop
+            estimate_usage(metrics, body)
+        return body, metrics
+
+def estimate_usage(metrics, body):
+    """Count the completion tokens of a body with the model's tokenizer, if its context window is known"""
+    budget = get_context_budget(body.get("model") or "")
+    if budget is None:
+        return
+    message = body["choices"][0]["message"]
+    metrics["completion_tokens"] = budget.count(message.get("reasoning_content", "") + message["content"])
+    metrics["usage_estimated"] = True
+
+def consume_stream(stream, start, detector=None):
+    """Read a chat completion stream. With an AnswerDetector, the stream is closed once the answer is complete"""
+    accumulator = StreamAccumulator(start)
+    for chunk in stream:
+        answer = accumulator.add(chunk)
+        if detector is not None and detector.feed(answer):
+            stream.close()
+            accumulator.stop(detector)
+            break
+    return accumulator.result()
+
+async def aconsume_stream(stream, start, detector=None):
+    accumulator = StreamAccumulator(start)
+    async for chunk in stream:
+        answer = accumulator.add(chunk)
+        if detector is not None and detector.feed(answer):
+            await stream.close()
+            accumulator.stop(detector)
+            break
+    return accumulator.result()
+
+def get_metrics_path(output_dir):
+    return os.path.join(output_dir, "metrics.jsonl")
+
+def append_metrics(output_dir, fname, idx, model, metrics):
+    with open(get_metrics_path(output_dir), 'a') as file:
+        file.write(json.dumps({
+            "case": fname.split('.')[0],
+            "idx": idx,
+            "model": model,
+            "time": time.time(),
+            **metrics
+        }) + "\n")
+
+def load_metrics(output_dir):
+    records = []
+    path = get_metrics_path(output_dir)
+    if not os.path.exists(path):
+        return records
+    with open(path, 'r') as file:
+        for line in file:
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:  # Torn write from a crash
+                continue
+    return records
+
+def percentile(values, q):
+    values = sorted(v for v in values if v is not None)
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+def summarize(records):
+    """Aggregate per-turn metrics: latency percentiles, throughput and token totals"""
+    def total(field):
+        return sum(record.get(field) or 0 for record in records)
+
+    latency = total("latency")
+    prompt_tokens = total("prompt_tokens")
+    generation_time = sum(
+        record["latency"] - (record.get("ttft") or 0) for record in records if record.get("completion_tokens")
+    )
+    return {
+        "turns": len(records),
+        "ttft_p50": percentile([record.get("ttft") for record in records], 0.5),
+        "ttft_p95": percentile([record.get("ttft") for record in records], 0.95),
+        "latency_p50": percentile([record.get("latency") for record in records], 0.5),
+        "latency_p95": percentile([record.get("latency") for record in records], 0.95),
+        "latency_total": latency,
+        "reasoning_time": total("reasoning_time"),
+        "early_stops": sum(bool(record.get("early_stop")) for record in records),
+        # Turns sent a second time by hedging.py, the hedges that answered first, and the latency with them
+        "hedged": sum(bool(record.get("hedged")) for record in records),
+        "hedge_wins": sum(bool(record.get("hedge_won")) for record in records),
+        "turn_latency_p95": percentile([record.get("turn_latency", record.get("latency")) for record in records], 0.95),
+        "tokens_per_second": total("completion_tokens") / generation_time if generation_time > 0 else None,
+        **{field: total(field) for field in USAGE_FIELDS},
+        # Share of the prompt tokens read from the provider's prompt cache, billed at a discount
+        "cache_hit_rate": total("cached_tokens") / prompt_tokens if prompt_tokens else None
+    }
+
+def format_number(value, digits=1):
+    if value is None:
+        return "-"
+    if isinstance(value, float):
+        return f"{value:.{digits}f}"
+    return str(value)
+
+def print_summaries(rows, key_name):
+    columns = [
+        ("turns", 6), ("ttft_p50", 9), ("ttft_p95", 9), ("latency_p50", 12), ("latency_p95", 12),
+        ("latency_total", 14), ("reasoning_time", 15), ("early_stops", 12), ("hedged", 8), ("hedge_wins", 11),
+        ("turn_latency_p95", 17), ("tokens_per_second", 18),
+        ("prompt_tokens", 14), ("cached_tokens", 14), ("cache_hit_rate", 15), ("completion_tokens", 18),
+        ("reasoning_tokens", 17)
+    ]
+    width = max([len(key_name)] + [len(key) for key, _ in rows]) + 2
+    print(f"{key_name:<{width}}" + "".join(f"{name:>{size}}" for name, size in columns))
+    for key, summary in rows:
+        print(f"{key:<{width}}" + "".join(f"{format_number(summary[name]):>{size}}" for name, size in columns))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Summarize the request metrics of runs')
+    parser.add_argument('output_dirs', nargs='*', help='output dirs, defaults to every dir in --output_root with metrics')
+    parser.add_argument('--output_root', type=str, default='../output')
+    parser.add_argument('--by', type=str, default='run', choices=['run', 'model', 'case'], help='aggregation level')
+    parser.add_argument('--top', type=int, default=None, help='only print the N rows with the most total latency')
+    args = parser.parse_args()
+
+    output_dirs = args.output_dirs or [
+        os.path.join(args.output_root, output) for output in sorted(os.listdir(args.output_root))
+        if os.path.exists(get_metrics_path(os.path.join(args.output_root, output)))
+    ]
+    groups = defaultdict(list)
+    for output_dir in output_dirs:
+        run = os.path.basename(os.path.normpath(output_dir))
+        for record in load_metrics(output_dir):
+            if args.by == "run":
+                groups[run].append(record)
+            elif args.by == "model":
+                groups[record["model"]].append(record)
+            else:
+                groups[f"{run}/{record['case']}"].append(record)
+    rows = [(key, summarize(records)) for key, records in groups.items()]
+    if args.top is not None:
+        rows = sorted(rows, key=lambda row: -row[1]["latency_total"])[:args.top]
+    print_summaries(rows, args.by)
@@ -1,20 +1,48 @@
 import json
 import os
+import hashlib
+import functools
 import asyncio
 import re
+import threading
 import argparse
+import time
 import traceback
 from datetime import datetime
 
+from rate_control import get_controller
+from hedging import get_hedger
+from response_cache import ResponseCache, request_key, batch_request_key
+from prompt_compiler import CompiledCase, Conversation, LAYOUTS
+from context_budget import get_context_budget, ApproxTokenizer
+from dataset_image import read_case
+from output_store import write_outputs
+from run_metrics import stream_kwargs, response_metrics, consume_stream, aconsume_stream, append_metrics, load_metrics
+from answer_detector import AnswerDetector, make_stopping_criteria
+from shards import parse_shard, balance_shards, get_shard_dir, prepare_shard_dir
+from scheduler import SCHEDULES, load_cost_model, turn_cost, predict_makespan, format_makespan, schedule as schedule_jobs
+
 def parse_arguments():
     parser = argparse.ArgumentParser(description='')
     # General args
     parser.add_argument('-m', '--model', type=str, help='model name')
     parser.add_argument('-p', '--prompt', type=str, help='prompt name')
-    parser.add_argument('--context', type=str, help='full, sum')
+    parser.add_argument('--context', type=str, help='full, sum, retrieve, conversation')
     parser.add_argument('--case', type=str, default="ALL", help='If ALL, run all cases; if a case number like 3-4-1, run that case; if a case number followed by a "+" like 3-4-1+, run that case and all cases after it.')
     parser.add_argument('--no_description', action='store_true')
+    parser.add_argument('--layout', type=str, default='default', choices=LAYOUTS, help='Order of the prompt sections: default (story first) or cache (most shared first, for provider prompt caching)')
     parser.add_argument('--data', type=str, default='aceattorney', help='dataset name, aceattorney or danganronpa')
+    parser.add_argument('--cache', type=str, default='on', choices=['on', 'replay', 'off'], help='Response cache mode: on (read and write), replay (read only, fail on misses) or off')
+    parser.add_argument('--concurrency', type=int, default=None, help='If set, run API models asynchronously with at most this many requests in flight across cases')
+    parser.add_argument('--schedule', type=str, default='longest', choices=SCHEDULES, help='With --concurrency, send the turns predicted to take longest first (longest) or in filename order (fifo)')
+    parser.add_argument('--stream', action='store_true', help='Stream responses, recording time to first token in metrics.jsonl')
+    parser.add_argument('--early_stop', action='store_true', help='End each response as soon as its answer json line is complete')
+    parser.add_argument('--prefix_cache', action='store_true', help='For Hugging Face models, reuse the KV cache of the prompt prefix shared with the previous prompt')
+    parser.add_argument('--batch_size', type=int, default=None, help='For Hugging Face models, generate up to this many turn prompts of similar length at once, across cases')
+    parser.add_argument('--shard', type=str, default=None, help='i/N: only run the i-th (from 0) of N parts of the cases, balanced by prompt tokens, into <output_dir>/shards/<i>of<N>; see shards.py')
+    parser.add_argument('--server', type=str, default=None, help='For Hugging Face models, base url of a running model_server.py, e.g. http://127.0.0.1:8001/v1, instead of loading the model')
+    parser.add_argument('--timeout', type=float, default=None, help='For API models, seconds before a request is given up on and sent again. It is retried like any timeout, up to 8 times with backoff, so a turn can take about 9 times this long')
+    parser.add_argument('--hedge', action='store_true', help='For API models, send a second request for turns still unanswered after the p95 latency of the model, keeping the first valid answer')
 
     # Evaluation args
     parser.add_argument('-a', '--all', action='store_true', help='Evaluate all existing models')
@@ -22,20 +50,43 @@ def parse_arguments():
 
 # OS operations
 
-def get_output_dir(MODEL, PROMPT, CONTEXT, CASE, NO_DESCRIPTION, DATA):
+def get_output_dir(MODEL, PROMPT, CONTEXT, CASE, NO_DESCRIPTION, DATA, LAYOUT="default"):
     output_dir = f'../output/{MODEL.split("/")[-1]}_prompt_{PROMPT}'
     if CONTEXT is not None:
         output_dir += f"_context_{CONTEXT}"
     if NO_DESCRIPTION:
         output_dir += "_desc_none"    
+    if LAYOUT != "default":
+        output_dir += f"_layout_{LAYOUT}"
     if CASE != "ALL":
         output_dir += f"_case_{CASE}"
     if DATA == 'danganronpa':
         output_dir += f"_data_{DATA}"
     return output_dir
 
-def get_fnames(data_dir, output_dir, CASE, eval=False, verbose=True):
-    """Return list of .json files"""
+def prepare_output_dir(MODEL, PROMPT, CONTEXT, CASE, NO_DESCRIPTION, DATA, LAYOUT="default"):
+    """Make the output dir of a run and write its metadata.json"""
+    output_dir = get_output_dir(MODEL, PROMPT, CONTEXT, CASE, NO_DESCRIPTION, DATA, LAYOUT)
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    with open(os.path.join(output_dir, 'metadata.json'), 'w') as file:
+        json.dump({
+            'model': MODEL,
+            'prompt': PROMPT,
+            'context': "none" if CONTEXT is None else CONTEXT,
+            'case': CASE if CASE != "ALL" else "all",
+            'no_description': NO_DESCRIPTION,
+            'layout': LAYOUT,
+            'data': DATA,
+            'timestamp': datetime.now().strftime("%Y%m%d_%H%M%S")
+        }, file, indent=2)
+    return output_dir
+
+def get_fnames(data_dir, output_dir, CASE, eval=False, verbose=True, shard=None, cost=None):
+    """
+    Return list of .json files. With shard (i, N), only the i-th of N parts of the cases,
+    balanced by cost(fname), and cases done in the dir of that shard are skipped too.
+    """
     all_fnames = sorted([
         fname for fname 
         in os.listdir(data_dir) 
@@ -56,10 +107,17 @@ def get_fnames(data_dir, output_dir, CASE, eval=False, verbose=True):
 
     if verbose: print(f"<get_fnames> Found {len(fnames)} total cases")
 
+    done_dirs = [output_dir]
+    if shard is not None:  # Split all cases of the run, done or not, so that every worker gets the same split
+        costs = dict(zip(fnames, map(cost, fnames)))
+        fnames = balance_shards(fnames, shard[1], [costs[fname] for fname in fnames])[shard[0]]
+        done_dirs.append(get_shard_dir(output_dir, shard))
+        if verbose: print(f"<get_fnames> Shard {shard[0]}/{shard[1]} has {len(fnames)} cases, {sum(costs[fname] for fname in fnames)} of {sum(costs.values())} estimated prompt tokens")
+
     if not eval:
         fnames_to_check = fnames.copy()
         for fname in fnames_to_check:
-            if os.path.exists(os.path.join(output_dir, fname.split('.')[0] + '.jsonl')):
+            if any(os.path.exists(os.path.join(done_dir, fname.split('.')[0] + '.jsonl')) for done_dir in done_dirs):
                 # print(f"Skipping existing {fname.split('.')[0] + '.jsonl'}")
                 fnames.remove(fname)
 
@@ -68,7 +126,9 @@ def get_fnames(data_dir, output_dir, CASE, eval=False, verbose=True):
 
 # Prompt builders
 
+@functools.lru_cache(maxsize=None)
 def build_prompt_prefix_suffix(prompt_arg):
+    """Load a prompt template once per process"""
     with open("prompts/" + prompt_arg + ".json", 'r') as file:
         # parse json
         data = json.load(file)
@@ -89,47 +149,31 @@ def build_prompt_prefix_suffix(prompt_arg):
     return prompt_prefix, prompt_suffix
 
 def parse_json(file_path):
-    with open(file_path, 'r') as file:
-        data = json.load(file)
-        characters = []
-        evidences = []
-        prev_context = re.sub(r'\n+', ' ', data.get("previousContext", ""))  # Remove newlines
-
-        for character in data.get('characters', {}):
-            characters.append(character)
-        for evidence in data.get('evidences', {}):
-            evidences.append(evidence)
-        turns = []
-        for turn in data.get("turns", []):
-            if turn["noPresent"]:
-                continue
-            testimonies = []
-            for testimony in turn['testimonies']:
-                testimonies.append(testimony)
-            turn_dict = {
-                'characters': characters,
-                'evidences': evidences,
-                'testimonies': testimonies,
-                'newContext': re.sub(r'\n+', ' ', turn['newContext']),
-                'summarizedContext': turn.get('summarizedContext', "")
-            }
-            turns.append(turn_dict)
-        return turns, prev_context
-
-def truncate_context(context, MODEL):
-    context_size = len(context)  # Count characters, not tokens
-
-    # Truncate context for specific models
-    max_context_size = -1
-    if "deepseek" in MODEL or "deepseek-chat" in MODEL:  # Roughly 66000 tokens for deepseek
-        max_context_size = 230000
-    # elif "70b" in MODEL:  # Roughtly 20000 tokens for 70b
-    #     max_context_size = 80000
-    if max_context_size != -1:
-        start_idx = context_size - max_context_size
-        context = "..." + context[start_idx:]
-
-    return context
+    data = read_case(file_path)
+    characters = []
+    evidences = []
+    prev_context = re.sub(r'\n+', ' ', data.get("previousContext", ""))  # Remove newlines
+
+    for character in data.get('characters', {}):
+        characters.append(character)
+    for evidence in data.get('evidences', {}):
+        evidences.append(evidence)
+    turns = []
+    for turn in data.get("turns", []):
+        if turn["noPresent"]:
+            continue
+        testimonies = []
+        for testimony in turn['testimonies']:
+            testimonies.append(testimony)
+        turn_dict = {
+            'characters': characters,
+            'evidences': evidences,
+            'testimonies': testimonies,
+            'newContext': re.sub(r'\n+', ' ', turn['newContext']),
+            'summarizedContext': turn.get('summarizedContext', "")
+        }
+        turns.append(turn_dict)
+    return turns, prev_context
 
 def build_prompt(
     turns, 
@@ -140,80 +184,24 @@ def build_prompt(
     NO_DESCRIPTION, 
     MODEL
 ):
-    prompts = []
-    context_sofar = ""
-    for turn in turns:
-        context_is_added = False
-        new_context = turn['newContext']  
-        new_context = re.sub(r'\n+', ' ', new_context)  # Remove newlines
-        context_sofar += new_context
-        if CONTEXT is None:
-            prompt = ""
-        else:
-            prompt = "Story:\n"
-            full_context = "" 
-            if CONTEXT == "full":
-                full_context += prev_context + "\n" + context_sofar + "\n"
-            elif CONTEXT == "sum":
-                full_context += turn['summarizedContext'] + "\n"
-
-            full_context = truncate_context(full_context, MODEL)
-
-            prompt += full_context
-
-        character_counter = 0
-        prompt += "Characters:\n"
-        for character in turn['characters']:
-            prompt += f"Character {character_counter}\n"
-            prompt += f"Name: {character['name']}\n"
-            if not NO_DESCRIPTION:
-                prompt += f"Description: {character['description1']}\n"
-            character_counter += 1
-
-        # Format evidences
-        evidence_counter = 0
-        evidences = []
-        for evidence in turn['evidences']:
-            evidence_string = f"Evidence {evidence_counter}\n"
-            evidence_string += f"Name: {evidence['name']}\n"
-            if not NO_DESCRIPTION:
-                evidence_string += f"Description: "
-                descriptions = []
-                for key in evidence.keys():
-                    if 'description' in key:
-                        descriptions.append(evidence[key])
-                evidence_string += " ".join(descriptions) + "\n"
-            evidences.append(evidence_string)
-            evidence_counter += 1
-        
-        # Format testimonies
-        testimony_counter = 0
-        testimonies = []
-        for testimony in turn['testimonies']:
-            testimony_string = f"Testimony {testimony_counter}\n"
-            testimony_string += f"Testimony: {testimony['testimony']}\n"
-            testimony_string += f"Person: {testimony['person']}\n"
-            # Provide context if needed
-            if "source" in testimony and \
-                testimony["source"].get("is_self_contained", "yes") == "no" and \
-                CONTEXT is None:
-                context_span = testimony["source"]["context_span"]
-                if not context_is_added and not NO_DESCRIPTION:
-                    for i, evidence_string in enumerate(evidences):
-                        evidence_spans = testimony["source"]["evidence_span"]
-                        if isinstance(evidence_spans, str):
-                            evidence_spans = [evidence_spans]
-                        for evidence_span in evidence_spans:
-                            if evidence_span in evidence_string: # Find evidence
-                                evidences[i] += f"{context_span}\n"  # Add context span
-                    context_is_added = True
-            testimony_counter += 1
-            testimonies.append(testimony_string)
-        
-        # Build rest of the prompt
-        prompt += f"Evidences:\n{''.join(evidences)}\nTestimonies:\n{''.join(testimonies)}\n"
-        prompts.append(PROMPT_PREFIX + prompt + PROMPT_SUFFIX)
-    return prompts
+    if not turns:
+        return []
+    return CompiledCase(turns, prev_context).build(PROMPT_PREFIX, PROMPT_SUFFIX, CONTEXT, NO_DESCRIPTION, MODEL)
+
+@functools.lru_cache(maxsize=None)
+def load_case(file_path):
+    """
+    Parse a case once per process. The compiled case keeps its prompt fragments, so every
+    prompt/context/description setting run in the same process reuses them.
+    """
+    return CompiledCase(*parse_json(file_path))
+
+def estimate_case_tokens(file_path, PROMPT, CONTEXT, NO_DESCRIPTION, MODEL, LAYOUT="default"):
+    """Approximate input tokens of all turns of a case, to balance shards. Conversations count as full context"""
+    prompt_prefix, prompt_suffix = build_prompt_prefix_suffix(PROMPT)
+    context = "full" if CONTEXT == "conversation" else CONTEXT
+    prompts = load_case(file_path).build(prompt_prefix, prompt_suffix, context, NO_DESCRIPTION, MODEL, LAYOUT)
+    return sum(ApproxTokenizer().count(prompt) for prompt in prompts)
 
 # Model runners
 
@@ -234,73 +222,323 @@ def get_json_answer(multiline_string):
             cot = ""
     return json_answer, cot
 
-def run_model(prompts, client, client_name):
+class SentRequest:
+    """
+    A chat completion read within its request: the parsed response and its metrics, with the headers
+    of the raw response for the rate controller. `streamed` is the (body, metrics) read from a stream.
+    """
+    def __init__(self, raw, start, streamed=None):
+        from openai.types.chat import ChatCompletion
+
+        self.headers = raw.headers
+        if streamed is not None:
+            self.response = ChatCompletion.model_validate(streamed[0])
+            self.metrics = streamed[1]
+        else:
+            self.response = raw.parse()
+            self.metrics = response_metrics(self.response, start)
+
+def read_answer(full_answer, cot=""):
+    """Return the json answer of a model answer, its COT, and whether no json answer was found"""
+    answer_json, parsed_cot = get_json_answer(full_answer)
+    if cot == "":  # Only when model does not return its COT field
+        cot = parsed_cot
+    return answer_json, cot, answer_json == {}
+
+def request_params(client_name):
+    """Sampling params of the requests of a model: those of the Kani path for a Hugging Face model on a --server"""
+    return dict(LOCAL_HYPERPARAMS) if get_provider(client_name) == "local" else {}
+
+def chat_request(client_name, messages, stream):
+    """Arguments of the chat completion request of a turn"""
+    return {"model": client_name, "messages": messages, **request_params(client_name), **stream_kwargs(stream)}
+
+def cache_params(params, early_stop):
+    """
+    Params of the cache key of a request. A response stopped at its answer line is cut short,
+    so it is cached apart from full responses, whose keys stay as they were
+    """
+    return {**params, "early_stop": True} if early_stop else params
+
+def cached_response(cache, key):
+    """The cached chat completion of a request, or None"""
+    body = cache.get(key) if cache is not None else None
+    if body is None:
+        return None
+    from openai.types.chat import ChatCompletion
+    return ChatCompletion.model_validate(body)
+
+def record_response(response, metrics, hedge_metrics, key, cache=None, on_metrics=None):
+    """
+    Report the metrics of a chat completion that was sent, and cache it if it holds an answer,
+    so that a rerun samples a failed turn again instead of replaying it
+    """
+    metrics.update(hedge_metrics)
+    if on_metrics is not None:
+        on_metrics(metrics)
+    if cache is not None and has_answer(response):
+        cache.put(key, response.model_dump(exclude_unset=True))
+
+def is_answered(text):
+    """Whether a model answer ends with a json answer line"""
+    try:
+        return bool(text) and get_json_answer(text)[0] != {}
+    except IndexError:  # A single line that is not json
+        return False
+
+def has_answer(response):
+    """Whether a chat completion ends with a json answer line"""
+    return is_answered(response.choices[0].message.content)
+
+def body_has_answer(body):
+    """Same as has_answer for a chat completion body, as cached"""
+    try:
+        return is_answered(body["choices"][0]["message"]["content"])
+    except (KeyError, IndexError, TypeError):
+        return False
+
+def parse_openai_response(response, client_name):
+    """Return the full answer text, prepending the COT field when the api provides one"""
+    full_answer = response.choices[0].message.content
+    cot = ""
+
+    # Get COT
+    try: 
+        cot = response.choices[0].message.reasoning_content
+        print(f"<run_model> COT returned for {client_name}")
+        full_answer = cot + "\n\n" + full_answer
+    except Exception as e:
+        print(f"<run_model> When trying to get COT for {client_name}: {e}")
+        print(f"<run_model> No COT for {client_name}")
+        cot = ""
+
+    return full_answer, cot
+
+async def kani_usage_metrics(client, message):
+    """
+    Token counts of a local model turn, as far as its engine can count them. The prompt is
+    measured as sent: the system prompt, the session history and the query.
+    """
+    try:
+        return {
+            "prompt_tokens": await client.engine.prompt_len(client.always_included_messages + client.chat_history[:-1]),
+            "completion_tokens": client.engine.message_len(message),
+            "reasoning_tokens": None,
+            "cached_tokens": client.engine.prefix_cache.last["cached_tokens"] if hasattr(client.engine, "prefix_cache") else None
+        }
+    except Exception:
+        return {}
+
+SYSTEM_MESSAGE = "You are a helpful assistant."  # Same for every request, so that it is part of the cached prefix
+
+# Sampling of Hugging Face models, in the run, in batches or on a model_server.py. No max tokens: as
+# in Kani, generation may run to the end of the context window
+LOCAL_HYPERPARAMS = {"temperature": 0.6}
+
+def build_messages(prompt):
+    """Chat messages of a prompt. A list of messages (conversation mode) is sent as is"""
+    if isinstance(prompt, list):
+        return prompt
+    return [
+        {"role": "system", "content": SYSTEM_MESSAGE},
+        {"role": "user", "content": prompt},
+    ]
+
+def local_messages(prompt):
+    """Chat messages of a prompt as the Kani session of a Hugging Face model sends them, with its empty system prompt"""
+    return [message for message in build_messages(prompt) if message["role"] != "system"]
+
+def api_messages(prompt, client_name):
+    """Chat messages of a prompt for an API model. A Hugging Face model on a --server gets those of the Kani path"""
+    return local_messages(prompt) if get_provider(client_name) == "local" else build_messages(prompt)
+
+def start_kani_session(client, prompt):
+    """
+    Start the session of a prompt on a Kani client: its history is replaced by the earlier turns of
+    the prompt's conversation, or emptied for a single prompt, so that nothing of the previous
+    prompts is sent again. Return the query of the turn.
+    """
+    if not isinstance(prompt, list):
+        client.chat_history = []
+        return prompt
+    from kani import ChatMessage
+    client.chat_history = [
+        ChatMessage.user(message["content"]) if message["role"] == "user" else ChatMessage.assistant(message["content"])
+        for message in prompt[:-1] if message["role"] != "system"
+    ]
+    return prompt[-1]["content"]
+
+_local = threading.local()
+
+def run_local(coroutine):
+    """
+    Run a coroutine of a local model on the event loop of the current thread, created once and
+    kept for the whole run instead of one loop per prompt
+    """
+    if getattr(_local, "loop", None) is None or _local.loop.is_closed():
+        _local.loop = asyncio.new_event_loop()
+    return _local.loop.run_until_complete(coroutine)
+
+def run_model(prompts, client, client_name, cache=None, on_turn=None, stream=False, on_metrics=None, early_stop=False):
+    """
+    Answer the prompts in order. `on_turn(i, answer_json, cot)` is called for each turn answered without error,
+    and `on_metrics(i, metrics)` for each request sent to the model. With early_stop, generation ends as soon
+    as the answer line is complete (API responses are then streamed). API requests get the deadline and
+    hedging of the model's hedger, see hedging.py.
+    """
+    stream = stream or (early_stop and type(client).__name__ != "Kani")
     has_error = False
     answer_jsons = []
     cots = []
-    for prompt in prompts:
+    for i, prompt in enumerate(prompts):
         #print(prompt)
         try:
             cot = ""
             if type(client).__name__ == "Kani":  # Use kani api
-                async def run_async_model():
-                    response = await client.chat_round_str(prompt, temperature=0.6)
-                    #print(response)
-                    return response
-
-                full_answer = asyncio.run(run_async_model())
+                messages = local_messages(prompt)
+                key = request_key(client_name, messages, cache_params(LOCAL_HYPERPARAMS, early_stop))
+                body = cache.get(key) if cache is not None else None
+                if body is None:
+                    query = start_kani_session(client, prompt)
+
+                    async def run_async_model():
+                        hyperparams = dict(LOCAL_HYPERPARAMS)
+                        if early_stop:
+                            hyperparams["stopping_criteria"] = make_stopping_criteria(client.engine.tokenizer)
+                        start = time.perf_counter()
+                        ttft = None
+                        if stream:
+                            stream_manager = client.chat_round_stream(query, **hyperparams)
+                            async for token in stream_manager:
+                                if ttft is None and token:
+                                    ttft = time.perf_counter() - start
+                            message = await stream_manager.message()
+                        else:
+                            message = await client.chat_round(query, **hyperparams)
+                        #print(message.text)
+                        metrics = {"stream": stream, "early_stop": early_stop, "ttft": ttft, "reasoning_time": None, "latency": time.perf_counter() - start}
+                        metrics.update(await kani_usage_metrics(client, message))
+                        return message.text, metrics
+
+                    full_answer, metrics = run_local(run_async_model())
+                    if on_metrics is not None:
+                        on_metrics(i, metrics)
+                    if cache is not None and is_answered(full_answer):
+                        cache.put(key, {"choices": [{"message": {"role": "assistant", "content": full_answer}}]})
+                else:
+                    full_answer = body["choices"][0]["message"]["content"]
 
             elif type(client).__name__ == "OpenAI":  # Use openai api
-                response = client.chat.completions.create(
-                    model=client_name,
-                    messages=[
-                    {"role": "system", "content": "You are a helpful assistant"},
-                    {"role": "user", "content": prompt},
-                ],
-                    stream=False
-                )
-                full_answer = response.choices[0].message.content
-
-                # Get COT
-                try: 
-                    cot = response.choices[0].message.reasoning_content
-                    print(f"<run_model> COT returned for {client_name}")
-                    full_answer = cot + "\n\n" + full_answer
-                except Exception as e:
-                    print(f"<run_model> When trying to get COT for {client_name}: {e}")
-                    print(f"<run_model> No COT for {client_name}")
+                messages = api_messages(prompt, client_name)
+                key = request_key(client_name, messages, cache_params(request_params(client_name), early_stop))
+                response = cached_response(cache, key)
+                if response is None:
+                    controller = get_controller(get_provider(client_name))
+                    hedger = get_hedger(client_name)
+                    def attempt(timer):
+                        def send():  # Keeps its state local, as a request given up on may still finish in its thread
+                            start = time.perf_counter()  # Not counting rate limit waits
+                            raw = client.chat.completions.with_raw_response.create(**chat_request(client_name, messages, stream))
+                            if stream:  # Read within the deadline, and retried with the request
+                                return SentRequest(raw, start, consume_stream(raw.parse(), start, AnswerDetector() if early_stop else None))
+                            return SentRequest(raw, start)
+                        def request():
+                            timer["start"] = time.perf_counter()  # When the hedge delay starts
+                            return hedger.call(send, controller)
+                        sent = controller.call(request)
+                        return sent.response, sent.metrics
+                    (response, metrics), hedge_metrics = hedger.run(attempt, lambda result: has_answer(result[0]))
+                    record_response(response, metrics, hedge_metrics, key, cache,
+                                    None if on_metrics is None else lambda metrics: on_metrics(i, metrics))
+                full_answer, cot = parse_openai_response(response, client_name)
 
             else:
                 raise ValueError(f"<run_model> Unknown client: {client}")
 
-            answer_json, parsed_cot = get_json_answer(full_answer)
-
-            if answer_json == {}:
-                has_error = True
+            answer_json, cot, turn_error = read_answer(full_answer, cot)
 
-            if cot == "":  # Only when model does not return its COT field
-                cot = parsed_cot
-                
         except Exception as e:  # Handle errors, such as rate limit, context window, etc.
             print(f"<run_model> {traceback.format_exc()}")
             answer_json, cot = {}, ""
+            turn_error = True
+
+        if turn_error:
             has_error = True
+        elif on_turn is not None:
+            on_turn(i, answer_json, cot)
 
         answer_jsons.append(answer_json)
         cots.append(cot)
 
     return answer_jsons, cots, has_error
 
-def load_model(model, config_path="models.json"):
+async def run_model_async(prompt, client, client_name, semaphore, cache=None, stream=False, on_metrics=None, early_stop=False):
+    """
+    Answer a single turn prompt with an AsyncOpenAI client, holding one of the in-flight slots
+    (for the whole stream when streaming, and for its hedge). `on_metrics(metrics)` is called if a request is sent.
+    """
+    stream = stream or early_stop
+    controller = get_controller(get_provider(client_name))
+    hedger = get_hedger(client_name)
+    try:
+        messages = api_messages(prompt, client_name)
+        key = request_key(client_name, messages, cache_params(request_params(client_name), early_stop))
+        response = cached_response(cache, key)
+        if response is None:
+            async def attempt(timer):
+                async def send():
+                    start = time.perf_counter()  # Not counting rate limit waits
+                    raw = await client.chat.completions.with_raw_response.create(**chat_request(client_name, messages, stream))
+                    if stream:  # Read within the deadline, and retried with the request
+                        return SentRequest(raw, start, await aconsume_stream(raw.parse(), start, AnswerDetector() if early_stop else None))
+                    return SentRequest(raw, start)
+                def request():
+                    timer["start"] = time.perf_counter()  # When the hedge delay starts
+                    return hedger.acall(send)
+                sent = await controller.acall(request)
+                return sent.response, sent.metrics
+            async with semaphore:  # A hedge runs in the slot of its turn, under the rate controller like any request
+                (response, metrics), hedge_metrics = await hedger.arun(attempt, lambda result: has_answer(result[0]))
+            record_response(response, metrics, hedge_metrics, key, cache, on_metrics)
+        answer_json, cot, has_error = read_answer(*parse_openai_response(response, client_name))
+
+    except Exception as e:  # Handle errors, such as rate limit, context window, etc.
+        print(f"<run_model_async> {traceback.format_exc()}")
+        answer_json, cot = {}, ""
+        has_error = True
+
+    return answer_json, cot, has_error
+
+def get_provider(model):
+    """Return the api provider key of a resolved model name"""
+    if "/" in model:  # A huggingface model served by model_server.py
+        return "local"
+    if any(m_name in model for m_name in ["gpt", "o3", "o4"]):
+        return "openai"
+    elif "deepseek" in model:  # deepseek-reasoner (R1), deepseek-chat (V3)
+        return "deepseek"
+    return model
+
+def resolve_model(model, config_path="models.json"):
+    """Map a model acronym to its full name in models.json"""
     with open(config_path, 'r') as file:
         config = json.load(file)
-    model = config.get(model, model)
-    if "/" in model:  # a huggingface model
+    return config.get(model, model)
+
+def load_model(model, config_path="models.json", async_client=False, prefix_cache=False, server=None):
+    """
+    Return a client for the model and the name to send requests with. With a server url, Hugging Face
+    models are sent to that OpenAI-compatible endpoint (see model_server.py) instead of being loaded.
+    """
+    model = resolve_model(model, config_path)
+    if "/" in model and server is None:  # a huggingface model
         from kani import Kani
         from kani.engines.huggingface import HuggingEngine
         import torch
 
         torch.cuda.empty_cache()
+        if prefix_cache:  # Keeps the KV cache of the shared prompt prefix across turns and cases
+            from local_engine import PrefixCachingEngine as HuggingEngine
         engine = HuggingEngine(
             model_id = model, 
             use_auth_token=True, 
@@ -308,157 +546,524 @@ def load_model(model, config_path="models.json"):
         )
         client = Kani(engine, system_prompt="")
 
-        name = model.split("/")[-1]
+        # The resolved models.json name, which keys the response cache: checkpoints in different
+        # dirs with the same basename must not share entries
+        name = model
 
     else:  # an api model
         from dotenv import load_dotenv
-        from openai import OpenAI
+        if async_client:
+            from openai import AsyncOpenAI as OpenAI
+        else:
+            from openai import OpenAI
 
         load_dotenv("../.env")
 
-        model_key = model
-
-        if any(m_name in model for m_name in ["gpt", "o3", "o4"]):
-            model_key = "openai"
-
-        elif "deepseek" in model:  # deepseek-reasoner (R1), deepseek-chat (V3)
-            model_key = "deepseek"
+        model_key = get_provider(model)
 
         auth = {
+            "local": {
+                "api_key": "local",
+                "base_url": server,
+                "name": model,
+                # The server queues whatever it gets and batches it, so only bound the requests in flight
+                "rate_limit": {"requests_per_second": None, "initial_concurrency": 8, "max_concurrency": 64}
+            },
             "deepseek": {
                 "api_key": os.getenv("DEEPSEEK_API_KEY"),
                 "base_url": "https://api.deepseek.com",
-                "name": model
+                "name": model,
+                # DeepSeek does not publish hard limits, so start high and let AIMD find the ceiling
+                "rate_limit": {"requests_per_second": None, "initial_concurrency": 16, "max_concurrency": 256}
             },
             "openai": {
                 "api_key": os.getenv("OPENAI_API_KEY"),
-                "name": model
+                "name": model,
+                "rate_limit": {"requests_per_second": 8, "initial_concurrency": 4, "max_concurrency": 64}
             }
         }
 
+        # Retries are handled by the rate controller instead of the client
         if "base_url" in auth[model_key]:
             client = OpenAI(
                 api_key=auth[model_key]["api_key"],
-                base_url=auth[model_key]["base_url"]
+                base_url=auth[model_key]["base_url"],
+                max_retries=0
             )
         else:
             client = OpenAI(
                 api_key=auth[model_key]["api_key"],
+                max_retries=0
             )
+        get_controller(model_key, **auth[model_key]["rate_limit"])
 
         name = auth[model_key]["name"]
 
     return client, name
 
-def create_batch(fnames, MODEL, PROMPT, CONTEXT, NO_DESCRIPTION, data_dir):
+# OpenAI's limits are 50000 requests and 200 MB per batch input file
+BATCH_MAX_REQUESTS = 50000
+BATCH_MAX_BYTES = 190 * 1024 ** 2
+BATCH_FAILED_STATUSES = ("failed", "expired", "cancelled")
+
+def iter_batch_requests(fnames, MODEL, PROMPT, CONTEXT, NO_DESCRIPTION, data_dir, layout="default"):
+    """Yield the batch request of every turn, one case at a time"""
     max_token_key = "max_tokens" if "gpt" in MODEL else "max_completion_tokens"
     max_token_val = 1000 if "gpt" in MODEL else 7000
-    batch = []
+    budget = get_context_budget(MODEL)
+    if budget is not None:  # Same completion reserve as the prompt budget
+        max_token_val = budget.max_completion_tokens
     skip_count = 0
     for fname in fnames:
-        turns, prev_context = parse_json(os.path.join(data_dir, fname))
-        if turns == []:
+        case = load_case(os.path.join(data_dir, fname))
+        if case.turns == []:
             skip_count += 1
             continue
         PROMPT_PREFIX, PROMPT_SUFFIX = build_prompt_prefix_suffix(PROMPT)
-        prompts = build_prompt(turns, prev_context, PROMPT_PREFIX, PROMPT_SUFFIX, CONTEXT, NO_DESCRIPTION, MODEL)
+        prompts = case.build(PROMPT_PREFIX, PROMPT_SUFFIX, CONTEXT, NO_DESCRIPTION, MODEL, layout)
         # print(prompts)
         for i, prompt in enumerate(prompts):
-            request = {
+            yield {
                 "custom_id": f"{fname.split('.')[0]}_{i}",
                 "method": "POST",
                 "url": "/v1/chat/completions",
                 "body": {
                     "model": MODEL,
-                    "messages": [
-                        {"role": "system", "content": "You are a helpful assistant."}, 
-                        {"role": "user", "content": prompt}
-                    ],
+                    "messages": build_messages(prompt),
                     max_token_key: max_token_val
                 }
             }
-            batch.append(request)
-    
-    assert len(batch) > 0, "Must have at least 1 batch item"
     print(f"Skipped {skip_count} cases")
 
-    return batch
-
-def submit_batch_job(jsonl_path, client, output_dir):
-    batch_input_file = client.files.create(
-        file=open(jsonl_path, "rb"),
-        purpose="batch"
-    )
+# Batch manifest
+
+def batch_file_name(prefix, index):
+    """batchinput.jsonl, batchinput_1.jsonl, ... and the matching batchoutput files"""
+    return f"{prefix}.jsonl" if index == 0 else f"{prefix}_{index}.jsonl"
+
+def load_batch_manifest(output_dir):
+    """
+    Return the list of submitted batch shards of an output dir. Dirs from before the manifest
+    only have batch_api_metadata.json, which describes the one input file without an output.
+    """
+    manifest_path = os.path.join(output_dir, "batch_manifest.json")
+    if os.path.exists(manifest_path):
+        with open(manifest_path, "r") as f:
+            return json.load(f)["shards"]
+    metadata_path = os.path.join(output_dir, "batch_api_metadata.json")
+    if not os.path.exists(metadata_path):
+        return []
+    with open(metadata_path, "r") as f:
+        metadata = json.load(f)
+    index = 0
+    while os.path.exists(os.path.join(output_dir, batch_file_name("batchoutput", index))) and \
+        os.path.exists(os.path.join(output_dir, batch_file_name("batchinput", index))):
+        index += 1
+    if not os.path.exists(os.path.join(output_dir, batch_file_name("batchinput", index))):
+        return []  # Every input file has its output
+    return [{
+        "input_file": batch_file_name("batchinput", index),
+        "output_file": batch_file_name("batchoutput", index),
+        "batch_file_id": metadata["batch_file_id"],
+        "batch_job_id": metadata["batch_job_id"],
+        "status": "submitted"
+    }]
+
+def save_batch_manifest(output_dir, shards):
+    manifest_path = os.path.join(output_dir, "batch_manifest.json")
+    with open(manifest_path + ".tmp", "w") as f:
+        json.dump({"shards": shards}, f, indent=4)
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+def get_next_batch_index(output_dir):
+    index = 0
+    for fname in os.listdir(output_dir):
+        match = re.fullmatch(r'batch(?:input|output)(?:_(\d+))?\.jsonl', fname)
+        if match:
+            index = max(index, int(match.group(1) or 0) + 1)
+    return index
+
+# Batch submission
+
+def submit_batch_job(jsonl_path, client):
+    """Upload a batch input file and start its batch. Return its manifest entry"""
+    controller = get_controller("openai")
+    with open(jsonl_path, "rb") as file:
+        batch_input_file = controller.call(lambda: client.files.create(
+            file=file,
+            purpose="batch"
+        ))
     batch_input_file_id = batch_input_file.id
 
-    batch_job = client.batches.create(
+    batch_job = controller.call(lambda: client.batches.create(
         input_file_id=batch_input_file_id,
         endpoint="/v1/chat/completions",
         completion_window="24h",
         metadata={
             "description": "turnabout llm"
         }
+    ))
+    print(f"<submit_batch_job> Submitted {os.path.basename(jsonl_path)} as {batch_job.id}")
+    return {
+        "batch_file_id": batch_input_file_id,
+        "batch_job_id": batch_job.id,
+        "status": "submitted"
+    }
+
+def filter_cached_requests(requests, cache, model, output_dir):
+    """
+    Yield the requests without a cached response. The cached ones have their inputs and outputs appended to
+    batchinput_cache.jsonl / batchoutput_cache.jsonl so that evaluation reads them like batch results.
+    """
+    if cache is None or not cache.enabled:
+        yield from requests
+        return
+    n_cached, n_remaining = 0, 0
+    input_file, output_file = None, None
+    try:
+        for request in requests:
+            body = cache.get(batch_request_key(request["body"], model))
+            if body is None:
+                n_remaining += 1
+                yield request
+                continue
+            if input_file is None:
+                input_file = open(os.path.join(output_dir, "batchinput_cache.jsonl"), "a")
+                output_file = open(os.path.join(output_dir, "batchoutput_cache.jsonl"), "a")
+            input_file.write(json.dumps(request, ensure_ascii=False) + "\n")
+            output_file.write(json.dumps({
+                "custom_id": request["custom_id"],
+                "response": {"status_code": 200, "body": body}
+            }, ensure_ascii=False) + "\n")
+            n_cached += 1
+    finally:
+        if input_file is not None:
+            input_file.close()
+            output_file.close()
+    print(f"<filter_cached_requests> {n_cached} requests served from cache, {n_remaining} to submit")
+
+def write_batch_shards(requests, output_dir, max_bytes=BATCH_MAX_BYTES, max_requests=BATCH_MAX_REQUESTS):
+    """Stream requests into batch input files capped by size and request count. Yield each file once it is full"""
+    index = get_next_batch_index(output_dir)
+    file, n_bytes, n_requests = None, 0, 0
+    for request in requests:
+        line = (json.dumps(request, ensure_ascii=False) + "\n").encode("utf-8")
+        if file is not None and (n_bytes + len(line) > max_bytes or n_requests >= max_requests):
+            file.close()
+            yield file.name, n_requests, n_bytes
+            index += 1
+            file = None
+        if file is None:
+            file = open(os.path.join(output_dir, batch_file_name("batchinput", index)), "wb")
+            n_bytes, n_requests = 0, 0
+        file.write(line)
+        n_bytes += len(line)
+        n_requests += 1
+    if file is not None:
+        file.close()
+        yield file.name, n_requests, n_bytes
+
+CUSTOM_ID_PATTERN = re.compile(rb'"custom_id":\s*"((?:[^"\\]|\\.)*)"')
+
+def read_custom_ids(path, offset=0):
+    """
+    Stream the custom_id of every complete line of a batch file from a byte offset, without decoding
+    the rest of the line. Return the ids and the offset after the last complete line.
+    """
+    custom_ids = []
+    with open(path, "rb") as f:
+        f.seek(offset)
+        for line in f:
+            if not line.endswith(b"\n"):  # Partially written line
+                break
+            offset += len(line)
+            match = CUSTOM_ID_PATTERN.search(line, 0, 1024)  # custom_id is always near the start
+            if match:
+                custom_ids.append(json.loads(b'"' + match.group(1) + b'"'))
+            elif line.strip():
+                custom_ids.append(json.loads(line)["custom_id"])
+    return custom_ids, offset
+
+def load_completion_index(output_dir):
+    """
+    Return the set of custom_ids that have a batch output. The ids of each batchoutput file are kept
+    in completion_index.json with the byte offset they were read up to, so only new files and
+    newly appended lines are read.
+    """
+    index_path = os.path.join(output_dir, "completion_index.json")
+    index = {"files": {}}
+    if os.path.exists(index_path):
+        with open(index_path, "r") as f:
+            index = json.load(f)
+
+    changed = False
+    output_files = [fname for fname in os.listdir(output_dir) if fname.startswith("batchoutput")]
+    for fname in list(index["files"]):
+        if fname not in output_files:  # Removed since
+            del index["files"][fname]
+            changed = True
+    for fname in output_files:
+        path = os.path.join(output_dir, fname)
+        entry = index["files"].get(fname, {"offset": 0, "ids": []})
+        size = os.path.getsize(path)
+        if size == entry["offset"]:
+            continue
+        if size < entry["offset"]:  # Rewritten since, read it again
+            entry = {"offset": 0, "ids": []}
+        custom_ids, entry["offset"] = read_custom_ids(path, entry["offset"])
+        entry["ids"] += custom_ids
+        index["files"][fname] = entry
+        changed = True
+
+    if changed:
+        with open(index_path + ".tmp", "w") as f:
+            json.dump(index, f)
+        os.replace(index_path + ".tmp", index_path)
+
+    return set(custom_id for entry in index["files"].values() for custom_id in entry["ids"])
+
+def get_submitted_ids(output_dir):
+    """custom_ids that already have an output, or are in a shard that is still running"""
+    submitted_ids = load_completion_index(output_dir)
+    for shard in load_batch_manifest(output_dir):
+        if shard.get("status") in BATCH_FAILED_STATUSES or \
+            os.path.exists(os.path.join(output_dir, shard["output_file"])):
+            continue
+        submitted_ids.update(read_custom_ids(os.path.join(output_dir, shard["input_file"]))[0])
+    return submitted_ids
+
+def run_batch_job(fnames, MODEL, PROMPT, CONTEXT, NO_DESCRIPTION, client, output_dir, data_dir, cache=None, 
+                  max_bytes=BATCH_MAX_BYTES, max_requests=BATCH_MAX_REQUESTS, layout="default"):
+    """
+    Stream the batch requests that are not done or running yet into size-capped input files, submit
+    each file as its own batch as soon as it is written, and record each batch in batch_manifest.json
+    as soon as it is submitted, so that a crash does not lose the ids of the batches already paid for
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    submitted_ids = get_submitted_ids(output_dir)
+    if submitted_ids:
+        print(f"<run_batch_job> {len(submitted_ids)} requests already done or running")
+    requests = (
+        request for request in iter_batch_requests(fnames, MODEL, PROMPT, CONTEXT, NO_DESCRIPTION, data_dir, layout)
+        if request["custom_id"] not in submitted_ids
     )
-    batch_job_id = batch_job.id
-    with open(os.path.join(output_dir, "batch_api_metadata.json"), "w") as f:
-        f.write(json.dumps({
-            "batch_job_id": batch_job_id, 
-            "batch_file_id": batch_input_file_id
-        }, indent=4))
-
-    return batch_job_id
-
-def run_batch_job(fnames, MODEL, PROMPT, CONTEXT, NO_DESCRIPTION, client, output_dir, data_dir):
-    # Create batch
-    batch = create_batch(fnames, MODEL, PROMPT, CONTEXT, NO_DESCRIPTION, data_dir)
-
-    jsonl_path = os.path.join(output_dir, "batchinput.jsonl")
-    # If exists, run the incomplete batch job instead
-    if os.path.exists(jsonl_path):
-        # Create duplicate file
-        dup_count = 1
-        new_jsonl_path = jsonl_path
-        while os.path.exists(new_jsonl_path):
-            new_jsonl_path = os.path.join(output_dir, f"batchinput_{dup_count}.jsonl")
-            dup_count += 1
-        print(f"<run_batch_job> Creating duplicate batch input file: {os.path.basename(new_jsonl_path)}")
-
-        # Filter incomplete input
-        output_data = []
-        output_files = sorted([
-            os.path.join(output_dir, output_path) 
-            for output_path in os.listdir(output_dir) 
-            if output_path.startswith("batchoutput")
-        ])  # Guaranteed to be mutually exclusive
-        for output_file in output_files:
-            with open(output_file, "r") as f:
-                output_data += [json.loads(line) for line in f]
-        output_ids = sorted(set([item["custom_id"] for item in output_data]))
-        new_input_data = []
-        for input_item in batch:
-            if input_item["custom_id"] not in output_ids:
-                new_input_data.append(input_item)
-        print(f"<run_batch_job> Found {len(new_input_data)} incomplete cases")
-
-        # Create new batch input file
-        with open(new_jsonl_path, "w") as f:
-            for request in new_input_data:
-                f.write(json.dumps(request, ensure_ascii=False) + "\n")
-        jsonl_path = new_jsonl_path
+    requests = filter_cached_requests(requests, cache, resolve_model(MODEL), output_dir)
 
-    else:
-        with open(jsonl_path, "w") as f:
-            for request in batch:
-                f.write(json.dumps(request, ensure_ascii=False) + "\n")
-    
-    batch_job_id = submit_batch_job(jsonl_path, client, output_dir)
-    return batch_job_id
+    manifest = load_batch_manifest(output_dir)
+    manifest_lock = threading.Lock()
+
+    def submit(shard, jsonl_path):
+        try:
+            shard.update(submit_batch_job(jsonl_path, client))
+        except Exception as e:  # Keep the file so the shard can be resubmitted
+            print(f"<run_batch_job> Failed to submit {shard['input_file']}: {e}")
+            shard["status"] = "failed"
+        with manifest_lock:
+            manifest.append(shard)
+            save_batch_manifest(output_dir, manifest)
+
+    shards = []
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        for jsonl_path, n_requests, n_bytes in write_batch_shards(requests, output_dir, max_bytes, max_requests):
+            print(f"<run_batch_job> Wrote {os.path.basename(jsonl_path)}: {n_requests} requests, {n_bytes / 1024 ** 2:.1f} MB")
+            input_file = os.path.basename(jsonl_path)
+            shards.append({
+                "input_file": input_file,
+                "output_file": input_file.replace("batchinput", "batchoutput"),
+                "n_requests": n_requests,
+                "n_bytes": n_bytes
+            })
+            executor.submit(submit, shards[-1], jsonl_path)
+
+    if not shards:
+        print("<run_batch_job> Nothing to submit")
+    return [shard.get("batch_job_id") for shard in shards]
 
 # Main loop
 
-def run_job(fnames, MODEL, PROMPT, CONTEXT, NO_DESCRIPTION, client, client_name, output_dir, data_dir):
+def write_case_outputs(output_dir, fname, prompts, answer_jsons, cots):
+    with open(os.path.join(output_dir, fname.split('.')[0] + '.jsonl'), 'w') as file:
+        for answer_json in answer_jsons:
+            file.write(json.dumps(answer_json) + "\n")
+    json_response = []
+    for idx, (answer_json, cot) in enumerate(zip(answer_jsons, cots)):
+        json_response.append({ 
+            "idx": idx,
+            "prompt": prompts[idx],
+            "response_json": answer_json,
+            "cot": cot
+        })
+    write_outputs(output_dir, fname.split('.')[0], json_response)
+
+def get_checkpoint_path(output_dir, fname):
+    return os.path.join(output_dir, "checkpoints", fname.split('.')[0] + '.jsonl')
+
+def hash_prompt(prompt):
+    return hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:16]
+
+def read_checkpoint(output_dir, fname):
+    """Return {idx: entry} of the logged turns, the last entry of a turn winning"""
+    entries = {}
+    checkpoint_path = get_checkpoint_path(output_dir, fname)
+    if not os.path.exists(checkpoint_path):
+        return entries
+    with open(checkpoint_path, 'r') as file:
+        for line in file:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:  # Torn write from a crash
+                continue
+            entries[entry["idx"]] = entry
+    return entries
+
+def load_checkpoint(output_dir, fname, prompts):
+    """Return {idx: (answer_json, cot)} of the logged turns whose prompt has not changed since"""
+    completed = {}
+    for idx, entry in read_checkpoint(output_dir, fname).items():
+        if idx < len(prompts) and entry["prompt_hash"] == hash_prompt(prompts[idx]):
+            completed[idx] = (entry["response_json"], entry["cot"])
+    return completed
+
+def append_checkpoint(output_dir, fname, idx, prompt, answer_json, cot):
+    """Durably append a finished turn to the case's write-ahead log"""
+    checkpoint_path = get_checkpoint_path(output_dir, fname)
+    os.makedirs(os.path.dirname(checkpoint_path), exist_ok=True)
+    with open(checkpoint_path, 'a') as file:
+        file.write(json.dumps({
+            "idx": idx,
+            "prompt_hash": hash_prompt(prompt),
+            "response_json": answer_json,
+            "cot": cot
+        }) + "\n")
+        file.flush()
+        os.fsync(file.fileno())
+
+def finalize_case(output_dir, fname, prompts):
+    """Assemble the case outputs from its log once every turn is complete. Return False otherwise"""
+    completed = load_checkpoint(output_dir, fname, prompts)
+    if len(completed) < len(prompts):
+        return False
+    answer_jsons = [completed[idx][0] for idx in range(len(prompts))]
+    cots = [completed[idx][1] for idx in range(len(prompts))]
+    for answer_json in answer_jsons:
+        print(answer_json)
+    write_case_outputs(output_dir, fname, prompts, answer_jsons, cots)
+    os.remove(get_checkpoint_path(output_dir, fname))
+    return True
+
+# Conversation mode
+
+def get_conversation_tokens_path(output_dir):
+    return os.path.join(output_dir, "conversation_tokens.json")
+
+def record_conversation_tokens(output_dir, fname, conversation):
+    """Keep the input tokens of a finished conversation next to those of the same turns with --context full"""
+    path = get_conversation_tokens_path(output_dir)
+    records = {}
+    if os.path.exists(path):
+        with open(path, 'r') as file:
+            records = json.load(file)
+    records[fname.split('.')[0]] = {
+        "turns": len(conversation.case.turns),
+        "restarts": conversation.restarts,
+        "conversation_tokens": conversation.sent_tokens,
+        "stateless_tokens": conversation.stateless_tokens,
+        "conversation_new_tokens": conversation.new_tokens,
+        "stateless_new_tokens": conversation.stateless_new_tokens
+    }
+    with open(path + ".tmp", 'w') as file:
+        json.dump(records, file, indent=2)
+    os.replace(path + ".tmp", path)
+
+def report_conversation_tokens(output_dir):
+    path = get_conversation_tokens_path(output_dir)
+    if not os.path.exists(path):
+        return
+    with open(path, 'r') as file:
+        records = json.load(file).values()
+    def total(field):
+        return sum(record[field] for record in records)
+
+    for kind, sent, stateless in [
+        ("input", total("conversation_tokens"), total("stateless_tokens")),
+        ("new (not a prefix of the previous request)", total("conversation_new_tokens"), total("stateless_new_tokens"))
+    ]:
+        if stateless:
+            print(f"<report_conversation_tokens> {len(records)} cases: {sent} {kind} tokens in conversation mode vs {stateless} "
+                  f"with --context full ({1 - sent / stateless:.1%} saved)")
+
+def start_conversation(case, PROMPT, NO_DESCRIPTION, MODEL, layout="default"):
+    PROMPT_PREFIX, PROMPT_SUFFIX = build_prompt_prefix_suffix(PROMPT)
+    return Conversation(case, PROMPT_PREFIX, PROMPT_SUFFIX, NO_DESCRIPTION, MODEL, SYSTEM_MESSAGE, layout)
+
+def conversation_turns(case, fname, PROMPT, NO_DESCRIPTION, MODEL, output_dir, layout="default"):
+    """
+    Walk the turns of a case as one conversation, resuming from the log. Yields (idx, messages) for
+    each turn to send, and is sent back its (answer_json, cot), or None if it failed. Returns whether
+    the case was finished, which it is not after a failed turn, since later turns need its answer.
+    """
+    conversation = start_conversation(case, PROMPT, NO_DESCRIPTION, MODEL, layout)
+    logged = read_checkpoint(output_dir, fname)
+    prompts = []
+    for idx in range(len(case.turns)):
+        prompt, messages = conversation.next_turn(idx)
+        prompts.append(prompt)
+        entry = logged.get(idx)
+        if entry is None or entry["prompt_hash"] != hash_prompt(prompt):
+            logged = {}  # Later turns in the log followed another history
+            answer = yield idx, messages
+            if answer is None:
+                return False
+            entry = {"response_json": answer[0]}
+            append_checkpoint(output_dir, fname, idx, prompt, *answer)
+        conversation.add_answer(entry["response_json"])
+    record_conversation_tokens(output_dir, fname, conversation)
+    finalize_case(output_dir, fname, prompts)
+    return True
+
+def run_conversation_case(case, fname, PROMPT, NO_DESCRIPTION, MODEL, client, client_name, output_dir, cache=None, 
+                          stream=False, early_stop=False, layout="default"):
+    """
+    Answer the turns of a case in order as one conversation, resuming from the log.
+    Return False if a turn fails, since later turns need its answer.
+    """
+    turns = conversation_turns(case, fname, PROMPT, NO_DESCRIPTION, MODEL, output_dir, layout)
+    try:
+        idx, messages = next(turns)
+        while True:
+            answer_jsons, cots, has_error = run_model(
+                [messages], client, client_name, cache, stream=stream, early_stop=early_stop,
+                on_metrics=lambda _, metrics: append_metrics(output_dir, fname, idx, client_name, metrics)
+            )
+            idx, messages = turns.send(None if has_error else (answer_jsons[0], cots[0]))
+    except StopIteration as done:
+        return done.value
+
+async def run_conversation_case_async(case, fname, PROMPT, NO_DESCRIPTION, MODEL, client, client_name, output_dir, semaphore, 
+                                      cache=None, stream=False, early_stop=False, layout="default"):
+    """Same as run_conversation_case with an AsyncOpenAI client"""
+    turns = conversation_turns(case, fname, PROMPT, NO_DESCRIPTION, MODEL, output_dir, layout)
+    try:
+        idx, messages = next(turns)
+        while True:
+            answer_json, cot, has_error = await run_model_async(
+                messages, client, client_name, semaphore, cache, stream, early_stop=early_stop,
+                on_metrics=lambda metrics: append_metrics(output_dir, fname, idx, client_name, metrics)
+            )
+            idx, messages = turns.send(None if has_error else (answer_json, cot))
+    except StopIteration as done:
+        return done.value
+
+# Jobs
+
+def run_job(fnames, MODEL, PROMPT, CONTEXT, NO_DESCRIPTION, client, client_name, output_dir, data_dir, cache=None, stream=False, 
+            early_stop=False, layout="default"):
     error_count = 0
     skip_count = 0
+    hedger = get_hedger(client_name)
+    if hedger.hedge:  # Hedge from the first turn with the latencies of earlier runs
+        hedger.seed(load_metrics(output_dir))
     for fname in fnames:
         # Parse and build prompt
         if error_count > 5:
@@ -466,37 +1071,245 @@ def run_job(fnames, MODEL, PROMPT, CONTEXT, NO_DESCRIPTION, client, client_name,
             break
 
         print(fname)
-        turns, context = parse_json(os.path.join(data_dir, fname))
-        if turns == []:  # Skip cases with no turns
+        case = load_case(os.path.join(data_dir, fname))
+        if case.turns == []:  # Skip cases with no turns
             skip_count += 1
             continue
+        if CONTEXT == "conversation":
+            if not run_conversation_case(
+                case, fname, PROMPT, NO_DESCRIPTION, MODEL, client, client_name, output_dir, cache, stream, early_stop, layout
+            ):
+                error_count += 1
+                print(f"<run_job> Error when running the model for {fname}")
+            continue
         PROMPT_PREFIX, PROMPT_SUFFIX = build_prompt_prefix_suffix(PROMPT)
-        prompts = build_prompt(turns, context, PROMPT_PREFIX, PROMPT_SUFFIX, CONTEXT, NO_DESCRIPTION, MODEL)
-
-        # Answer
-        answer_jsons, cots, has_error = run_model(prompts, client, client_name)
+        prompts = case.build(PROMPT_PREFIX, PROMPT_SUFFIX, CONTEXT, NO_DESCRIPTION, MODEL, layout)
+
+        # Resume from the turns already in the log
+        completed = load_checkpoint(output_dir, fname, prompts)
+        pending = [idx for idx in range(len(prompts)) if idx not in completed]
+        if completed:
+            print(f"<run_job> Resuming {fname}: {len(completed)} of {len(prompts)} turns already done")
+
+        # Answer, logging each turn as soon as it returns
+        _, _, has_error = run_model(
+            [prompts[idx] for idx in pending], 
+            client, 
+            client_name, 
+            cache,
+            on_turn=lambda i, answer_json, cot: append_checkpoint(
+                output_dir, fname, pending[i], prompts[pending[i]], answer_json, cot
+            ),
+            stream=stream,
+            on_metrics=lambda i, metrics: append_metrics(output_dir, fname, pending[i], client_name, metrics),
+            early_stop=early_stop
+        )
         if has_error:
             error_count += 1
             print(f"<run_job> Error when running the model for {fname}")
-            continue  # Skip cases with errors
-        for answer_json in answer_jsons:
-            print(answer_json)
+            continue  # Skip cases with errors, the finished turns stay in the log
 
         # Log
-        with open(os.path.join(output_dir, fname.split('.')[0] + '.jsonl'), 'w') as file:
-            for answer_json in answer_jsons:
-                file.write(json.dumps(answer_json) + "\n")
-        with open(os.path.join(output_dir, fname.split('.')[0] + '_outputs.json'), 'w') as file:
-            json_response = []
-            for idx, (answer_json, cot) in enumerate(zip(answer_jsons, cots)):
-                json_response.append({ 
-                    "idx": idx,
-                    "prompt": prompts[idx],
-                    "response_json": answer_json,
-                    "cot": cot
-                })
-            file.write(json.dumps(json_response, indent=2))
+        finalize_case(output_dir, fname, prompts)
     
+    if cache is not None:
+        print(f"<run_job> Cache: {cache.summary()}")
+    if hasattr(getattr(client, "engine", None), "prefix_cache"):
+        print(f"<run_job> Prefix cache: {client.engine.prefix_cache.summary()}")
+    if hedger.hedge or hedger.timeout is not None:
+        print(f"<run_job> {hedger.summary()}")
+    report_conversation_tokens(output_dir)
+    print(f"Skipped {skip_count} cases")
+
+def collect_jobs(fnames, MODEL, PROMPT, CONTEXT, NO_DESCRIPTION, output_dir, data_dir, cost_model, layout="default"):
+    """
+    Return the cases with turns, as {fname: prompts} (the compiled case for conversations), and the
+    ((fname, idx), predicted seconds) of their turns not yet in the log, in filename order. A
+    conversation is one job (fname, None) costing the sum of its turns, as they run one after the other.
+    """
+    PROMPT_PREFIX, PROMPT_SUFFIX = build_prompt_prefix_suffix(PROMPT)
+    cases, jobs = {}, []
+    for fname in fnames:
+        case = load_case(os.path.join(data_dir, fname))
+        if case.turns == []:  # Skip cases with no turns
+            continue
+        if CONTEXT == "conversation":  # Costed as full context, which the first turn and restarts send
+            prompts = case.build(PROMPT_PREFIX, PROMPT_SUFFIX, "full", NO_DESCRIPTION, MODEL, layout)
+            cases[fname] = case
+            jobs.append(((fname, None), sum(turn_cost(cost_model, case, i, prompt) for i, prompt in enumerate(prompts))))
+            continue
+        prompts = case.build(PROMPT_PREFIX, PROMPT_SUFFIX, CONTEXT, NO_DESCRIPTION, MODEL, layout)
+        cases[fname] = prompts
+        completed = load_checkpoint(output_dir, fname, prompts)
+        jobs += [((fname, idx), turn_cost(cost_model, case, idx, prompts[idx])) for idx in range(len(prompts)) if idx not in completed]
+    return cases, jobs
+
+async def run_job_async(fnames, MODEL, PROMPT, CONTEXT, NO_DESCRIPTION, client, client_name, output_dir, data_dir, concurrency, cache=None, 
+                        semaphore=None, stream=False, early_stop=False, layout="default", schedule="longest"):
+    """
+    Same as run_job, but the turn prompts of all cases are sent concurrently with at most
+    `concurrency` requests in flight. Each case is written as soon as all of its turns return.
+    Jobs that pass the same `semaphore` share its limit instead. With the longest schedule, the
+    turns predicted to take longest are sent first (conversations, as a whole, longest first).
+    """
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(concurrency)
+    state = {"error_count": 0}
+
+    async def run_turn(fname, prompts, idx):
+        answer_json, cot, has_error = await run_model_async(
+            prompts[idx], client, client_name, semaphore, cache, stream,
+            on_metrics=lambda metrics: append_metrics(output_dir, fname, idx, client_name, metrics),
+            early_stop=early_stop
+        )
+        if not has_error:
+            append_checkpoint(output_dir, fname, idx, prompts[idx], answer_json, cot)
+        return has_error
+
+    async def run_case(fname, prompts, turn_tasks):
+        if state["error_count"] > 5:
+            return
+        if CONTEXT == "conversation":  # prompts is the case, its turns are sent one after the other
+            errors = [not await run_conversation_case_async(
+                prompts, fname, PROMPT, NO_DESCRIPTION, MODEL, client, client_name, output_dir, semaphore, cache, stream, early_stop, layout
+            )]
+        else:
+            errors = await asyncio.gather(*turn_tasks)
+        if any(errors):
+            state["error_count"] += 1
+            print(f"<run_job_async> Error when running the model for {fname}")
+            if state["error_count"] > 5:
+                print(f"<run_job_async> Terminating due to {state['error_count']}+ json parsing errors")
+                for task in tasks:
+                    task.cancel()
+            return  # Skip cases with errors, the finished turns stay in the log
+        print(f"<run_job_async> {fname}")
+
+        # Log
+        if CONTEXT != "conversation":
+            finalize_case(output_dir, fname, prompts)
+
+    hedger = get_hedger(client_name)
+    if hedger.hedge:  # Hedge from the first turn with the latencies of earlier runs
+        hedger.seed(load_metrics(output_dir))
+    cost_model = load_cost_model([output_dir], data_dir)
+    cases, jobs = collect_jobs(fnames, MODEL, PROMPT, CONTEXT, NO_DESCRIPTION, output_dir, data_dir, cost_model, layout)
+    skip_count = len(fnames) - len(cases)
+    controller = get_controller(get_provider(client_name))
+    if schedule == "longest":
+        jobs = schedule_jobs(jobs, concurrency, controller)
+    print(f"<run_job_async> {format_makespan(predict_makespan(jobs, concurrency, controller))}")
+
+    # Requests reach the semaphore in the order their tasks are created, so create them in schedule order
+    tasks = []
+    turn_tasks = {fname: [] for fname in cases}
+    for (fname, idx), _ in jobs:
+        if idx is not None:
+            turn_tasks[fname].append(asyncio.ensure_future(run_turn(fname, cases[fname], idx)))
+            tasks.append(turn_tasks[fname][-1])
+    case_order = [fname for (fname, idx), _ in jobs if idx is None] if CONTEXT == "conversation" else list(cases)
+    for fname in case_order:
+        tasks.append(asyncio.ensure_future(run_case(fname, cases[fname], turn_tasks[fname])))
+
+    print(f"<run_job_async> Running {len(cases)} cases of {os.path.basename(output_dir)}")
+    await asyncio.gather(*tasks, return_exceptions=True)
+    print(f"<run_job_async> {get_controller(get_provider(client_name)).summary()}")
+    if hedger.hedge or hedger.timeout is not None:
+        print(f"<run_job_async> {hedger.summary()}")
+    if cache is not None:
+        print(f"<run_job_async> Cache: {cache.summary()}")
+    report_conversation_tokens(output_dir)
+    print(f"Skipped {skip_count} cases")
+
+def run_local_batch_job(fnames, MODEL, PROMPT, CONTEXT, NO_DESCRIPTION, client, client_name, output_dir, data_dir, batch_size, 
+                        cache=None, early_stop=False, layout="default"):
+    """
+    Same as run_job for a Hugging Face model, but the pending turn prompts of all cases are sorted by
+    length and generated in batches of up to `batch_size` prompts. Each case is written as soon as
+    all of its turns are done.
+    """
+    from local_engine import length_buckets, tokenize_messages, generate_batch
+
+    PROMPT_PREFIX, PROMPT_SUFFIX = build_prompt_prefix_suffix(PROMPT)
+    hyperparams = dict(LOCAL_HYPERPARAMS)  # Same as run_model
+    key_params = cache_params(hyperparams, early_stop)
+    case_prompts = {}
+    remaining = {}  # Turns left per case
+    pending = []
+    skip_count = 0
+    for fname in fnames:
+        case = load_case(os.path.join(data_dir, fname))
+        if case.turns == []:  # Skip cases with no turns
+            skip_count += 1
+            continue
+        prompts = case.build(PROMPT_PREFIX, PROMPT_SUFFIX, CONTEXT, NO_DESCRIPTION, MODEL, layout)
+        completed = load_checkpoint(output_dir, fname, prompts)
+        case_prompts[fname] = prompts
+        remaining[fname] = len(prompts) - len(completed)
+        pending += [(fname, idx) for idx in range(len(prompts)) if idx not in completed]
+
+    def request_messages(fname, idx):
+        return local_messages(case_prompts[fname][idx])
+
+    error_cases = set()
+    def record(fname, idx, full_answer):
+        try:
+            answer_json, cot = get_json_answer(full_answer)
+        except Exception:  # Empty answer
+            answer_json, cot = {}, ""
+        if answer_json == {}:
+            error_cases.add(fname)
+            return
+        append_checkpoint(output_dir, fname, idx, case_prompts[fname][idx], answer_json, cot)
+        remaining[fname] -= 1
+        if remaining[fname] == 0:
+            finalize_case(output_dir, fname, case_prompts[fname])
+
+    for fname in [fname for fname in remaining if remaining[fname] == 0]:  # Done before a crash, not written yet
+        finalize_case(output_dir, fname, case_prompts[fname])
+
+    to_generate = []
+    for fname, idx in pending:
+        body = cache.get(request_key(client_name, request_messages(fname, idx), key_params)) if cache is not None else None
+        if body is None:
+            to_generate.append((fname, idx))
+        else:
+            record(fname, idx, body["choices"][0]["message"]["content"])
+
+    token_ids = [tokenize_messages(client.engine, request_messages(fname, idx)) for fname, idx in to_generate]
+    buckets = length_buckets([len(ids) for ids in token_ids], batch_size)
+    print(f"<run_local_batch_job> Generating {len(to_generate)} turns of {len(case_prompts)} cases in {len(buckets)} batches")
+    for bucket in buckets:
+        start = time.perf_counter()
+        try:
+            texts, lengths = generate_batch(
+                client.engine, [token_ids[i] for i in bucket],
+                make_stopping_criteria(client.engine.tokenizer) if early_stop else None, **hyperparams
+            )
+        except Exception:  # Such as out of memory, the turns of the batch stay pending
+            print(f"<run_local_batch_job> {traceback.format_exc()}")
+            error_cases.update(to_generate[i][0] for i in bucket)
+            continue
+        latency = time.perf_counter() - start
+        for i, full_answer, n_tokens in zip(bucket, texts, lengths):
+            fname, idx = to_generate[i]
+            append_metrics(output_dir, fname, idx, client_name, {
+                "stream": False, "early_stop": early_stop, "ttft": None, "reasoning_time": None, "latency": latency,
+                "batch_size": len(bucket), "prompt_tokens": len(token_ids[i]), "completion_tokens": n_tokens,
+                "reasoning_tokens": None, "cached_tokens": None
+            })
+            if cache is not None and is_answered(full_answer):
+                cache.put(
+                    request_key(client_name, request_messages(fname, idx), key_params),
+                    {"choices": [{"message": {"role": "assistant", "content": full_answer}}]}
+                )
+            record(fname, idx, full_answer)
+        print(f"<run_local_batch_job> Batch of {len(bucket)} prompts of up to {max(len(token_ids[i]) for i in bucket)} tokens in {latency:.1f}s")
+
+    for fname in sorted(error_cases):
+        print(f"<run_local_batch_job> Error when running the model for {fname}")
+    if cache is not None:
+        print(f"<run_local_batch_job> Cache: {cache.summary()}")
     print(f"Skipped {skip_count} cases")
 
 if __name__ == "__main__":
@@ -507,37 +1320,52 @@ if __name__ == "__main__":
     CASE = args.case if args.case else "ALL"
     CONTEXT = args.context
     NO_DESCRIPTION = args.no_description
+    LAYOUT = args.layout
     DATA = args.data
+    CONCURRENCY = args.concurrency
+    STREAM = args.stream
+    EARLY_STOP = args.early_stop
+    cache = ResponseCache(mode=args.cache)
 
     if DATA == 'aceattorney':
         data_dir = '../data/aceattorney_data/final'
     elif DATA == 'danganronpa':
         data_dir = '../data/danganronpa_data/final'
 
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-
     # Make output dir
-    output_dir = get_output_dir(MODEL, PROMPT, CONTEXT, CASE, NO_DESCRIPTION, DATA)
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
-    with open(os.path.join(output_dir, 'metadata.json'), 'w') as file:
-        json.dump({
-            'model': MODEL,
-            'prompt': PROMPT,
-            'context': "none" if CONTEXT is None else CONTEXT,
-            'case': CASE if CASE != "ALL" else "all",
-            'no_description': NO_DESCRIPTION,
-            'data': DATA,
-            'timestamp': timestamp
-        }, file, indent=2)
+    output_dir = prepare_output_dir(MODEL, PROMPT, CONTEXT, CASE, NO_DESCRIPTION, DATA, LAYOUT)
     # Load model
-    client, client_name = load_model(MODEL)
+    # Conversation turns depend on the previous answers, so they cannot be sent as one batch
+    is_batch = any(name in MODEL for name in ["o3", "o4", "gpt"]) and CONTEXT != "conversation"
+    is_async = CONCURRENCY is not None and not is_batch
+    client, client_name = load_model(MODEL, async_client=is_async, prefix_cache=args.prefix_cache, server=args.server)
+    get_hedger(client_name, timeout=args.timeout, hedge=args.hedge)
+    if is_async and type(client).__name__ != "AsyncOpenAI":
+        print(f"<main> --concurrency is only supported for api models, running {MODEL} serially")
+        is_async = False
+    is_local_batch = args.batch_size is not None and type(client).__name__ == "Kani"
+    if is_local_batch and CONTEXT == "conversation":
+        print(f"<main> --batch_size does not apply to conversation mode, running {MODEL} one turn at a time")
+        is_local_batch = False
 
     # Collect cases
-    fnames = get_fnames(data_dir, output_dir, CASE)
+    if args.shard is None:
+        fnames = get_fnames(data_dir, output_dir, CASE)
+    else:
+        if is_batch:  # Batches are already run in parallel by the provider
+            raise ValueError(f"<main> --shard does not apply to batch models like {MODEL}")
+        shard = parse_shard(args.shard)
+        fnames = get_fnames(data_dir, output_dir, CASE, shard=shard, cost=lambda fname: estimate_case_tokens(
+            os.path.join(data_dir, fname), PROMPT, CONTEXT, NO_DESCRIPTION, MODEL, LAYOUT
+        ))
+        output_dir = prepare_shard_dir(output_dir, shard)
 
     # Run cases
-    if any(name in MODEL for name in ["o3", "o4", "gpt"]):
-        run_batch_job(fnames, MODEL, PROMPT, CONTEXT, NO_DESCRIPTION, client, output_dir, data_dir)
+    if is_batch:
+        run_batch_job(fnames, MODEL, PROMPT, CONTEXT, NO_DESCRIPTION, client, output_dir, data_dir, cache, layout=LAYOUT)
+    elif is_async:
+        asyncio.run(run_job_async(fnames, MODEL, PROMPT, CONTEXT, NO_DESCRIPTION, client, client_name, output_dir, data_dir, CONCURRENCY, cache, stream=STREAM, early_stop=EARLY_STOP, layout=LAYOUT, schedule=args.schedule))
+    elif is_local_batch:
+        run_local_batch_job(fnames, MODEL, PROMPT, CONTEXT, NO_DESCRIPTION, client, client_name, output_dir, data_dir, args.batch_size, cache, EARLY_STOP, LAYOUT)
     else:
-        run_job(fnames, MODEL, PROMPT, CONTEXT, NO_DESCRIPTION, client, client_name, output_dir, data_dir)
+        run_job(fnames, MODEL, PROMPT, CONTEXT, NO_DESCRIPTION, client, client_name, output_dir, data_dir, cache, STREAM, EARLY_STOP, LAYOUT)
@@ -0,0 +1,185 @@
+import heapq
+import json
+import os
+
+from context_budget import ApproxTokenizer
+
+# Longest-job-first scheduling of the turns of a run. In filename order, the longest full-context
+# turns (late cases with long stories and many evidences) can start last and set the makespan of a
+# concurrent run; started first, they overlap with the many short turns instead. The latency of a
+# turn is predicted from its prompt tokens and its action space, n_evidences × n_testimonies as in
+# evaluate.parse_gold, since the model weighs every evidence against every testimony.
+
+# Rough priors, used until metrics.jsonl of the run has enough requests to fit them
+BASE_SECONDS = 4.0
+SECONDS_PER_PROMPT_TOKEN = 0.0002
+SECONDS_PER_ACTION = 0.05
+MIN_FIT_SAMPLES = 20
+
+SCHEDULES = ["longest", "fifo"]
+
+class CostModel:
+    """Predicted seconds of a request: base + per_token * prompt tokens + per_action * action space"""
+    def __init__(self, base=BASE_SECONDS, per_token=SECONDS_PER_PROMPT_TOKEN, per_action=SECONDS_PER_ACTION, n_samples=0):
+        self.base = base
+        self.per_token = per_token
+        self.per_action = per_action
+        self.n_samples = n_samples  # Requests it was fit to, 0 for the priors
+
+    def predict(self, prompt_tokens, n_actions):
+        return self.base + self.per_token * prompt_tokens + self.per_action * n_actions
+
+    def describe(self):
+        source = f"fit to {self.n_samples} requests" if self.n_samples else "priors"
+        return f"{self.base:.2f}s + {self.per_token * 1000:.3f}s per 1k prompt tokens + {self.per_action:.3f}s per action ({source})"
+
+def action_space(case, i):
+    """Evidence-testimony pairs the model chooses from at turn i of a compiled case"""
+    return len(case.evidences) * len(case.turns[i]['testimonies'])
+
+def turn_cost(cost_model, case, i, prompt):
+    return cost_model.predict(ApproxTokenizer().count(prompt), action_space(case, i))
+
+def fit_cost_model(samples):
+    """Least squares fit to (prompt tokens, action space, latency) samples, slopes kept non-negative"""
+    import numpy as np
+
+    x = np.array([[1.0, tokens, actions] for tokens, actions, _ in samples])
+    y = np.array([latency for _, _, latency in samples])
+    coefficients = np.linalg.lstsq(x, y, rcond=None)[0]
+    if (coefficients[1:] < 0).any():  # A negative slope only fits noise, so drop it and refit
+        keep = [0] + [j for j in (1, 2) if coefficients[j] >= 0]
+        coefficients = np.zeros(3)
+        coefficients[keep] = np.linalg.lstsq(x[:, keep], y, rcond=None)[0]
+    return CostModel(max(coefficients[0], 0.0), coefficients[1], coefficients[2], len(samples))
+
+def load_cost_model(output_dirs, data_dir):
+    """
+    Fit the latencies in metrics.jsonl of output_dirs, or return the priors if there are too few. The
+    prompts of each run are rebuilt from its metadata.json and counted as in turn_cost, so that the
+    fit and the predictions are in the same token units.
+    """
+    from run_metrics import load_metrics
+    from run_models import load_case, build_prompt_prefix_suffix
+
+    tokenizer = ApproxTokenizer()
+    samples = []
+    for output_dir in output_dirs:
+        metadata_path = os.path.join(output_dir, "metadata.json")
+        if not os.path.exists(metadata_path):
+            continue
+        with open(metadata_path, "r") as file:
+            metadata = json.load(file)
+        PROMPT_PREFIX, PROMPT_SUFFIX = build_prompt_prefix_suffix(metadata["prompt"])
+        context = None if metadata["context"] == "none" else metadata["context"]
+        if context == "conversation":  # Costed as full context, as in collect_jobs
+            context = "full"
+        turns = {}  # Case name: (prompt tokens, action space) of its turns
+        for record in load_metrics(output_dir):
+            path = os.path.join(data_dir, record["case"] + ".json")
+            if record.get("latency") is None or not os.path.exists(path):
+                continue
+            if record["case"] not in turns:
+                case = load_case(path)
+                prompts = case.build(
+                    PROMPT_PREFIX, PROMPT_SUFFIX, context, metadata["no_description"], metadata["model"], metadata.get("layout", "default")
+                )
+                turns[record["case"]] = [(tokenizer.count(prompt), action_space(case, i)) for i, prompt in enumerate(prompts)]
+            if record["idx"] < len(turns[record["case"]]):
+                samples.append((*turns[record["case"]][record["idx"]], record["latency"]))
+    if len(samples) < MIN_FIT_SAMPLES:
+        return CostModel()
+    return fit_cost_model(samples)
+
+def longest_first(jobs):
+    """Sort (key, cost) jobs by decreasing cost"""
+    return sorted(jobs, key=lambda job: -job[1])
+
+def ramp_up_jobs(concurrency, controller=None):
+    """Jobs a RateController has to finish before its limit lets `concurrency` requests in flight"""
+    if controller is None:
+        return 0
+    limit, n_jobs = controller.limit, 0
+    while int(limit) < min(concurrency, controller.max_concurrency):
+        limit += 1 / max(limit, 1)
+        n_jobs += 1
+    return n_jobs
+
+def schedule(jobs, concurrency, controller=None):
+    """
+    Longest first. While a rate controller is still ramping up to `concurrency`, slots only open as
+    jobs finish, so up to `concurrency` of the shortest jobs go first instead, if simulate predicts
+    that this ends the run sooner.
+    """
+    ordered = longest_first(jobs)
+    n_ramp_up = min(ramp_up_jobs(concurrency, controller), concurrency, len(jobs))
+    if n_ramp_up == 0:
+        return ordered
+    ramp_up_first = ordered[-n_ramp_up:][::-1] + ordered[:-n_ramp_up]
+    if simulate([cost for _, cost in ramp_up_first], concurrency, controller) < simulate([cost for _, cost in ordered], concurrency, controller):
+        return ramp_up_first
+    return ordered
+
+def simulate(costs, concurrency, controller=None):
+    """
+    Makespan of running jobs of these costs in order, each starting as soon as a slot is free. There
+    are `concurrency` slots, or with a RateController, at most its limit, which grows as in
+    RateController.on_success with every finished job.
+    """
+    limit = float(concurrency) if controller is None else min(controller.limit, concurrency)
+    max_limit = concurrency if controller is None else min(controller.max_concurrency, concurrency)
+    running, now, makespan = [], 0.0, 0.0
+    for cost in costs:
+        while len(running) >= max(1, int(limit)):
+            now = heapq.heappop(running)
+            limit = min(max_limit, limit + 1 / max(limit, 1))
+        heapq.heappush(running, now + cost)
+        makespan = max(makespan, now + cost)
+    return makespan
+
+def predict_makespan(jobs, concurrency, controller=None):
+    """Predicted makespan of (key, cost) jobs in their given order, in filename order and as scheduled"""
+    costs = [cost for _, cost in jobs]
+    return {
+        "jobs": len(jobs),
+        "concurrency": concurrency,
+        "total": sum(costs),
+        "given": simulate(costs, concurrency, controller),
+        "fifo": simulate([cost for _, cost in sorted(jobs, key=lambda job: job[0])], concurrency, controller),
+        "longest_first": simulate([cost for _, cost in schedule(jobs, concurrency, controller)], concurrency, controller),
+        "lower_bound": max(sum(costs) / concurrency, max(costs)) if costs else 0.0
+    }
+
+def format_makespan(prediction):
+    return (
+        f"{prediction['jobs']} jobs at concurrency {prediction['concurrency']}: predicted makespan "
+        f"{prediction['given']:.0f}s (filename order {prediction['fifo']:.0f}s, longest first "
+        f"{prediction['longest_first']:.0f}s, lower bound {prediction['lower_bound']:.0f}s)"
+    )
+
+if __name__ == "__main__":
+    import argparse
+    from run_models import parse_arguments, get_output_dir, get_fnames, collect_jobs
+    from sweep import get_data_dir
+
+    parser = argparse.ArgumentParser(description='Predict the makespan of a run before starting it', parents=[parse_arguments()], conflict_handler='resolve')
+    parser.add_argument('--concurrency', type=str, default='8,16,32,64', help='comma-separated concurrencies to simulate')
+    parser.add_argument('--metrics', type=str, nargs='*', default=[], help='output dirs whose metrics.jsonl the cost model is fit to, besides that of the run')
+    parser.add_argument('--initial_concurrency', type=float, default=None, help='simulate a rate controller whose limit starts here and grows with every finished request, as in rate_control.py')
+    parser.add_argument('--top', type=int, default=5, help='number of most expensive requests to list')
+    args = parser.parse_args()
+    data_dir = get_data_dir(args.data)
+    output_dir = get_output_dir(args.model, args.prompt, args.context, args.case, args.no_description, args.data, args.layout)
+    fnames = get_fnames(data_dir, output_dir, args.case, verbose=False)
+    cost_model = load_cost_model([output_dir] + args.metrics, data_dir)
+    _, jobs = collect_jobs(fnames, args.model, args.prompt, args.context, args.no_description, output_dir, data_dir, cost_model, args.layout)
+    print(f"<main> Cost model: {cost_model.describe()}")
+    controller = None
+    if args.initial_concurrency is not None:
+        from rate_control import RateController
+        controller = RateController("simulated", initial_concurrency=args.initial_concurrency, max_concurrency=1 << 20)
+    for concurrency in [int(value) for value in args.concurrency.split(",")]:
+        scheduled = schedule(jobs, concurrency, controller) if args.schedule == "longest" else jobs
+        print(f"<main> {format_makespan(predict_makespan(scheduled, concurrency, controller))}")
+    for (fname, idx), cost in longest_first(jobs)[:args.top]:
+        print(f"<main> {cost:8.1f}s  {fname.split('.')[0]}" + ("" if idx is None else f" turn {idx}"))
@@ -0,0 +1,224 @@
+import argparse
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+
+# Sharded runs. With --shard i/N, a worker runs the i-th of N parts of the cases of a run, balanced
+# by estimated prompt tokens, and writes them to <output_dir>/shards/<i>of<N>. The shard dirs keep
+# their prompts in their own store (<output_dir>/shards/.store), so they can be produced on other
+# machines and copied back. Merging moves their finished cases into the output dir, which is then
+# the same as that of an unsharded run.
+#
+#   python shards.py --workers N <run_models.py arguments>     run N local workers, then merge
+#   python shards.py --merge_only <run_models.py arguments>    merge shard dirs copied from elsewhere
+
+SHARD_DIR_PATTERN = re.compile(r"(\d+)of(\d+)")
+
+def parse_shard(shard):
+    """Parse "i/N" into (i, N), with 0 <= i < N"""
+    match = re.fullmatch(r"(\d+)/(\d+)", shard)
+    if match is None or not int(match.group(1)) < int(match.group(2)):
+        raise ValueError(f"<parse_shard> Expected i/N with 0 <= i < N, got {shard}")
+    return int(match.group(1)), int(match.group(2))
+
+def get_shards_dir(output_dir):
+    return os.path.join(output_dir, "shards")
+
+def get_shard_dir(output_dir, shard):
+    return os.path.join(get_shards_dir(output_dir), f"{shard[0]}of{shard[1]}")
+
+def prepare_shard_dir(output_dir, shard):
+    """Make the dir of a shard, with the metadata of the run and the shard"""
+    shard_dir = get_shard_dir(output_dir, shard)
+    os.makedirs(shard_dir, exist_ok=True)
+    with open(os.path.join(output_dir, 'metadata.json'), 'r') as file:
+        metadata = json.load(file)
+    with open(os.path.join(shard_dir, 'metadata.json'), 'w') as file:
+        json.dump({**metadata, 'shard': f"{shard[0]}/{shard[1]}"}, file, indent=2)
+    return shard_dir
+
+def balance_shards(fnames, n_shards, costs):
+    """
+    Split fnames into n_shards parts of similar total cost: the most expensive case goes to the part
+    with the least cost so far, ties to the lowest part. Each part keeps the order of fnames.
+    """
+    parts = [[] for _ in range(n_shards)]
+    loads = [0] * n_shards
+    for i in sorted(range(len(fnames)), key=lambda i: (-costs[i], i)):
+        part = min(range(n_shards), key=lambda j: (loads[j], j))
+        parts[part].append(i)
+        loads[part] += costs[i]
+    return [[fnames[i] for i in sorted(part)] for part in parts]
+
+def check_case(shard_dir, case_name):
+    """Return why the outputs of a finished case in a shard dir are unusable, or None"""
+    from output_store import read_outputs
+
+    with open(os.path.join(shard_dir, case_name + '.jsonl'), 'r') as file:
+        n_answers = sum(1 for _ in file)
+    try:
+        outputs = read_outputs(shard_dir, case_name)  # Also loads every prompt from the store
+    except (OSError, EOFError, json.JSONDecodeError) as e:
+        return f"unreadable outputs ({type(e).__name__}: {e})"
+    if outputs is None:
+        return "no outputs file"
+    if len(outputs) != n_answers:
+        return f"{n_answers} answers but {len(outputs)} outputs"
+    return None
+
+def copy_prompt_store(source_dir, target_dir):
+    """Copy the prompts of one store into another, skipping those it already holds"""
+    for root, _, fnames in os.walk(os.path.join(source_dir, "prompts")):
+        for fname in fnames:
+            if fname.endswith(".tmp"):  # Left by an interrupted write
+                continue
+            target = os.path.join(target_dir, os.path.relpath(os.path.join(root, fname), source_dir))
+            if not os.path.exists(target):
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                shutil.copyfile(os.path.join(root, fname), target + ".tmp")
+                os.replace(target + ".tmp", target)
+
+def merge_shards(output_dir, fnames, dry_run=False):
+    """
+    Validate the shard dirs of a run and move their finished cases, metrics and conversation token
+    records into the output dir. Nothing is moved if any shard dir is inconsistent: shards of
+    different N, a case finished in two shards, or a finished case whose outputs do not match its
+    answers or miss prompts. Shard dirs with unfinished cases are kept, so that rerunning their
+    worker resumes them. Return the cases of fnames that are still missing from the output dir.
+    """
+    from output_store import get_outputs_path, get_legacy_outputs_path, get_prompt_store
+    from run_metrics import get_metrics_path
+    from run_models import get_conversation_tokens_path
+
+    shards_dir = get_shards_dir(output_dir)
+    shard_names = []
+    if os.path.isdir(shards_dir):
+        shard_names = sorted(
+            (name for name in os.listdir(shards_dir) if SHARD_DIR_PATTERN.fullmatch(name)),
+            key=lambda name: int(SHARD_DIR_PATTERN.fullmatch(name).group(1))
+        )
+    problems = []
+    n_shards = {int(SHARD_DIR_PATTERN.fullmatch(name).group(2)) for name in shard_names}
+    if len(n_shards) > 1:
+        problems.append(f"shards of different splits: {', '.join(shard_names)}")
+    owners = {}  # Finished case name: shard dir
+    for name in shard_names:
+        shard_dir = os.path.join(shards_dir, name)
+        for fname in sorted(os.listdir(shard_dir)):
+            if not fname.endswith('.jsonl') or fname == os.path.basename(get_metrics_path(shard_dir)):
+                continue
+            case_name = fname[:-len('.jsonl')]
+            if case_name in owners:
+                problems.append(f"{case_name} is finished in both {os.path.basename(owners[case_name])} and {name}")
+                continue
+            owners[case_name] = shard_dir
+            problem = check_case(shard_dir, case_name)
+            if problem is not None:
+                problems.append(f"{name}/{case_name}: {problem}")
+    for problem in problems:
+        print(f"<merge_shards> {problem}")
+    if problems:
+        raise ValueError(f"<merge_shards> {len(problems)} problems in {shards_dir}, nothing was merged")
+
+    if not dry_run and shard_names:
+        copy_prompt_store(os.path.join(shards_dir, ".store"), get_prompt_store(output_dir).store_dir)
+        for case_name, shard_dir in owners.items():
+            for path in [get_outputs_path(shard_dir, case_name), get_legacy_outputs_path(shard_dir, case_name)]:
+                if os.path.exists(path):
+                    os.replace(path, os.path.join(output_dir, os.path.basename(path)))
+            # The answers last, as they mark the case as done
+            os.replace(os.path.join(shard_dir, case_name + '.jsonl'), os.path.join(output_dir, case_name + '.jsonl'))
+        for name in shard_names:
+            shard_dir = os.path.join(shards_dir, name)
+            metrics_path = get_metrics_path(shard_dir)
+            if os.path.exists(metrics_path):
+                with open(metrics_path, 'r') as source, open(get_metrics_path(output_dir), 'a') as target:
+                    shutil.copyfileobj(source, target)
+                os.remove(metrics_path)
+            tokens_path = get_conversation_tokens_path(shard_dir)
+            if os.path.exists(tokens_path):
+                records = {}
+                if os.path.exists(get_conversation_tokens_path(output_dir)):
+                    with open(get_conversation_tokens_path(output_dir), 'r') as file:
+                        records = json.load(file)
+                with open(tokens_path, 'r') as file:
+                    records.update(json.load(file))
+                with open(get_conversation_tokens_path(output_dir), 'w') as file:
+                    json.dump(records, file, indent=2)
+                os.remove(tokens_path)
+            checkpoints_dir = os.path.join(shard_dir, "checkpoints")
+            if not (os.path.isdir(checkpoints_dir) and os.listdir(checkpoints_dir)):
+                shutil.rmtree(shard_dir)
+        if not any(SHARD_DIR_PATTERN.fullmatch(name) for name in os.listdir(shards_dir)):
+            shutil.rmtree(os.path.join(shards_dir, ".store"), ignore_errors=True)
+            if not os.listdir(shards_dir):  # Worker logs are kept
+                os.rmdir(shards_dir)
+        print(f"<merge_shards> Merged {len(owners)} cases from {len(shard_names)} shards into {output_dir}")
+
+    done = set(owners) if dry_run else set()
+    missing = [
+        fname for fname in fnames
+        if fname.split('.')[0] not in done and not os.path.exists(os.path.join(output_dir, fname.split('.')[0] + '.jsonl'))
+    ]
+    if missing:
+        print(f"<merge_shards> {len(missing)} cases are not finished yet: {', '.join(fname.split('.')[0] for fname in missing)}")
+    return missing
+
+def get_run_fnames(data_dir, output_dir, CASE):
+    """Cases of a run that have outputs once it is complete. Cases without turns have none"""
+    from run_models import get_fnames, load_case
+
+    return [
+        fname for fname in get_fnames(data_dir, output_dir, CASE, eval=True, verbose=False)
+        if load_case(os.path.join(data_dir, fname)).turns
+    ]
+
+def parse_launcher_arguments():
+    parser = argparse.ArgumentParser(description='Run a run_models.py run as sharded workers and merge their outputs', add_help=False)
+    parser.add_argument('--workers', type=int, default=None, help='number of local worker processes, each with --shard i/N')
+    parser.add_argument('--merge_only', action='store_true', help='only validate and merge the shard dirs of the run')
+    parser.add_argument('--dry_run', action='store_true', help='only validate the shard dirs of the run')
+    parser.add_argument('--split_env', type=str, action='append', default=[], help='give worker i the value of <VAR>_<i> as VAR, when set, e.g. one API key per worker; can be repeated')
+    return parser
+
+def launch_workers(run_args, n_workers, output_dir, split_env=()):
+    """Run one run_models.py process per shard, logging to <output_dir>/shards/<i>of<N>.log. Return their exit codes"""
+    os.makedirs(get_shards_dir(output_dir), exist_ok=True)
+    workers = []
+    for i in range(n_workers):
+        env = dict(os.environ)
+        for var in split_env:
+            if f"{var}_{i}" in os.environ:
+                env[var] = os.environ[f"{var}_{i}"]
+        log_path = os.path.join(get_shards_dir(output_dir), f"{i}of{n_workers}.log")
+        log = open(log_path, 'w')
+        workers.append((subprocess.Popen(
+            [sys.executable, "run_models.py", *run_args, "--shard", f"{i}/{n_workers}"],
+            stdout=log, stderr=subprocess.STDOUT, env=env
+        ), log, log_path))
+        print(f"<launch_workers> Started shard {i}/{n_workers}, logging to {log_path}")
+    codes = []
+    for process, log, log_path in workers:
+        codes.append(process.wait())
+        log.close()
+        print(f"<launch_workers> {log_path}: exit code {codes[-1]}")
+    return codes
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+    from run_models import parse_arguments, prepare_output_dir
+    from sweep import get_data_dir
+
+    load_dotenv("../.env")  # So that --split_env finds the keys kept there
+    launcher_args, run_args = parse_launcher_arguments().parse_known_args()
+    args = parse_arguments().parse_args(run_args)
+    if args.shard is not None:
+        raise ValueError("<main> Shards are set by --workers, do not pass --shard")
+    output_dir = prepare_output_dir(args.model, args.prompt, args.context, args.case, args.no_description, args.data, args.layout)
+    if launcher_args.workers is not None and not launcher_args.merge_only:
+        launch_workers(run_args, launcher_args.workers, output_dir, launcher_args.split_env)
+    missing = merge_shards(output_dir, get_run_fnames(get_data_dir(args.data), output_dir, args.case), launcher_args.dry_run)
+    sys.exit(1 if missing else 0)
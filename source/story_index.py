@@ -0,0 +1,143 @@
+import math
+import re
+from collections import Counter
+
+# Lexical (BM25) index over the story of a case, for --context retrieve. The story is split into
+# chunks of a few sentences that never cross a turn boundary; a turn retrieves only from the
+# previous context and the new contexts up to its own, ranked against its testimonies and evidences.
+
+CHUNK_WORDS = 60  # Chunks are whole sentences, cut once they reach this many words
+RETRIEVE_TOKENS = 2048  # Story tokens per prompt, unless the context window of the model is smaller
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+STOPWORDS = set("""
+a an and are as at be been but by did do does for from had has have he her him his i if in into is it its
+me my no not of on or our she so than that the their them then there they this to was we were what when
+where which who why will with would you your
+""".split())
+
+def normalize(text):
+    return re.sub(r'\s+', ' ', text).strip()
+
+def tokenize(text):
+    return [word for word in re.findall(r"[a-z0-9]+", text.lower()) if word not in STOPWORDS]
+
+def split_sentences(text):
+    return [sentence for sentence in re.split(r'(?<=[.!?…])\s+', text) if sentence]
+
+class StoryIndex:
+    """
+    BM25 over the chunks of a story given as segments (previous context, then one new context per
+    turn). Segments are whitespace-normalised; the chunks of a segment, joined with a space, give
+    it back, so that character offsets of a segment map to chunks.
+    """
+    def __init__(self, segments, chunk_words=CHUNK_WORDS):
+        self.segments = [normalize(segment) for segment in segments]
+        self.chunks = []  # (segment, start, end) offsets in the normalised segment
+        for segment, text in enumerate(self.segments):
+            start, words, sentences = 0, 0, []
+            for sentence in split_sentences(text):
+                sentences.append(sentence)
+                words += len(sentence.split())
+                if words >= chunk_words:
+                    self._add_chunk(segment, start, sentences)
+                    start += len(" ".join(sentences)) + 1
+                    words, sentences = 0, []
+            if sentences:
+                self._add_chunk(segment, start, sentences)
+        self.term_counts = [Counter(tokenize(self.text(chunk))) for chunk in range(len(self.chunks))]
+        self.lengths = [sum(counts.values()) for counts in self.term_counts]
+        self._document_frequencies = {}
+
+    def _add_chunk(self, segment, start, sentences):
+        self.chunks.append((segment, start, start + len(" ".join(sentences))))
+
+    def text(self, chunk):
+        segment, start, end = self.chunks[chunk]
+        return self.segments[segment][start:end]
+
+    def visible(self, n_segments):
+        """Chunks of the first n_segments segments"""
+        return [chunk for chunk, (segment, _, _) in enumerate(self.chunks) if segment < n_segments]
+
+    def document_frequencies(self, n_segments):
+        if n_segments not in self._document_frequencies:
+            frequencies = Counter()
+            for chunk in self.visible(n_segments):
+                frequencies.update(self.term_counts[chunk].keys())
+            self._document_frequencies[n_segments] = frequencies
+        return self._document_frequencies[n_segments]
+
+    def search(self, query, n_segments):
+        """Return the visible chunks by decreasing BM25 score against a {term: weight} query"""
+        chunks = self.visible(n_segments)
+        if not chunks:
+            return []
+        frequencies = self.document_frequencies(n_segments)
+        average_length = sum(self.lengths[chunk] for chunk in chunks) / len(chunks) or 1
+        idf = {
+            term: math.log(1 + (len(chunks) - frequencies[term] + 0.5) / (frequencies[term] + 0.5))
+            for term in query if frequencies[term]
+        }
+        scores = []
+        for chunk in chunks:
+            counts = self.term_counts[chunk]
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * self.lengths[chunk] / average_length)
+            score = sum(
+                weight * idf[term] * counts[term] * (BM25_K1 + 1) / (counts[term] + norm)
+                for term, weight in query.items() if term in idf and counts[term]
+            )
+            if score > 0:
+                scores.append((score, chunk))
+        return [chunk for _, chunk in sorted(scores, key=lambda item: (-item[0], item[1]))]
+
+    def find(self, span, n_segments):
+        """Chunks covering a verbatim occurrence of span in the first n_segments segments, or None"""
+        span = normalize(span)
+        if not span:
+            return None
+        for segment in range(min(n_segments, len(self.segments))):
+            start = self.segments[segment].find(span)
+            if start != -1:
+                end = start + len(span)
+                return [
+                    chunk for chunk, (chunk_segment, chunk_start, chunk_end) in enumerate(self.chunks)
+                    if chunk_segment == segment and chunk_start < end and start < chunk_end
+                ]
+        return None
+
+    def select(self, query, spans, n_segments, max_tokens, count):
+        """
+        Pick the chunks of a turn: first those holding the spans (a span found nowhere in the story
+        is kept as its own excerpt), then the best BM25 matches while they fit in max_tokens.
+        Return the excerpts in story order, contiguous chunks merged.
+        """
+        picked, extra, used = [], [], 0
+        for span in spans:
+            chunks = self.find(span, n_segments)
+            if chunks is None:
+                if normalize(span) not in extra:
+                    extra.append(normalize(span))
+                    used += count(normalize(span))
+                continue
+            for chunk in chunks:
+                if chunk not in picked:
+                    picked.append(chunk)
+                    used += count(self.text(chunk))
+        for chunk in self.search(query, n_segments):
+            if chunk in picked:
+                continue
+            tokens = count(self.text(chunk))
+            if used + tokens > max_tokens:
+                continue  # A shorter chunk further down may still fit
+            picked.append(chunk)
+            used += tokens
+        excerpts, previous = [], None
+        for chunk in sorted(picked):
+            if previous is not None and chunk == previous + 1 and self.chunks[chunk][0] == self.chunks[previous][0]:
+                excerpts[-1] += " " + self.text(chunk)
+            else:
+                excerpts.append(self.text(chunk))
+            previous = chunk
+        return excerpts + extra
@@ -0,0 +1,185 @@
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import sys
+import time
+
+from run_models import get_output_dir, prepare_output_dir, get_fnames, load_model, resolve_model, get_provider, \
+    run_job, run_job_async, run_batch_job, run_local_batch_job, estimate_case_tokens
+from shards import parse_shard, get_shard_dir, prepare_shard_dir, merge_shards, get_run_fnames
+from rate_control import get_controller
+from hedging import get_hedger
+from response_cache import ResponseCache
+
+# Run a grid of (model, prompt, context, no_description, data, layout) configurations in one process.
+# Cases are parsed and their prompt fragments compiled once (run_models.load_case), each model is
+# loaded once, and the configurations of different providers run at the same time.
+
+GRID_KEYS = ["model", "prompt", "context", "no_description", "data", "layout"]
+
+def parse_sweep_arguments():
+    parser = argparse.ArgumentParser(description='Run a grid of configurations in one process')
+    parser.add_argument('spec', type=str, help='grid spec json: a value or a list of values for each of ' + ", ".join(GRID_KEYS) + ', and an optional case')
+    parser.add_argument('--concurrency', type=int, default=32, help='maximum number of requests in flight per api provider, across configurations')
+    parser.add_argument('--cache', type=str, default='on', choices=['on', 'replay', 'off'], help='Response cache mode, as in run_models.py')
+    parser.add_argument('--stream', action='store_true', help='Stream responses, as in run_models.py')
+    parser.add_argument('--early_stop', action='store_true', help='End each response once its answer line is complete, as in run_models.py')
+    parser.add_argument('--prefix_cache', action='store_true', help='Reuse the KV cache of shared prompt prefixes for local models, as in run_models.py')
+    parser.add_argument('--batch_size', type=int, default=None, help='Generate local model turns in batches of this size, as in run_models.py')
+    parser.add_argument('--server', type=str, default=None, help='Send local model requests to this running model_server.py, as in run_models.py')
+    parser.add_argument('--timeout', type=float, default=None, help='Seconds before an API request is given up on and sent again (up to 8 times), as in run_models.py')
+    parser.add_argument('--hedge', action='store_true', help='Hedge API turns slower than the p95 latency of their model, as in run_models.py')
+    parser.add_argument('--shard', type=str, default=None, help='i/N: only run the i-th (from 0) of N parts of the cases of every configuration, as in run_models.py')
+    parser.add_argument('--merge', action='store_true', help='instead validate and merge the shard dirs of every configuration, see shards.py')
+    parser.add_argument('--dry_run', action='store_true', help='only list the configurations and their number of new cases')
+    return parser
+
+def expand_grid(spec):
+    """Return the list of configurations of a grid spec, as dicts with the run_models.py argument names"""
+    defaults = {"context": [None], "no_description": [False], "data": ["aceattorney"], "layout": ["default"]}
+    values = []
+    for key in GRID_KEYS:
+        value = spec.get(key, defaults.get(key))
+        if value is None:
+            raise ValueError(f"<expand_grid> The spec has no {key}")
+        values.append(value if isinstance(value, list) else [value])
+    configs = []
+    for combination in itertools.product(*values):
+        config = dict(zip(GRID_KEYS, combination))
+        config["case"] = spec.get("case", "ALL")
+        configs.append(config)
+    return configs
+
+def get_data_dir(DATA):
+    if DATA == 'aceattorney':
+        return '../data/aceattorney_data/final'
+    elif DATA == 'danganronpa':
+        return '../data/danganronpa_data/final'
+    raise ValueError(f"<get_data_dir> Unknown dataset: {DATA}")
+
+def is_batch_config(config):
+    # Same test as run_models.py
+    return any(name in config["model"] for name in ["o3", "o4", "gpt"]) and config["context"] != "conversation"
+
+def is_local_model(MODEL):
+    return "/" in resolve_model(MODEL)  # Same test as load_model
+
+def prepare_config(config, dry_run=False, shard=None):
+    """Make the output dir of a configuration and collect its new cases. With shard, those of the shard dir"""
+    make_dir = get_output_dir if dry_run else prepare_output_dir
+    output_dir = make_dir(
+        config["model"], config["prompt"], config["context"], config["case"], config["no_description"], config["data"],
+        config["layout"]
+    )
+    data_dir = get_data_dir(config["data"])
+    if shard is None:
+        fnames = get_fnames(data_dir, output_dir, config["case"], verbose=False)
+    elif is_batch_config(config):  # Batches are already run in parallel by the provider, so shard 0 submits them all
+        fnames = get_fnames(data_dir, output_dir, config["case"], verbose=False) if shard[0] == 0 else []
+    else:
+        fnames = get_fnames(data_dir, output_dir, config["case"], verbose=False, shard=shard, cost=lambda fname: estimate_case_tokens(
+            os.path.join(data_dir, fname), config["prompt"], config["context"], config["no_description"], config["model"], config["layout"]
+        ))
+        output_dir = get_shard_dir(output_dir, shard) if dry_run else prepare_shard_dir(output_dir, shard)
+    return output_dir, data_dir, fnames
+
+def job_args(config, fnames):
+    return (fnames, config["model"], config["prompt"], config["context"], config["no_description"])
+
+def run_local_configs(configs, cache, stream=False, early_stop=False, prefix_cache=False, batch_size=None):
+    """Local models hold the GPU, so their configurations run one model at a time"""
+    import torch
+
+    for MODEL, model_configs in itertools.groupby(configs, key=lambda config: config[0]["model"]):
+        client, client_name = load_model(MODEL, prefix_cache=prefix_cache)
+        for config, output_dir, data_dir, fnames in model_configs:
+            if batch_size is not None and config["context"] != "conversation":
+                run_local_batch_job(
+                    *job_args(config, fnames), client, client_name, output_dir, data_dir, batch_size, cache, early_stop, config["layout"]
+                )
+                continue
+            run_job(*job_args(config, fnames), client, client_name, output_dir, data_dir, cache, stream, early_stop, config["layout"])
+        del client
+        torch.cuda.empty_cache()
+
+async def run_sweep(configs, concurrency, cache, stream=False, early_stop=False, prefix_cache=False, batch_size=None, server=None,
+                    timeout=None, hedge=False):
+    async_configs, batch_configs, local_configs = [], [], []
+    for config, output_dir, data_dir, fnames in configs:
+        if not fnames:
+            continue
+        if is_batch_config(config):
+            batch_configs.append((config, output_dir, data_dir, fnames))
+        elif is_local_model(config["model"]) and server is None:  # Served models run as api models
+            local_configs.append((config, output_dir, data_dir, fnames))
+        else:
+            async_configs.append((config, output_dir, data_dir, fnames))
+
+    clients = {}
+    semaphores = {}  # One per provider, shared by all of its configurations
+    jobs, names = [], []
+    for config, output_dir, data_dir, fnames in async_configs:
+        if config["model"] not in clients:
+            clients[config["model"]] = load_model(config["model"], async_client=True, server=server)
+        client, client_name = clients[config["model"]]
+        get_hedger(client_name, timeout=timeout, hedge=hedge)
+        provider = get_provider(client_name)
+        if provider not in semaphores:
+            semaphores[provider] = asyncio.Semaphore(concurrency)
+        jobs.append(run_job_async(
+            *job_args(config, fnames), client, client_name, output_dir, data_dir, concurrency, cache,
+            semaphore=semaphores[provider], stream=stream, early_stop=early_stop, layout=config["layout"]
+        ))
+        names.append(output_dir)
+    for config, output_dir, data_dir, fnames in batch_configs:  # Submissions upload files, so run them in threads
+        if config["model"] not in clients:
+            clients[config["model"]] = load_model(config["model"])
+        client, _ = clients[config["model"]]
+        jobs.append(asyncio.to_thread(
+            run_batch_job, *job_args(config, fnames), client, output_dir, data_dir, cache, layout=config["layout"]
+        ))
+        names.append(output_dir)
+    if local_configs:
+        jobs.append(asyncio.to_thread(
+            run_local_configs, sorted(local_configs, key=lambda c: c[0]["model"]), cache, stream, early_stop, prefix_cache, batch_size
+        ))
+        names.append(f"{len(local_configs)} local model configurations")
+
+    print(f"<run_sweep> Running {len(async_configs)} async, {len(batch_configs)} batch and {len(local_configs)} local configurations")
+    results = await asyncio.gather(*jobs, return_exceptions=True)
+    for name, result in zip(names, results):
+        if isinstance(result, BaseException):
+            print(f"<run_sweep> {name} failed: {type(result).__name__}: {result}")
+    for provider in semaphores:
+        print(f"<run_sweep> {get_controller(provider).summary()}")
+
+if __name__ == "__main__":
+    args = parse_sweep_arguments().parse_args()
+    with open(args.spec, "r") as file:
+        configs = expand_grid(json.load(file))
+
+    if args.merge:
+        n_missing = 0
+        for config in configs:
+            if is_batch_config(config):
+                continue
+            output_dir, data_dir, _ = prepare_config(config, dry_run=True)
+            n_missing += len(merge_shards(output_dir, get_run_fnames(data_dir, output_dir, config["case"]), args.dry_run))
+        sys.exit(1 if n_missing else 0)
+
+    shard = parse_shard(args.shard) if args.shard is not None else None
+    configs = [(config, *prepare_config(config, args.dry_run, shard)) for config in configs]
+    for config, output_dir, data_dir, fnames in configs:
+        print(f"<main> {output_dir}: {len(fnames)} new cases")
+    if args.dry_run:
+        sys.exit()
+
+    cache = ResponseCache(mode=args.cache)
+    start = time.perf_counter()
+    asyncio.run(run_sweep(
+        configs, args.concurrency, cache, args.stream, args.early_stop, args.prefix_cache, args.batch_size, args.server, args.timeout, args.hedge
+    ))
+    print(f"<main> Cache: {cache.summary()}")
+    print(f"<main> Sweep finished in {time.perf_counter() - start:.1f}s")
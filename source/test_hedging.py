@@ -0,0 +1,132 @@
+import asyncio
+import time
+
+import pytest
+
+# Tests of deadlines, hedging and AIMD against mock_openai_server.py started in-process: turns are
+# answered by run_model and run_model_async as in a run, and the mock is scripted with the latency
+# or the 429 of each chat completion, in the order they arrive. Run from source/ with
+# python -m pytest test_hedging.py
+
+openai = pytest.importorskip("openai")
+
+import hedging
+import rate_control
+from mock_openai_server import serve
+from run_models import run_model, run_model_async
+
+MODEL = "mock/model"  # Goes to the "local" provider, as with --server
+PROMPT = "Which evidence contradicts which testimony?"
+ANSWER = {"evidence": 0, "testimony": 0}
+
+@pytest.fixture
+def server(monkeypatch):
+    """The mock on a free port, with fresh rate controllers and hedgers"""
+    monkeypatch.setattr(rate_control, "CONTROLLERS", {})
+    monkeypatch.setattr(hedging, "HEDGERS", {})
+    server = serve(port=0)
+    yield server
+    server.shutdown()
+
+def clients(server):
+    """Sync and async clients of the mock, which leave retries to the rate controller as load_model does"""
+    base_url = f"http://127.0.0.1:{server.server_address[1]}/v1"
+    return (openai.OpenAI(api_key="mock", base_url=base_url, max_retries=0),
+            openai.AsyncOpenAI(api_key="mock", base_url=base_url, max_retries=0))
+
+def script(server, latencies=(), rate_limited=()):
+    """Give the chat completions these latencies and 429s in turn, then none. Return their arrival times"""
+    latencies, rate_limited = iter(latencies), iter(rate_limited)
+    arrivals = []
+    def request_latency(body):
+        arrivals.append(time.perf_counter())
+        return next(latencies, 0.0)
+    server.state.request_latency = request_latency
+    server.state.rate_limited = lambda: next(rate_limited, False)
+    return arrivals
+
+def wait_until(condition, timeout=5.0):
+    deadline = time.perf_counter() + timeout
+    while not condition():
+        assert time.perf_counter() < deadline
+        time.sleep(0.05)
+
+def seed(hedger, latency, n=hedging.MIN_HEDGE_SAMPLES):
+    for _ in range(n):
+        hedger.observe(latency)
+
+def test_request_abandoned_at_deadline(server):
+    script(server, [2.0])
+    client, _ = clients(server)
+    controller = rate_control.get_controller("local", initial_concurrency=4, base_delay=0.1)
+    hedger = hedging.get_hedger(MODEL, timeout=0.5)
+    start = time.perf_counter()
+    answers, _, has_error = run_model([PROMPT], client, MODEL)
+    assert not has_error and answers == [ANSWER]
+    assert time.perf_counter() - start < 1.5  # Sent again at the deadline, not after the slow request
+    assert hedger.stats["timeouts"] == 1 and controller.stats["retries"] == 1
+    assert controller.stats["throttled"] == 0 and controller.limit > 4  # A missed deadline is no rate limit
+    assert controller.in_flight == 1  # The request given up on keeps its slot while it runs
+    wait_until(lambda: controller.in_flight == 0)
+
+def test_async_request_abandoned_at_deadline(server):
+    script(server, [2.0])
+    _, client = clients(server)
+    controller = rate_control.get_controller("local", initial_concurrency=4, base_delay=0.1)
+    hedger = hedging.get_hedger(MODEL, timeout=0.5)
+    start = time.perf_counter()
+    answer, _, has_error = asyncio.run(run_model_async(PROMPT, client, MODEL, asyncio.Semaphore(4)))
+    assert not has_error and answer == ANSWER
+    assert time.perf_counter() - start < 1.5
+    assert hedger.stats["timeouts"] == 1 and controller.limit > 4
+    assert controller.in_flight == 0  # Cancelled at the deadline
+
+def test_no_hedge_before_p95(server):
+    script(server, [0.05])
+    client, _ = clients(server)
+    hedger = hedging.get_hedger(MODEL, hedge=True, min_delay=0.1)
+    seed(hedger, 0.5)
+    metrics = []
+    run_model([PROMPT], client, MODEL, on_metrics=lambda i, turn_metrics: metrics.append(turn_metrics))
+    assert server.state.stats["requests"] == 1
+    assert metrics[0]["hedged"] is False and hedger.stats["hedged"] == 0
+
+def test_hedge_after_p95_keeps_winner(server):
+    arrivals = script(server, [1.5])
+    client, _ = clients(server)
+    controller = rate_control.get_controller("local", initial_concurrency=4)
+    hedger = hedging.get_hedger(MODEL, hedge=True, min_delay=0.1)
+    seed(hedger, 0.3)
+    metrics = []
+    answers, _, has_error = run_model([PROMPT], client, MODEL, on_metrics=lambda i, turn_metrics: metrics.append(turn_metrics))
+    assert not has_error and answers == [ANSWER]
+    assert arrivals[1] - arrivals[0] > 0.25  # Hedged once the first request had run for the p95
+    assert metrics[0]["hedged"] and metrics[0]["hedge_won"] and metrics[0]["turn_latency"] < 1.0
+    assert hedger.stats == {"turns": 1, "hedged": 1, "hedge_wins": 1, "timeouts": 0}
+    assert controller.in_flight == 1  # A sync loser cannot be stopped and runs to its end
+    wait_until(lambda: controller.in_flight == 0)
+
+def test_async_hedge_cancels_loser(server):
+    arrivals = script(server, [3.0])
+    _, client = clients(server)
+    controller = rate_control.get_controller("local", initial_concurrency=4)
+    hedger = hedging.get_hedger(MODEL, hedge=True, min_delay=0.1)
+    seed(hedger, 0.3)
+    metrics = []
+    answer, _, has_error = asyncio.run(run_model_async(PROMPT, client, MODEL, asyncio.Semaphore(4), on_metrics=metrics.append))
+    assert not has_error and answer == ANSWER
+    assert len(arrivals) == 2 and arrivals[1] - arrivals[0] > 0.25
+    assert metrics[0]["hedged"] and metrics[0]["hedge_won"] and metrics[0]["turn_latency"] < 1.0
+    assert controller.in_flight == 0  # The first request was cancelled instead of running on for 3 s
+    assert hedger.latencies[-1] >= 0.3  # and counts with the time it ran
+
+def test_aimd_recovers_after_rate_limits(server):
+    script(server, rate_limited=[True, True])
+    client, _ = clients(server)
+    controller = rate_control.get_controller("local", initial_concurrency=8, base_delay=0.01)
+    limits = []
+    answers, _, has_error = run_model([PROMPT] * 40, client, MODEL, on_turn=lambda i, answer_json, cot: limits.append(controller.limit))
+    assert not has_error and answers == [ANSWER] * 40
+    assert controller.stats["throttled"] == 2 and controller.stats["retries"] == 2
+    assert limits[0] == pytest.approx(4.25)  # Halved once for the burst of two 429s, then one success
+    assert limits == sorted(limits) and limits[-1] > 8  # Grown back by the successes
@@ -0,0 +1,50 @@
+import os
+
+import pytest
+
+# Regression test for the sessions of Hugging Face runs: run_model answers every turn prompt on one
+# Kani client, as a run does, and each prompt must reach the engine alone, without the earlier
+# prompts and answers of the run. Run from source/ with python -m pytest test_local_sessions.py
+
+pytest.importorskip("kani")
+pytest.importorskip("transformers")
+
+SOURCE_DIR = os.path.dirname(os.path.abspath(__file__))
+N_CASES = 2
+
+@pytest.fixture
+def sessions(monkeypatch):
+    """The turn prompts of the first cases, a client as load_model makes it, and what its engine received"""
+    monkeypatch.chdir(SOURCE_DIR)  # Prompts, data and the tiny model are found relative to source/
+    from kani import Kani
+    from kani.engines.huggingface import HuggingEngine
+    from bench_local import build_tiny_model, load_prompts
+
+    received = []
+
+    class RecordingEngine(HuggingEngine):
+        async def predict(self, messages, functions=None, **hyperparams):
+            received.append(list(messages))
+            return await super().predict(messages, functions, **hyperparams)
+
+    engine = RecordingEngine(build_tiny_model(), device="cpu", max_new_tokens=2)
+    client = Kani(engine, system_prompt="")  # As load_model
+    cases = load_prompts('../data/aceattorney_data/final', N_CASES, 'base', None, 'default')
+    return cases, client, received
+
+def test_each_turn_is_sent_alone(sessions):
+    from run_models import run_model, run_local
+    from kani import ChatMessage, ChatRole
+
+    cases, client, received = sessions
+    for prompts in cases:
+        metrics = []
+        start = len(received)
+        run_model(prompts, client, "local", on_metrics=lambda i, turn_metrics: metrics.append(turn_metrics))
+        assert len(received) - start == len(prompts)
+        for prompt, messages, turn_metrics in zip(prompts, received[start:], metrics):
+            assert all(message.role == ChatRole.SYSTEM for message in messages[:-1])
+            assert messages[-1].role == ChatRole.USER and messages[-1].text == prompt
+            # Prefill stays that of the turn alone instead of growing over the case
+            alone = run_local(client.engine.prompt_len(client.always_included_messages + [ChatMessage.user(prompt)]))
+            assert turn_metrics["prompt_tokens"] == alone
@@ -0,0 +1,149 @@
+import threading
+from concurrent.futures import Future
+from email.utils import formatdate
+
+import pytest
+
+import rate_control
+from rate_control import RateController, parse_duration
+
+# Unit tests of rate_control.py on a fake clock: the token bucket, the AIMD limit, the pauses asked
+# for by rate limit headers and the slots kept by sync requests given up on. Errors are injected
+# by the request functions. Run from source/ with python -m pytest test_rate_control.py
+
+class FakeClock:
+    """Stands in for the time module of rate_control.py. Sleeping moves the clock on at once"""
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+class APIError(Exception):
+    """An error with a status code and response headers, as the openai client raises them"""
+    def __init__(self, status_code, headers=None):
+        super().__init__(f"Error code: {status_code}")
+        self.status_code = status_code
+        self.headers = headers or {}
+
+def failing(*errors):
+    """A request function that raises the errors in turn, then succeeds"""
+    errors = list(errors)
+    def request():
+        if errors:
+            raise errors.pop(0)
+        return "response"
+    return request
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(rate_control, "time", clock)  # Before any controller reads the time
+    return clock
+
+def test_token_bucket_caps_the_rate(clock):
+    controller = RateController("test", requests_per_second=2)
+    assert [controller._wait_time() for _ in range(2)] == [0.0, 0.0]  # A burst of the bucket capacity
+    assert controller._wait_time() == pytest.approx(0.5)
+    clock.sleep(0.5)
+    assert controller._wait_time() == 0.0
+    clock.sleep(60)  # Idle time refills the bucket only up to its capacity
+    assert [controller._wait_time() for _ in range(3)] == [0.0, 0.0, pytest.approx(0.5)]
+
+def test_call_sleeps_between_requests(clock):
+    controller = RateController("test", requests_per_second=2)
+    for _ in range(6):
+        assert controller.call(failing()) == "response"
+    assert sum(clock.slept) == pytest.approx(2.0)  # The 4 requests after the burst, at 2 a second
+    assert controller.stats["requests"] == 6
+
+def test_aimd_increase(clock):
+    controller = RateController("test", initial_concurrency=4, max_concurrency=6)
+    controller.on_success({})
+    assert controller.limit == pytest.approx(4.25)
+    for _ in range(3):
+        controller.on_success({})
+    assert 4.9 < controller.limit < 5  # About one slot per window of successes
+    for _ in range(100):
+        controller.on_success({})
+    assert controller.limit == 6
+
+def test_aimd_decrease_once_per_burst(clock):
+    controller = RateController("test", initial_concurrency=8, min_concurrency=1)
+    controller.on_throttle({})
+    controller.on_throttle({})
+    assert controller.limit == 4
+    clock.sleep(1.5)
+    controller.on_throttle({})
+    assert controller.limit == 2
+    for _ in range(5):
+        clock.sleep(1.5)
+        controller.on_throttle({})
+    assert controller.limit == 1
+    assert controller.stats["throttled"] == 8
+
+def test_only_rate_limits_decrease(clock):
+    controller = RateController("test", initial_concurrency=8, base_delay=0)
+    request = failing(TimeoutError(), APIError(503), APIError(429))
+    assert controller.call(request) == "response"
+    assert controller.limit == pytest.approx(4.25)  # Halved by the 429 only, then one success
+    assert controller.stats == {"requests": 4, "successes": 1, "throttled": 1, "retries": 3, "failures": 0}
+
+def test_call_gives_up(clock):
+    controller = RateController("test", max_retries=2, base_delay=0)
+    with pytest.raises(TimeoutError):
+        controller.call(failing(TimeoutError(), TimeoutError(), TimeoutError()))
+    with pytest.raises(APIError):
+        controller.call(failing(APIError(400)))  # Not retryable
+    assert controller.stats["retries"] == 2 and controller.stats["failures"] == 2
+    assert controller.in_flight == 0
+
+@pytest.mark.parametrize("headers, pause", [
+    ({"retry-after": "2"}, 2.0),
+    ({"retry-after-ms": "500", "retry-after": "2"}, 0.5),
+    ({"x-ratelimit-remaining-requests": "0", "x-ratelimit-reset-requests": "1m30s"}, 90.0),
+    ({"x-ratelimit-remaining-requests": "3", "x-ratelimit-reset-requests": "1m30s"}, 0.0),
+])
+def test_headers_pause_requests(clock, headers, pause):
+    controller = RateController("test")
+    controller.on_success(headers)  # Successful responses can ask for a pause too
+    assert controller._wait_time() == pytest.approx(pause)
+    clock.sleep(pause)
+    assert controller._wait_time() == 0.0
+
+def test_call_waits_out_retry_after(clock):
+    controller = RateController("test", base_delay=0)
+    assert controller.call(failing(APIError(429, {"retry-after": "3"}))) == "response"
+    assert clock.slept == [3.0]
+
+@pytest.mark.parametrize("value, seconds", [
+    ("1.5", 1.5), ("20ms", 0.02), ("6m0s", 360.0), ("1h", 3600.0), ("-3", 0.0), ("soon", None), (None, None)
+])
+def test_parse_duration(value, seconds):
+    assert parse_duration(value) == pytest.approx(seconds)
+
+def test_parse_duration_of_http_date(clock):
+    assert parse_duration(formatdate(clock.now + 30, usegmt=True)) == pytest.approx(30)
+
+def test_hold_keeps_a_slot_until_the_request_finishes(clock):
+    controller = RateController("test", initial_concurrency=1)
+    future = Future()
+    controller.hold(future)
+    assert controller.in_flight == 1
+
+    results = []
+    waiting = threading.Thread(target=lambda: results.append(controller.call(failing())))
+    waiting.start()
+    waiting.join(0.2)
+    assert waiting.is_alive() and not results  # The held slot is the only one
+    future.set_result(None)
+    waiting.join(5)
+    assert results == ["response"] and controller.in_flight == 0
@@ -0,0 +1,97 @@
+import argparse
+import asyncio
+import json
+import os
+
+from run_models import load_batch_manifest, save_batch_manifest, load_completion_index, resolve_model, \
+    BATCH_FAILED_STATUSES
+from evaluate import get_openai_client, get_pending_shards, poll_shard, evaluate_single_run
+
+# Watch every output dir with running batch shards at once: poll them concurrently, back off while
+# nothing changes, stream finished results to disk and optionally evaluate each run once it is done
+
+def parse_watch_arguments():
+    parser = argparse.ArgumentParser(description='Poll all outstanding batch jobs and download their results')
+    parser.add_argument('--output_root', type=str, default='../output', help='directory holding the output dirs')
+    parser.add_argument('--interval', type=float, default=30, help='seconds between polls while shards make progress')
+    parser.add_argument('--max_interval', type=float, default=600, help='upper bound of the poll interval')
+    parser.add_argument('--backoff', type=float, default=2.0, help='factor applied to the interval after a poll without progress')
+    parser.add_argument('--max_workers', type=int, default=16, help='maximum number of concurrent API calls')
+    parser.add_argument('--evaluate', action='store_true', help='evaluate each run once all its shards are done')
+    parser.add_argument('--once', action='store_true', help='poll every pending shard once and exit')
+    parser.add_argument('--base_url', type=str, default=None, help='base url of an OpenAI-compatible API, e.g. mock_openai_server.py')
+    return parser
+
+def find_pending_runs(output_root):
+    """Output dirs that have batch shards without a downloaded output"""
+    output_dirs = []
+    for output in sorted(os.listdir(output_root)):
+        output_dir = os.path.join(output_root, output)
+        if os.path.isdir(output_dir) and get_pending_shards(output_dir, load_batch_manifest(output_dir)):
+            output_dirs.append(output_dir)
+    return output_dirs
+
+def get_data_dir(output_dir):
+    if "danganronpa" in os.path.basename(output_dir):
+        return '../data/danganronpa_data/final'
+    return '../data/aceattorney_data/final'
+
+async def watch_run(client, output_dir, args, semaphore, eval_lock):
+    """Poll the shards of one output dir until none is running. Return True if the run finished"""
+    with open(os.path.join(output_dir, "metadata.json"), "r") as file:
+        model = resolve_model(json.load(file)["model"])
+    name = os.path.basename(output_dir)
+
+    async def poll(shard):
+        async with semaphore:
+            try:
+                return await asyncio.to_thread(poll_shard, client, output_dir, shard, model)
+            except Exception as e:  # Keep watching, the next poll retries
+                print(f"<watch_run> {name}: polling {shard['batch_job_id']} failed: {type(e).__name__}: {e}")
+                return None
+
+    interval = args.interval
+    while True:
+        shards = load_batch_manifest(output_dir)
+        pending = get_pending_shards(output_dir, shards)
+        statuses = await asyncio.gather(*[poll(shard) for shard in pending])
+        save_batch_manifest(output_dir, shards)
+        await asyncio.to_thread(load_completion_index, output_dir)  # Index the new output files
+
+        finished = sum(status == "completed" or status in BATCH_FAILED_STATUSES for status in statuses)
+        n_running = len(statuses) - finished
+        if n_running == 0:
+            break
+        if args.once:
+            return False
+        # Poll again soon while shards finish, and less and less often while none does
+        interval = args.interval if finished else min(interval * args.backoff, args.max_interval)
+        print(f"<watch_run> {name}: {n_running}/{len(statuses)} shards running, next poll in {interval:.0f}s")
+        await asyncio.sleep(interval)
+
+    print(f"<watch_run> {name}: all shards done")
+    if args.evaluate:
+        async with eval_lock:  # evaluate draws with matplotlib, which is not thread-safe
+            await asyncio.to_thread(
+                evaluate_single_run, output_dir, get_data_dir(output_dir), name.split("_")[0]
+            )
+    return True
+
+async def watch_all(args):
+    output_dirs = find_pending_runs(args.output_root)
+    print(f"<watch_all> {len(output_dirs)} runs with pending batch shards")
+    if not output_dirs:
+        return
+    client = get_openai_client(args.base_url)
+    semaphore = asyncio.Semaphore(args.max_workers)
+    eval_lock = asyncio.Lock()
+    finished = await asyncio.gather(*[
+        watch_run(client, output_dir, args, semaphore, eval_lock) for output_dir in output_dirs
+    ])
+    print(f"<watch_all> {sum(finished)}/{len(output_dirs)} runs finished")
+
+if __name__ == "__main__":
+    args = parse_watch_arguments().parse_args()
+    if args.evaluate and not os.path.exists("../eval"):
+        os.makedirs("../eval")
+    asyncio.run(watch_all(args))
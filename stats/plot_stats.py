@@ -3,6 +3,10 @@ import typing
 import os
 import json
 import collections
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "source"))
+from dataset_image import read_case
 
 
 FOLDERS = [
@@ -86,7 +90,7 @@ class Chapter:
     print(f"Loading {filename}")
     self.filename = filename
     self.is_aa = filename.startswith("data/ace")
-    self._source_json = json.load(open(filename))
+    self._source_json = read_case(filename)
 
   def turns(self) -> typing.List[Turn]:
     print(f"Loading turns in {self.filename}")